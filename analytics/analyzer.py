@@ -6,13 +6,12 @@ representing trip objects.
 Future: Grab from database?
 '''
 
-import csv
-import datetime
 import json
 import numpy
 import sys
 
 
+from logic.trip_files import load_trips, to_trips
 from utils import Connector
 from models import Trip, Station
 
@@ -23,35 +22,10 @@ class Analyzer:
         
     def read_and_parse(self, file_name):
         '''
-        Parses trips from the given csv file and returns them as a list
+        Parses trips from the given file (csv, or .npz, see
+        logic/trip_files.py) and returns them as a list
         '''
-        trip_list = []
-        with open(file_name, 'r') as f:
-            reader = csv.reader(f)
-            for line in reader:
-                bike_id = line[0]
-                member_type = line[1]
-                trip_type = line[2]
-                output_type_one = "%Y-%m-%d %H:%M:%S.%f"
-                output_type_two = "%Y-%m-%d %H:%M:%S"
-                if "." in line[3]:
-                    start_date =  datetime.datetime.strptime(line[3], output_type_one)
-                else:
-                    start_date =  datetime.datetime.strptime(line[3], output_type_two)
-
-                if "." in line[4]:
-                    end_date =  datetime.datetime.strptime(line[4], output_type_one)
-                else:
-                    end_date =  datetime.datetime.strptime(line[4], output_type_two)
-
-                start_station_id = int(line[5])
-                end_station_id = int(line[6])
-
-                trip = Trip(bike_id, member_type, trip_type, start_date, end_date,
-                            start_station_id, end_station_id)
-                trip_list.append(trip)
-
-        return trip_list
+        return to_trips(load_trips(file_name))
 
     
     def get_station_stats(self, trips):
@@ -15,7 +15,7 @@ def calculate_cost(sim_results):
     num_bikes = sim_results['total_num_bikes']
     num_rebalances = sim_results['total_rebalances']
     num_trips = len(sim_results['trips'])
-    num_dep_diss = len([d for d in sim_results['disappointments'] if not d.trip])
+    num_dep_diss = len(sim_results['empty_station_disappointments'])
     
 
     bike_cost = num_bikes * BIKE_COST
@@ -45,9 +45,8 @@ def long_run_optimize(start_d, end_d, step=100, max_over=1.35, iters=10, fname='
 
     f = open(fname, 'w')
     f.write('nbikes, nrebalances, ntrips, n_arr_dis, n_dep_dis\n')
-    ds = sim_results['disappointments']
-    num_dep_diss = len([d for d in ds if not d.trip])
-    num_arr_diss = len(ds) - num_dep_diss
+    num_dep_diss = len(sim_results['empty_station_disappointments'])
+    num_arr_diss = len(sim_results['full_station_disappointments'])
     f.write('%d, %d, %d, %d, %d\n' % (base_line, sim_results['total_rebalances'],
              len(sim_results['trips']), num_arr_diss, num_dep_diss))
     for nbikes in range(100, int(max_over*base_line), step):
@@ -61,8 +60,8 @@ def long_run_optimize(start_d, end_d, step=100, max_over=1.35, iters=10, fname='
         costs = calculate_cost(sim_results)
         errors[nbikes] = costs['gross_rev'] - costs['gross_cost']
 
-        num_dep_diss = len([d for d in sim_results['disappointments'] if not d.trip])
-        num_arr_diss = len(sim_results['disappointments']) - num_dep_diss
+        num_dep_diss = len(sim_results['empty_station_disappointments'])
+        num_arr_diss = len(sim_results['full_station_disappointments'])
         f.write('%d, %d, %d, %d, %d\n' % (nbikes, sim_results['total_rebalances'],
              len(sim_results['trips']), num_arr_diss, num_dep_diss))
 
@@ -24,6 +24,11 @@ stats about the bike trips:
 '''
 
 from logic import PoissonLogic, Simulator
+from logic.station_index import StationIndex
+from logic.trip_buffer import TripBuffer
+from logic.disappointment_log import DisappointmentLog
+from logic.progress import DEFAULT_JOB
+from logic.sim_clock import epoch_seconds
 from utils import Connector
 from models import Trip, Station
 from tests import RangeEvaluator
@@ -36,10 +41,26 @@ import sys
 import random
 
 class SummaryStats:
-    def __init__(self, start_date, end_date, capacity_dict):
+    def __init__(self, start_date, end_date, capacity_dict, seed=None,
+                 job_id=DEFAULT_JOB, sinks=(), sim_logic=None):
+        '''
+        seed: the simulation's rng_seed. Scenarios run with the same seed
+        share their random numbers, so their differences come from the
+        scenario rather than from noise.
+        job_id: what the simulation's progress is published as, see
+        logic/progress.py
+        sinks: ResultSinks the simulation's results also go to while it
+        runs, see logic/result_sinks.py
+        sim_logic: the sim logic to run, whose session is used as well.
+        A new PoissonLogic with a new session if None.
+        '''
         self.start_date = start_date
         self.end_date = end_date
         self.capacity_dict = capacity_dict
+        self.seed = seed
+        self.job_id = job_id
+        self.sinks = sinks
+        self.sim_logic = sim_logic
 
         self.session = None
         self.trips = None
@@ -58,14 +79,21 @@ class SummaryStats:
 
     def run_simulation(self):
         options = {'station_caps' : self.capacity_dict}
-        session = Connector().getDBSession()
+        if self.seed is not None:
+            options['rng_seed'] = self.seed
+        if self.sim_logic is None:
+            session = Connector().getDBSession()
+        else:
+            session = self.sim_logic.getDBSession()
         self.session = session
         #self.station_list = self.session.query(Station)
 
         # we only have 'real' trips up to the end of 2013
         # so we can't do comparisons/evaluations for 2014
         if self.run_evaluator and self.end_date.year <= 2013:
-            re = RangeEvaluator(self.start_date, self.end_date, logic_options = options)
+            re = RangeEvaluator(self.start_date, self.end_date, logic_options = options,
+                                job_id = self.job_id, sinks = self.sinks,
+                                sim_logic = self.sim_logic)
             self.stats['man_dist_score_arr'] = re.eval_man_indiv_dist(True)
             self.stats['man_dist_score_dep'] = re.eval_man_indiv_dist(False)
             self.stats['eucl_dist_score'] = re.eval_eucl_dist()
@@ -79,9 +107,10 @@ class SummaryStats:
             self.dep_dis_station_counts = re.dep_dis_station_counts
             self.station_list = self.session.query(Station).filter(Station.id.in_(re.station_counts.keys()))
         else:
-            logic = PoissonLogic(session)
+            logic = self.sim_logic or PoissonLogic(session)
             simulator = Simulator(logic)            
-            results = simulator.run(self.start_date, self.end_date, logic_options = options)            
+            results = simulator.run(self.start_date, self.end_date, logic_options = options,
+                                    job_id = self.job_id, sinks = self.sinks)
 
             self.trips = results['trips']
             self.empty_station_disappointments = results['empty_station_disappointments']
@@ -94,20 +123,19 @@ class SummaryStats:
 
     def get_dummy_simulation(self):
         station_ids = [0,1,2,3,4]
-        trip_list = []
+        trips = TripBuffer(StationIndex(station_ids))
 
         for i in range(22):
             start_time = datetime.datetime(2012, 1, 5, hour=i, minute=0, second=0, microsecond=0, tzinfo=None)
             end_time = datetime.datetime(2012, 1, 5, hour=i, minute=20, second=0, microsecond=0, tzinfo=None)
-            trip_list.append(Trip(str(random.randint(1,500)),"Casual", 2,start_time,end_time,i%4,4-i%4))
+            trips.append(i%4, 4-i%4, epoch_seconds(start_time), epoch_seconds(end_time))
 
-        self.trips = trip_list
-        self.full_station_disappointments = []
-        self.empty_station_disappointments = []
+        self.trips = trips
+        self.full_station_disappointments = DisappointmentLog(trips.station_index)
+        self.empty_station_disappointments = DisappointmentLog(trips.station_index)
 
     def calculate_overall_stats(self):
-        trips_and_times = [(trip.duration().total_seconds(), trip) for trip in self.trips]
-        trip_times = [x[0] for x in trips_and_times]
+        trip_times = self.trips.durations()
         self.stats['std_disappointments'] = {'total': numpy.std(self.stats['num_disappointments_per_station'].values()), 'dep': numpy.std(self.stats['num_dep_disappointments_per_station'].values()), 'arr': numpy.std(self.stats['num_arr_disappointments_per_station'].values())}
         self.stats['avg_disappointments'] = {'total': numpy.average(self.stats['num_disappointments_per_station'].values()), 'dep': numpy.average(self.stats['num_dep_disappointments_per_station'].values()), 'arr': numpy.average(self.stats['num_arr_disappointments_per_station'].values())}
 
@@ -121,28 +149,25 @@ class SummaryStats:
         self.stats['avg_trip_time'] = numpy.average(trip_times)
         self.stats['std_trip_time'] = numpy.std(trip_times)
         
-        min_trip = 0 if len(trips_and_times) == 0 else min(trips_and_times)[1]
-        max_trip = 0 if len(trips_and_times) == 0 else max(trips_and_times)[1]
-        
-        self.stats['min_duration_trip'] = {
-            'start_station_name' : self.station_name_dict[min_trip.start_station_id].encode('ascii', 'ignore'),
-            'end_station_name' : self.station_name_dict[min_trip.end_station_id].encode('ascii', 'ignore'),
-            'start_datetime' : min_trip.start_date,
-            'end_datetime' : min_trip.end_date,
-            'duration' : min_trip.duration().total_seconds()
-        }
-        self.stats['max_duration_trip'] = {
-            'start_station_name' : self.station_name_dict[max_trip.start_station_id].encode('ascii', 'ignore'),
-            'end_station_name' : self.station_name_dict[max_trip.end_station_id].encode('ascii', 'ignore'),
-            'start_datetime' : max_trip.start_date,
-            'end_datetime' : max_trip.end_date,
-            'duration' : max_trip.duration().total_seconds()
+        if len(trip_times) > 0:
+            self.stats['min_duration_trip'] = self.describe_trip(numpy.argmin(trip_times))
+            self.stats['max_duration_trip'] = self.describe_trip(numpy.argmax(trip_times))
+
+    def describe_trip(self, row):
+        station_index = self.trips.station_index
+        start_station_id = station_index.id_of(self.trips.start_station[row])
+        end_station_id = station_index.id_of(self.trips.end_station[row])
+        return {
+            'start_station_name' : self.station_name_dict[start_station_id].encode('ascii', 'ignore'),
+            'end_station_name' : self.station_name_dict[end_station_id].encode('ascii', 'ignore'),
+            'start_datetime' : self.trips.start_date(row),
+            'end_datetime' : self.trips.end_date(row),
+            'duration' : float(self.trips.end_time[row] - self.trips.start_time[row])
         }
 
     def calculate_per_station_stats(self):
         dep_counts = {}
         arr_counts = {}
-        pair_counts = {}
         # disapointment counts per station
         #dis_counts = {}
         i = 0
@@ -161,22 +186,18 @@ class SummaryStats:
                 self.dep_dis_station_counts[station1.id] = 0
 
             self.dis_station_counts[station1.id] = self.arr_dis_station_counts[station1.id] + self.dep_dis_station_counts[station1.id]
-            
-            pair_counts[station1_name] = {}
-            for station2 in self.station_list:
-                station2_name = station2.name.encode('ascii','ignore')
-                pair_counts[station1_name][station2_name] = 0            
+
         print i, "in station_list"
-        for trip in self.trips:
-            start_station_name = self.station_name_dict[trip.start_station_id]
-            end_station_name = self.station_name_dict[trip.end_station_id]
-            dep_counts[start_station_name] += 1
-            arr_counts[end_station_name] += 1
-            pair_counts[start_station_name][end_station_name] += 1
+        station_ids = self.trips.station_index.ids.tolist()
+        trip_dep_counts = self.trips.departure_counts()
+        trip_arr_counts = self.trips.arrival_counts()
+        for idx in numpy.flatnonzero(trip_dep_counts + trip_arr_counts):
+            station_name = self.station_name_dict[station_ids[idx]]
+            dep_counts[station_name] += int(trip_dep_counts[idx])
+            arr_counts[station_name] += int(trip_arr_counts[idx])
         self.stats['station_name_dict'] = self.station_name_dict
         self.stats['num_departures_per_station'] = dep_counts
         self.stats['num_arrivals_per_station'] = arr_counts
-        # self.stats['num_trips_per_pair_station'] = pair_counts
         self.stats['num_disappointments_per_station'] = self.dis_station_counts
         self.stats['num_dep_disappointments_per_station'] = self.dep_dis_station_counts 
         self.stats['num_arr_disappointments_per_station'] = self.arr_dis_station_counts
@@ -185,27 +206,14 @@ class SummaryStats:
 
 
     def calculate_per_hour_stats(self):
-        trip_counts = [[0,0] for i in range(24)]
-        dis_time_counts = [0] * 24
-        empty_dis_time_counts = [0] * 24
-        full_dis_time_counts = [0] * 24
-
-        for trip in self.trips:
-            start_hour = trip.start_date.hour
-            trip_counts[start_hour][0] += 1
-            
-            end_hour = trip.end_date.hour
-            trip_counts[end_hour][1] += 1
-
-        for disappointment in self.full_station_disappointments:
-            hour = disappointment.time.hour
-            dis_time_counts[hour] += 1
-            full_dis_time_counts[hour] +=1
-
-        for disappointment in self.empty_station_disappointments:
-            hour = disappointment.time.hour
-            dis_time_counts[hour] += 1
-            empty_dis_time_counts[hour] +=1
+        full_dis_time_counts = self.full_station_disappointments.hour_totals().tolist()
+        empty_dis_time_counts = self.empty_station_disappointments.hour_totals().tolist()
+        dis_time_counts = [full + empty for full, empty in zip(full_dis_time_counts,
+                                                              empty_dis_time_counts)]
+
+        dep_hour_counts = numpy.bincount(self.trips.start_hours(), minlength=24)
+        arr_hour_counts = numpy.bincount(self.trips.end_hours(), minlength=24)
+        trip_counts = [[int(dep_hour_counts[i]), int(arr_hour_counts[i])] for i in range(24)]
 
         # put in suitable form for group chart
         trip_counts_dict = [{
@@ -6,6 +6,7 @@ from datetime import datetime
 from bs4 import BeautifulSoup
 from models import *
 from utils import *
+from occupancy_rollup import add_status_group
 
 XML_URL = 'http://www.capitalbikeshare.com/data/stations/bikeStations.xml'
 
@@ -51,6 +52,8 @@ def parse_and_save_to_db(session, xml):
     data_soup = BeautifulSoup(xml, 'xml') 
     sg = StatusGroup(datetime.datetime.now())
     session.add(sg)
+    # station id -> bike count, for the occupancy rollup
+    bike_counts = {}
     for station in data_soup.findAll('station'):
         station_id = int(station.terminalName.string)
         num_bikes = station.nbBikes.string 
@@ -58,9 +61,11 @@ def parse_and_save_to_db(session, xml):
         # Otherwise it's just an untracked station which we have no data for so we will ignore it
         if station_id in stations:
             session.add(StationStatus(sg, station_id, num_bikes, num_empties))
+            bike_counts[station_id] = int(num_bikes)
         else:
             print "Error no station ",station_id
 
+    add_status_group(session, sg, bike_counts)
     session.commit()
 
 def main():
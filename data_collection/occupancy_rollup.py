@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+'''
+    occupancy_rollup.py
+
+    Maintains the hourly occupancy rollup (StationOccupancy, FleetSize) of
+    station_statuses, which the simulation logics initialize stations
+    from in one query instead of one per station.
+
+    The rollup is built by rebuild, until then readers aggregate
+    station_statuses instead. Once built, the status collector
+    (cron_job.py) adds every status group it saves with add_status_group.
+    To build the rollup of existing statuses, or after editing
+    station_statuses by hand, run:
+
+        python -m data_collection.occupancy_rollup
+'''
+from models import *
+from sqlalchemy.sql import extract, func
+import math
+import numpy
+
+from utils import Connector
+
+
+def add_status_group(session, status_group, bike_counts):
+    '''
+    Adds the statuses of status_group to the rollup, if it was built: a
+    rollup started from the statuses collected since would hide the older
+    ones from hourly_occupancy and max_fleet_size.
+    bike_counts: {station id : bike count} of the group's statuses
+    '''
+    # Made by rebuild, the rollup holds every status since
+    fleet_size = session.query(FleetSize).get(1)
+    if fleet_size is None:
+        return
+    fleet_size.add(sum(bike_counts.itervalues()))
+
+    hour = status_group.time.hour
+    is_week_day = status_group.time.weekday() < 5
+    occupancies = {o.station_id:o for o in session.query(StationOccupancy)
+                                                 .filter(StationOccupancy.hour == hour)
+                                                 .filter(StationOccupancy.is_week_day == is_week_day)}
+    for station_id, bike_count in bike_counts.iteritems():
+        if station_id not in occupancies:
+            occupancies[station_id] = StationOccupancy(station_id, hour, is_week_day)
+            session.add(occupancies[station_id])
+        occupancies[station_id].add(bike_count)
+
+def rebuild(session):
+    '''Recomputes the whole rollup from station_statuses'''
+    session.query(StationOccupancy).delete()
+    session.query(FleetSize).delete()
+
+    # Status group id -> (hour, is_week_day)
+    group_ids, group_times = zip(*session.query(StatusGroup.id, StatusGroup.time)) or ([], [])
+    if not group_ids:
+        session.commit()
+        return
+    group_hours = numpy.zeros(max(group_ids) + 1, dtype=numpy.int64)
+    group_week_days = numpy.zeros(max(group_ids) + 1, dtype=bool)
+    group_hours[list(group_ids)] = [t.hour for t in group_times]
+    group_week_days[list(group_ids)] = [t.weekday() < 5 for t in group_times]
+
+    fleet_size = FleetSize()
+    fleet_size.status_groups = len(group_ids)
+    session.add(fleet_size)
+
+    statuses = session.query(StationStatus.station_id, StationStatus.status_group_id,
+                             StationStatus.bike_count).all()
+    if not statuses:
+        session.commit()
+        return
+    station_ids, status_groups, bike_counts = numpy.array(statuses, dtype=numpy.int64)\
+                                                   .reshape(len(statuses), 3).T
+    hours = group_hours[status_groups]
+    week_days = group_week_days[status_groups]
+
+    # One rollup row per distinct (station, hour, is_week_day)
+    keys = numpy.column_stack([station_ids, hours, week_days])
+    unique_keys, rows = numpy.unique(keys, axis=0, return_inverse=True)
+    counts = numpy.bincount(rows, minlength=len(unique_keys))
+    sums = numpy.bincount(rows, bike_counts, minlength=len(unique_keys))
+    sq_sums = numpy.bincount(rows, bike_counts**2, minlength=len(unique_keys))
+    for (station_id, hour, is_week_day), count, bike_sum, bike_sq_sum in \
+            zip(unique_keys.tolist(), counts.tolist(), sums.tolist(), sq_sums.tolist()):
+        occupancy = StationOccupancy(station_id, hour, bool(is_week_day))
+        occupancy.count = count
+        occupancy.bike_sum = int(bike_sum)
+        occupancy.bike_sq_sum = int(bike_sq_sum)
+        session.add(occupancy)
+
+    group_totals = numpy.bincount(status_groups, bike_counts)
+    fleet_size.max_bike_total = int(group_totals.max())
+    session.commit()
+    print "Rolled up %d statuses into %d occupancies" % (len(statuses), len(unique_keys))
+
+def hourly_occupancy(session, hour):
+    '''
+    {station id : (count, bike sum, bike sum of squares)} of the statuses
+    taken at hour, week days and weekends together. Read from the rollup,
+    or aggregated from station_statuses if the rollup wasn't built.
+    '''
+    if session.query(FleetSize).get(1) is not None:
+        query = session.query(StationOccupancy.station_id,
+                              func.sum(StationOccupancy.count),
+                              func.sum(StationOccupancy.bike_sum),
+                              func.sum(StationOccupancy.bike_sq_sum))\
+                       .filter(StationOccupancy.hour == hour)\
+                       .group_by(StationOccupancy.station_id)
+    else:
+        query = session.query(StationStatus.station_id,
+                              func.count(StationStatus.bike_count),
+                              func.sum(StationStatus.bike_count),
+                              func.sum(StationStatus.bike_count * StationStatus.bike_count))\
+                       .join(StatusGroup)\
+                       .filter(extract('hour', StatusGroup.time) == hour)\
+                       .group_by(StationStatus.station_id)
+    return {s_id:(int(count), int(bike_sum), int(bike_sq_sum))
+            for s_id, count, bike_sum, bike_sq_sum in query}
+
+def mean_std(count, bike_sum, bike_sq_sum):
+    '''Mean and (population) standard deviation of a rollup's bike counts'''
+    mean = bike_sum / float(count)
+    return mean, math.sqrt(max(bike_sq_sum / float(count) - mean**2, 0))
+
+def max_fleet_size(session):
+    '''Largest number of bikes docked at once over all the status groups'''
+    fleet_size = session.query(FleetSize).get(1)
+    if fleet_size is not None:
+        return fleet_size.max_bike_total
+    return max(session.query(func.sum(StationStatus.bike_count))\
+                      .group_by(StationStatus.status_group_id).all())[0]
+
+def main():
+    session = Connector().getDBSession()
+    rebuild(session)
+
+if __name__ == "__main__":
+    main()
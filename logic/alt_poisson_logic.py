@@ -6,13 +6,14 @@
     - Do we have to specify standard deviation and whatever the poisson equivalent is? (Perhaps we use scipy's rvs function but I haven't figured it out yet.)
 '''
 from utils import Connector
-import bisect
 from models import *
-from scipy.stats import poisson
 from scipy import stats
 import numpy
 import random
 from simulation_logic import SimulationLogic
+from random_streams import DEPARTURES, DESTINATIONS
+from model_artifacts import ExpRate
+from model_tables import GammaTable, KeyedTable, flatten
 import datetime
 from dateutil import rrule
 from collections import defaultdict
@@ -28,18 +29,15 @@ LOG2 = 2
 
 class AltPoissonLogic(SimulationLogic):
 
+    MODEL_TYPES = ['exp_lambda', 'gamma', 'dest_distr']
     def __init__(self, session):
         SimulationLogic.__init__(self, session)
 
     def initialize(self, start_time, end_time, **kwargs):
         SimulationLogic.initialize(self, start_time, end_time, **kwargs)
         self.time_of_last_data = datetime.datetime(2013, 07, 01)
-        print "Loading Lambdas"
-        self.lambda_distrs = self.load_lambdas(start_time, end_time)
-        print "Loading Gammas"
-        self.duration_distrs = self.load_gammas()
-        print "Loading Destination Distrs"
-        self.dest_distrs = self.load_dest_distrs(start_time, end_time)
+        self.last_data_second = self.clock.seconds(self.time_of_last_data)
+        self.ensure_models(start_time, end_time)
         self.moving_bikes = 0
         if end_time > self.time_of_last_data:
             self.regression_type = LINEAR
@@ -48,6 +46,25 @@ class AltPoissonLogic(SimulationLogic):
             self.monthly_intercept = regression_data[1]
 
 
+    def load_models(self, start_time, end_time):
+        print "Loading Lambdas"
+        self.lambda_distrs = self.load_lambdas(start_time, end_time)
+        print "Loading Gammas"
+        self.duration_distrs = self.load_gammas()
+        print "Loading Destination Distrs"
+        self.dest_distrs = self.load_dest_distrs(start_time, end_time)
+
+    def model_arrays(self):
+        arrays = self.lambda_distrs.arrays('lambdas')
+        arrays.update(self.duration_distrs.arrays('gammas'))
+        arrays.update(self.dest_distrs.arrays('dest_distrs'))
+        return arrays
+
+    def set_model_arrays(self, arrays):
+        self.lambda_distrs = KeyedTable.from_arrays(arrays, 'lambdas')
+        self.duration_distrs = GammaTable.from_arrays(self.station_index, arrays, 'gammas')
+        self.dest_distrs = KeyedTable.from_arrays(arrays, 'dest_distrs')
+
     def init_regression_hardcoded(self):
         # Hard-coded for LOG2, which worked best on one day of PoissonLogic...
         monthly_slope = [140162.706152, 94490.3697272, 160616.094567, 212792.877352, \
@@ -117,14 +134,13 @@ class AltPoissonLogic(SimulationLogic):
 
     def update(self, timestep):
         '''Moves the simulation forward one timestep from given time'''
-        self.rebalance_stations(self.time)
-        self.generate_new_trips(self.time)
-        self.time += timestep
+        self.generate_new_trips(self.now)
+        self.now += int(timestep.total_seconds())
         self.resolve_trips()
 
     def load_dest_distrs(self, start_time, end_time):
         '''
-        Caches destination distributions into dictionary of day -> hour -> start_station_id -> [cumulative_distr, corresponding stations]
+        Caches destination distributions into a KeyedTable of (start_station_id, year, month, is_week_day, hour) -> [cumulative probability vector, corresponding stations]
         # Change to a list of lists, faster, more space efficient
         '''
         time_diff = end_time - start_time 
@@ -156,95 +172,113 @@ class AltPoissonLogic(SimulationLogic):
                 year = day.year
             print "Year", year
 
-            date_distrs = self.session.query(data_model.DestDistr) \
-               .filter(DestDistr.year == year)\
-               .filter(DestDistr.month == day.month-1)\
-               .filter(DestDistr.is_week_day == (dow < 5)) \
-               .filter(DestDistr.hour.between(start_hour, end_hour))\
-               .yield_per(10000)
+            # Months of destination distributions start at 0
+            distrs = self.model_artifacts.get('dest_distr', (year, day.month-1, dow < 5))
+            in_hours = (distrs['hour'] >= start_hour) & (distrs['hour'] <= end_hour)
+            date_distrs = zip(*[distrs[name][in_hours].tolist()
+                                for name in ['start_station_id', 'end_station_id', 'year',
+                                             'month', 'is_week_day', 'hour', 'prob']])
 
             # TODO REMOVE count stuff
             count = 0
             s_count = 0
-            for distr in date_distrs:
+            for s_id, e_id, d_year, d_month, is_week_day, hour, prob in date_distrs:
                 count += 1
-                # Faster to do this than be smart about the db query
-                if distr.start_station_id in self.stations \
-                        and distr.end_station_id in self.stations:
+                # Faster to do this than be smart about the artifact
+                if s_id in self.stations \
+                        and e_id in self.stations:
                     s_count += 1
-                    result = distr_dict[distr.start_station_id][distr.year][distr.month+1][distr.is_week_day][distr.hour]
+                    result = distr_dict[s_id][d_year][d_month+1][is_week_day][hour]
 
                     # Unencountered  day, hour, start_station_id -> Create the list of lists containing distribution probability values and corresponding end station ids.
                     if len(result) == 0:
-                        distr_dict[distr.start_station_id][distr.year][distr.month+1][distr.is_week_day]\
-                                  [distr.hour] = [[distr.prob], [distr.end_station_id]]
+                        distr_dict[s_id][d_year][d_month+1][is_week_day]\
+                                  [hour] = [[prob], [e_id]]
                     else:
-                        result[0].append(distr.prob)
-                        result[1].append(distr.end_station_id)
+                        result[0].append(prob)
+                        result[1].append(e_id)
                     num_distrs += 1
 
-            print "\t\tStarting reductions"
-            # Change all of the probability vectors into cumulative probability vectors
-            for s_id, s_id_info in distr_dict.iteritems():
-                for hour, vectors in s_id_info[day.year][day.month][(dow < 5)].iteritems():
-                    # We have data for choosing destination vector
-                    if len(vectors) == 2:
-                        prob_vector = vectors[0]
-                        # thanks to http://stackoverflow.com/questions/14132545/itertools-accumulate-versus-functools-reduce
-                        # for basic accumulator code
-                        cum_prob_vector = reduce(lambda a, x: a + [a[-1] + x], prob_vector[1:], [prob_vector[0]])
-                        vectors[0] = cum_prob_vector
+
+        # Change all of the probability lists into cumulative probability
+        # vectors, once every day has been loaded
+        for s_id_info in distr_dict.itervalues():
+            for year_info in s_id_info.itervalues():
+                for month_info in year_info.itervalues():
+                    for day_info in month_info.itervalues():
+                        for vectors in day_info.itervalues():
+                            vectors[0] = numpy.cumsum(vectors[0])
+                            vectors[1] = numpy.array(vectors[1])
         print "Loaded %d distrs" % num_distrs
-        return distr_dict
+        return KeyedTable.from_dict(flatten(distr_dict, 5), 5, [numpy.float64, numpy.int64])
 
 
-    def _get_destination(self, s_id, time):
+    def _get_destination_counts(self, s_id, time, num_trips):
         '''
-            Returns a destination station given dest_distrs
+            Splits num_trips leaving s_id between destinations given dest_distrs.
+            Returns parallel arrays (end station ids, number of trips)
         '''
-        if time > self.time_of_last_data:
-            year = self.get_year_range_of_data(time.month)[-1]
-        else:
-            year = time.year
-        vectors = self.dest_distrs[s_id][year][time.month][time.weekday() < 5][time.hour]
+        year, month, weekday, hour = self.clock.hour_key(time)
+        if time > self.last_data_second:
+            year = self.get_year_range_of_data(month)[-1]
+        vectors = self.dest_distrs.get((s_id, year, month, weekday < 5, hour))
         if vectors:
-            cum_prob_vector = vectors[0]
-            station_vector = vectors[1]
-
-            # cum_prob_vector[-1] should be 1 No scaling needed as described here:
-            # http://docs.python.org/3/library/random.html (very bottom of page)
-            # Scale it appropriately
-            x = random.random() * cum_prob_vector[-1] 
-        
-            return station_vector[bisect.bisect(cum_prob_vector, x)]
+            cum_prob_vector, station_vector = vectors
         else:
-            print "Error getting destination: Day",time.day,"hour",time.hour,"s_id",s_id
-            # Send it to one of 273 randomly
-            return random.choice(self.stations.keys())
+            print "Error getting destination: Day",weekday,"hour",hour,"s_id",s_id
+            # Send them to one of 273 randomly
+            station_vector = self.station_index.ids
+            cum_prob_vector = numpy.arange(1, len(station_vector) + 1)
+        # Destinations are drawn per station and hour
+        choices = self.random_streams.choices(DESTINATIONS, cum_prob_vector, s_id,
+                                              self.clock.origin + time,
+                                              numpy.arange(num_trips))
+        return station_vector, numpy.bincount(choices, minlength=len(station_vector))
 
     def generate_new_trips(self, start_time):
-        for s_id in self.station_counts:
-            if start_time > self.time_of_last_data:
-                lam = self.predict_future_lambda(start_time, s_id)
+        '''
+        Draws departure counts of all stations with one Poisson call, then
+        splits each station's departures between destinations with a
+        multinomial draw and schedules all the trips as a single batch.
+        '''
+        station_ids = []
+        means = []
+        year, month, weekday, hour = self.clock.hour_key(start_time)
+        is_future = start_time > self.last_data_second
+        for s_id in self.station_index.ids.tolist():
+            if is_future:
+                lam = self.predict_future_lambda(self.clock.to_datetime(start_time), s_id)
             else:
-                lam = self.get_lambda(start_time.year, start_time.month,
-                                  start_time.weekday(), start_time.hour, s_id)
+                lam = self.get_lambda(year, month, weekday, hour, s_id)
             if lam:
-                num_trips = self.get_num_trips(lam)
-                for i in xrange(num_trips):
-                    e_id = self._get_destination(s_id, start_time)
-                    gamma = self.duration_distrs.get((s_id, e_id), None)
-                    if gamma:
-                        added_time = datetime.timedelta(seconds=random.randint(0, 3600))
-                        trip_start_time = start_time + added_time
-                        trip_duration = self.get_trip_duration(gamma)
-                        trip_end_time = trip_start_time + trip_duration
-                        new_trip = data_model.Trip(str(random.randint(1,500)), 
-                                                  "Casual", 2, 
-                                                  trip_start_time, trip_end_time,
-                                                  s_id, e_id)
-                        self.pending_departures.put((start_time, new_trip))
-    
+                station_ids.append(s_id)
+                means.append(3600./lam.rate)
+        if not station_ids:
+            return
+        # Departure counts are drawn per station and hour
+        num_departures = self.random_streams.poissons(DEPARTURES, means, station_ids,
+                                                      self.clock.origin + start_time)
+
+        start_ids = []
+        end_ids = []
+        shapes = []
+        scales = []
+        for s_id, num_trips in zip(station_ids, num_departures):
+            if num_trips == 0:
+                continue
+            e_ids, counts = self._get_destination_counts(s_id, start_time, num_trips)
+            for e_id, count in zip(e_ids[counts > 0], counts[counts > 0]):
+                gamma = self.duration_distrs.get((s_id, e_id), None)
+                if gamma:
+                    start_ids.extend([s_id] * count)
+                    end_ids.extend([e_id] * count)
+                    shapes.extend([gamma.shape] * count)
+                    scales.extend([gamma.scale] * count)
+        self.schedule_trip_batch(start_time,
+                                 self.station_index.indexes_of(start_ids),
+                                 self.station_index.indexes_of(end_ids),
+                                 shapes, scales)
+
 
     def predict_future_lambda(self, start_time, station_id):
         month = start_time.month
@@ -259,7 +293,7 @@ class AltPoissonLogic(SimulationLogic):
         lam_prediction /= len(self.get_year_range_of_data(month))
         if lam_prediction <= 0:
             return None
-        return ExpLambda(station_id, start_time.year, start_time.month, start_time.weekday()<5, start_time.hour, lam_prediction)
+        return ExpRate(lam_prediction)
 
 
     def predict_from_one_year(self, prev_year, prev_year_lambda, slope, intercept, start_time):
@@ -303,24 +337,6 @@ class AltPoissonLogic(SimulationLogic):
             return [2011, 2012]
 
 
-    def get_num_trips(self, lam):
-        """
-        Samples a poisson distribution with the given lambda and returns the number
-        of trips produced from the dist. Returns -1 if lambda = 0 -> undefined function.
-        """
-        # HACK RIGHT NOW
-        probability = random.random()
-        while probability == 0:
-            probability = random.random()
-
-        # (4./3) * 
-        num_trips = poisson.ppf(probability, 3600./lam.rate)
-
-        if numpy.isnan(num_trips):
-            num_trips = -1
-        return int(round(num_trips))
-
-
     def load_gaussians(self):
         """
         Caches gaussian distribution values into a dictionary.
@@ -334,33 +350,36 @@ class AltPoissonLogic(SimulationLogic):
 
     def load_gammas(self):
         '''
-        Caches gaussian distribution variables into a dictionary.
+        Caches gamma distribution variables into a GammaTable.
         '''
-        gamma_distr = self.session.query(data_model.Gamma)
-        distr_dict = {}
-        for gamma in gamma_distr:
-            distr_dict[(gamma.start_station_id, gamma.end_station_id)] = gamma 
-        return distr_dict
+        gammas = self.model_artifacts.get('gamma')
+        return GammaTable.from_columns(self.station_index, gammas['start_station_id'],
+                                       gammas['end_station_id'], gammas['shape'],
+                                       gammas['scale'])
 
     def get_lambda(self, year, month, day, hour, start_station):
         '''
         If there is a lambda, return it. Otherwise return None as we only 
         load non-zero lambdas from the database for performance reasons.
         '''
-        return self.lambda_distrs.get(year, {}).get(month, {}).get(day < 5, {}).get(hour, {}).get(start_station, None)
+        rates = self.lambda_distrs.get((year, month, day < 5, hour, start_station))
+        if rates is None:
+            return None
+        return ExpRate(float(rates[0][0]))
 
     def load_lambdas(self, start_time, end_time):
         '''
+        Caches exp lambdas into a KeyedTable of
+        (year, month, is_week_day, hour, station_id) -> [rate]
         Note: DB only has values > 0.
         '''
-        # kind of gross but makes for easy housekeeping
-        distr_dict = defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: defaultdict(float)))))
+        # (year, month, is_week_day, hour, station_id) -> ([rate],)
+        distr_dict = {}
 
         # keep track of when we've hit the database for a particular request
         requested_dict = defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: defaultdict(bool))))
 
         num_added = 0
-        station_list = self.stations.keys()
         
         # If future, load lambdas for that time every year
         if end_time > self.time_of_last_data:
@@ -377,16 +396,9 @@ class AltPoissonLogic(SimulationLogic):
                 year = day.year
                 is_week_day = dow < 5
                 if not requested_dict[month][year][is_week_day][(start_hour, end_hour)]:
-                    lambda_poisson = self.session.query(ExpLambda)\
-                        .filter(ExpLambda.is_week_day == is_week_day)\
-                        .filter(ExpLambda.month == month)\
-                        .filter(ExpLambda.hour.between(start_hour, end_hour))\
-                        .filter(ExpLambda.station_id.in_(station_list))
+                    num_added += self._add_rates(distr_dict, (None, month, is_week_day),
+                                                 start_hour, end_hour)
                     requested_dict[month][year][is_week_day][(start_hour, end_hour)] = True
-
-                for lam in lambda_poisson:
-                    distr_dict[lam.year][lam.month][lam.is_week_day][lam.hour][lam.station_id] = lam
-                    num_added += 1
                             
         for day in rrule.rrule(rrule.DAILY, dtstart=start_time, until=end_time):
             dow = day.weekday()
@@ -399,32 +411,26 @@ class AltPoissonLogic(SimulationLogic):
             is_week_day = dow < 5
             
             if not requested_dict[month][year][is_week_day][(start_hour, end_hour)]:
-                lambda_poisson = self.session \
-                                     .query(ExpLambda) \
-                                     .filter(ExpLambda.month == month) \
-                                     .filter(ExpLambda.year == year) \
-                                     .filter(ExpLambda.is_week_day == is_week_day) \
-                                     .filter(ExpLambda.hour.between(start_hour, end_hour))\
-                                     .filter(ExpLambda.station_id.in_(station_list))
+                num_added += self._add_rates(distr_dict, (year, month, is_week_day),
+                                             start_hour, end_hour)
                 requested_dict[month][year][is_week_day][(start_hour, end_hour)] = True
-                
-            for lam in lambda_poisson:
-                distr_dict[lam.year][lam.month][lam.is_week_day][lam.hour][lam.station_id] = lam
-                num_added += 1
 
         print "Loaded %s lambdas" % num_added
-        return distr_dict
+        return KeyedTable.from_dict(distr_dict, 5, [numpy.float64])
 
-    def get_trip_duration(self, gamma):
+    def _add_rates(self, distr_dict, calendar_slice, start_hour, end_hour):
         '''
-        Samples from a gamma distribution and returns a timedelta representing
-        a trip length
+        Adds the exp lambdas of a calendar slice (see ModelArtifacts) within
+        the given hours to distr_dict, returns how many were added
         '''
-        #TODO Fix this
-        if gamma.shape <= 0 or gamma.scale <= 0:
-            return datetime.timedelta(seconds=0)
-        trip_length = numpy.random.gamma(gamma.shape, gamma.scale)
-        return datetime.timedelta(seconds=trip_length)
+        rates = self.model_artifacts.get('exp_lambda', calendar_slice)
+        selected = (rates['hour'] >= start_hour) & (rates['hour'] <= end_hour)\
+                   & numpy.in1d(rates['station_id'], self.station_index.ids)
+        columns = [rates[name][selected].tolist()
+                   for name in ['station_id', 'year', 'month', 'is_week_day', 'hour', 'rate']]
+        for s_id, year, month, is_week_day, hour, rate in zip(*columns):
+            distr_dict[(year, month, is_week_day, hour, s_id)] = ([rate],)
+        return len(columns[0])
 
     def clean_up(self):
         pass
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+'''
+    bulk_writer.py
+
+    Saves produced trips and disappointments straight from their columns
+    (TripBuffer, DisappointmentLog), without building ORM objects. On
+    PostgreSQL rows are streamed through COPY ... FROM STDIN, their ids
+    drawn from the table's sequence in one query; other backends get
+    executemany inserts of batch_size rows.
+
+    DBWriter is a ResultSink (see result_sinks.py) doing the same on a
+    background thread while the run goes on, see Simulator.run.
+'''
+import Queue
+import StringIO
+import csv
+import threading
+import numpy
+
+from models import Trip, TripType, Disappointment
+from result_sinks import ResultSink, END_OF_RUN, format_dates
+from sim_clock import from_epoch_seconds
+
+TRIP_COLUMNS = ['bike_id', 'member_type', 'trip_type_id', 'start_date', 'end_date',
+                'start_station_id', 'end_station_id']
+DISAPPOINTMENT_COLUMNS = ['station_id', 'time', 'trip_id']
+# Columns holding epoch seconds, saved as DateTime
+DATE_COLUMNS = set(['start_date', 'end_date', 'time'])
+
+
+def produced_trip_type(session):
+    '''Commits a new Produced TripType for the trips of a run, returns its id'''
+    trip_type = TripType('Produced')
+    session.add(trip_type)
+    session.commit()
+    return trip_type.id
+
+def trip_values(trips, trip_type_id, rng=numpy.random):
+    '''
+    Lists of the values of TRIP_COLUMNS for every trip of a TripBuffer,
+    dates as epoch seconds. Bike ids are made up, as in TripBuffer.to_trips.
+    '''
+    num_trips = len(trips)
+    return [rng.randint(1, 501, num_trips).astype(str).tolist(),
+            ['Casual'] * num_trips,
+            [trip_type_id] * num_trips,
+            (trips.origin + trips.start_time).tolist(),
+            (trips.origin + trips.end_time).tolist(),
+            trips.start_station_ids().tolist(),
+            trips.end_station_ids().tolist()]
+
+def disappointment_values(disappointments):
+    '''Lists of the values of DISAPPOINTMENT_COLUMNS for every row of a DisappointmentLog'''
+    return [disappointments.station_index.ids_of(disappointments.station).tolist(),
+            (disappointments.origin + disappointments.time).tolist(),
+            [None] * len(disappointments)]
+
+def write_rows(connection, table, columns, values, batch_size=10000):
+    '''
+    Inserts the rows of values, one list per column of columns, into table
+    over a SQLAlchemy connection, batch_size rows at a time
+    '''
+    if not values or not len(values[0]):
+        return
+    if connection.dialect.name == 'postgresql':
+        write = _copy_rows
+    else:
+        write = _insert_rows
+    num_rows = len(values[0])
+    for first in xrange(0, num_rows, batch_size):
+        write(connection, table, columns,
+              [column[first:first + batch_size] for column in values])
+
+def _copy_rows(connection, table, columns, values):
+    sequence = table.c.id.default.name
+    ids = [row[0] for row in connection.execute(
+                "SELECT nextval('%s') FROM generate_series(1, %d)" % (sequence, len(values[0])))]
+    values = [format_dates(0, numpy.asarray(column, dtype=numpy.int64))
+              if name in DATE_COLUMNS else column
+              for name, column in zip(columns, values)]
+    buf = StringIO.StringIO()
+    # None is written as an empty field, which COPY reads as NULL
+    csv.writer(buf).writerows(zip(ids, *values))
+    buf.seek(0)
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert('COPY %s (%s) FROM STDIN WITH CSV'
+                           % (table.name, ', '.join(['id'] + columns)), buf)
+    finally:
+        cursor.close()
+
+def _insert_rows(connection, table, columns, values):
+    values = [[from_epoch_seconds(t) for t in column] if name in DATE_COLUMNS else column
+              for name, column in zip(columns, values)]
+    connection.execute(table.insert(), [dict(zip(columns, row)) for row in zip(*values)])
+
+def save_results(connection, trips, disappointments, trip_type_id,
+                 batch_size=10000, rng=numpy.random):
+    '''Writes a TripBuffer and a DisappointmentLog to the trips and disappointments tables'''
+    write_rows(connection, Trip.__table__, TRIP_COLUMNS,
+               trip_values(trips, trip_type_id, rng), batch_size)
+    write_rows(connection, Disappointment.__table__, DISAPPOINTMENT_COLUMNS,
+               disappointment_values(disappointments), batch_size)
+
+
+class DBWriter(ResultSink):
+    '''
+    Saves the results of a run as they come in, on a background thread
+    with its own connection. At most maxsize batches wait for the thread,
+    after which the run waits for it. Every batch is committed once
+    written, under one new Produced TripType. Errors of the thread are
+    raised in the run, by the next write or by close.
+    '''
+
+    def __init__(self, session, maxsize=16, batch_size=10000):
+        self.session = session
+        self.engine = session.get_bind()
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.trip_type_id = None
+
+    def open(self):
+        self.trip_type_id = produced_trip_type(self.session)
+        self.queue = Queue.Queue(self.maxsize)
+        self.error = None
+        self.rows_written = 0
+        self.thread = threading.Thread(target=self._write_batches)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, time, trips, disappointments):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((trips, disappointments))
+
+    def close(self):
+        self.queue.put(END_OF_RUN)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _write_batches(self):
+        # The thread's own bike id draws leave the run's random state alone
+        rng = numpy.random.RandomState()
+        connection = self.engine.connect()
+        try:
+            while True:
+                batch = self.queue.get()
+                if batch is END_OF_RUN:
+                    return
+                trips, disappointments = batch
+                with connection.begin():
+                    save_results(connection, trips, disappointments,
+                                 self.trip_type_id, self.batch_size, rng)
+                self.rows_written += len(trips) + len(disappointments)
+        except Exception, e:
+            self.error = e
+            # Keep taking batches so the run never waits on a full queue
+            while self.queue.get() is not END_OF_RUN:
+                pass
+        finally:
+            connection.close()
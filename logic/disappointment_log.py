@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+'''
+    disappointment_log.py
+
+    Append-only log of the disappointments of a simulation run: riders
+    finding their start station empty or their end station full. Like
+    TripBuffer, every disappointment is a row of a few growing columns
+    (station index, time in simulation seconds, full or empty, trip row),
+    and the per-station and per-hour counts are kept up to date on every
+    append so reports don't need to go through the rows.
+
+    Nothing touches the DB while simulating, see bulk_writer.py to save
+    the log.
+'''
+import numpy
+
+from models import Disappointment
+from sim_clock import from_epoch_seconds, HOUR
+
+# Disappointment not tied to a trip
+NO_TRIP = -1
+
+COLUMNS = [('station', numpy.int32),
+           ('time', numpy.int64),
+           ('is_full', bool),
+           ('trip', numpy.int64)]
+
+
+class DisappointmentLog(object):
+
+    def __init__(self, station_index, origin=0, capacity=1024):
+        '''origin: epoch seconds of time 0, i.e. the simulation's SimClock.origin'''
+        self.station_index = station_index
+        self.origin = origin
+        self.size = 0
+        self._columns = {name:numpy.zeros(capacity, dtype=dtype)
+                         for name, dtype in COLUMNS}
+        # [empty, full] disappointments of every station index / hour of the day
+        self.station_counts = numpy.zeros((2, len(station_index)), dtype=numpy.int64)
+        self.hour_counts = numpy.zeros((2, 24), dtype=numpy.int64)
+
+    def __len__(self):
+        return self.size
+
+    # Views of the filled part of every column, see TripBuffer
+    @property
+    def station(self):
+        return self._columns['station'][:self.size]
+
+    @property
+    def time(self):
+        return self._columns['time'][:self.size]
+
+    @property
+    def is_full(self):
+        return self._columns['is_full'][:self.size]
+
+    @property
+    def trip(self):
+        return self._columns['trip'][:self.size]
+
+    def _reserve(self, num_rows):
+        capacity = len(self._columns['station'])
+        needed = self.size + num_rows
+        if needed <= capacity:
+            return
+        capacity = max(capacity * 2, needed)
+        for name, column in self._columns.items():
+            grown = numpy.zeros(capacity, dtype=column.dtype)
+            grown[:self.size] = column[:self.size]
+            self._columns[name] = grown
+
+    def append(self, station, time, is_full, trip=NO_TRIP):
+        '''Logs one disappointment at station index station, returns its row'''
+        self._reserve(1)
+        row = self.size
+        columns = self._columns
+        columns['station'][row] = station
+        columns['time'][row] = time
+        columns['is_full'][row] = is_full
+        columns['trip'][row] = trip
+        self.size += 1
+        kind = int(is_full)
+        self.station_counts[kind, station] += 1
+        self.hour_counts[kind, ((self.origin + time) // HOUR) % 24] += 1
+        return row
+
+    def extend(self, station, time, is_full, trip):
+        '''Logs one disappointment per entry of the given (parallel) arrays'''
+        num_rows = len(station)
+        self._reserve(num_rows)
+        first = self.size
+        last = first + num_rows
+        columns = self._columns
+        columns['station'][first:last] = station
+        columns['time'][first:last] = time
+        columns['is_full'][first:last] = is_full
+        columns['trip'][first:last] = trip
+        self.size = last
+        kinds = columns['is_full'][first:last].astype(int)
+        hours = ((self.origin + columns['time'][first:last]) // HOUR) % 24
+        numpy.add.at(self.station_counts, (kinds, columns['station'][first:last]), 1)
+        numpy.add.at(self.hour_counts, (kinds, hours), 1)
+
+    def select(self, rows):
+        '''A new log holding copies of the given rows (indexes or mask)'''
+        selected = DisappointmentLog(self.station_index, self.origin, capacity=0)
+        selected.extend(*[getattr(self, name)[rows] for name, dtype in COLUMNS])
+        return selected
+
+    def clear(self):
+        '''Drops every row, the counts by station and hour are kept'''
+        self.size = 0
+
+    def of_kind(self, is_full):
+        '''The full station (or empty station) disappointments'''
+        return self.select(self.is_full == is_full)
+
+    def station_totals(self, is_full):
+        '''Number of full (or empty) station disappointments by station index'''
+        return self.station_counts[int(is_full)]
+
+    def hour_totals(self, is_full=None):
+        '''Number of disappointments by hour of the day, of one kind or both'''
+        if is_full is None:
+            return self.hour_counts.sum(axis=0)
+        return self.hour_counts[int(is_full)]
+
+    def dates(self):
+        return [from_epoch_seconds(t) for t in (self.origin + self.time).tolist()]
+
+    def to_disappointments(self):
+        '''Builds ORM Disappointment objects for every row'''
+        station_ids = self.station_index.ids_of(self.station).tolist()
+        return [Disappointment(s_id, date, trip_id=None, is_full=is_full)
+                for s_id, date, is_full in zip(station_ids, self.dates(),
+                                               self.is_full.tolist())]
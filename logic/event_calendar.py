@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+'''
+    event_calendar.py
+
+    Event calendars hold every pending departure and arrival of a simulation
+    run. Entries are ordered by (time, event type, insertion order) so that
+    ties never fall back to comparing the payloads (trips) themselves and
+    departures still resolve before arrivals that happen at the same time.
+
+    Two backends are available:
+    - HeapCalendar: a single binary heap (heapq)
+    - CalendarQueue: events hashed into fixed width time buckets, each bucket
+      being a small heap. Cheaper when many events are pending at once.
+'''
+import datetime
+import heapq
+import itertools
+
+HEAP_CALENDAR = 'heap'
+CALENDAR_QUEUE = 'calendar_queue'
+
+
+class EventCalendar:
+    '''
+    Interface shared by all calendars. Events are pushed as
+    (time, event_type, payload) and popped back in the same form.
+    '''
+
+    def __init__(self):
+        # Monotonic counter used as a stable tie-breaker
+        self._seq = itertools.count()
+
+    def push(self, time, event_type, payload):
+        raise NotImplementedError
+
+    def push_sorted(self, events):
+        '''
+        Bulk insert of (time, event_type, payload) tuples that are already
+        sorted by (time, event_type).
+        '''
+        for time, event_type, payload in events:
+            self.push(time, event_type, payload)
+
+    def pop(self):
+        '''Removes and returns the earliest event or None if empty'''
+        raise NotImplementedError
+
+    def peek_time(self):
+        '''Time of the earliest event or None if empty'''
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def empty(self):
+        return len(self) == 0
+
+    def events(self):
+        '''
+        All pending (time, event_type, payload) in the order they would be
+        popped, without removing them. push_sorted takes them back as is.
+        '''
+        return [(time, event_type, payload)
+                for time, event_type, seq, payload in sorted(self._pending_entries())]
+
+    def _pending_entries(self):
+        raise NotImplementedError
+
+    def _entries(self, events):
+        seq = self._seq
+        return [(time, event_type, next(seq), payload)
+                for time, event_type, payload in events]
+
+
+class HeapCalendar(EventCalendar):
+
+    calendar_type = HEAP_CALENDAR
+
+    def __init__(self):
+        EventCalendar.__init__(self)
+        self._heap = []
+
+    def push(self, time, event_type, payload):
+        heapq.heappush(self._heap, (time, event_type, next(self._seq), payload))
+
+    def push_sorted(self, events):
+        entries = self._entries(events)
+        if not self._heap:
+            # A sorted list already satisfies the heap invariant
+            self._heap = entries
+        elif len(entries) * 4 > len(self._heap):
+            # Cheaper to rebuild the heap in linear time than to sift each
+            self._heap.extend(entries)
+            heapq.heapify(self._heap)
+        else:
+            for entry in entries:
+                heapq.heappush(self._heap, entry)
+
+    def pop(self):
+        if not self._heap:
+            return None
+        time, event_type, seq, payload = heapq.heappop(self._heap)
+        return time, event_type, payload
+
+    def peek_time(self):
+        if not self._heap:
+            return None
+        return self._heap[0][0]
+
+    def __len__(self):
+        return len(self._heap)
+
+    def _pending_entries(self):
+        return self._heap
+
+
+class CalendarQueue(EventCalendar):
+    '''
+    Time-bucketed calendar. Only non-empty buckets are stored, so the
+    queue doesn't need to be resized as the simulation moves forward.
+    bucket_width: width of a bucket, in seconds
+    '''
+
+    calendar_type = CALENDAR_QUEUE
+
+    def __init__(self, bucket_width=900, origin=None):
+        EventCalendar.__init__(self)
+        self.bucket_width = bucket_width
+        self.origin = origin
+        # bucket index -> heap of entries
+        self._buckets = {}
+        # Lowest bucket index that may hold an event
+        self._cur = None
+        self._size = 0
+
+    def _bucket(self, time):
+        if self.origin is None:
+            self.origin = time
+        delta = time - self.origin
+        if isinstance(delta, datetime.timedelta):
+            delta = delta.total_seconds()
+        return int(delta // self.bucket_width)
+
+    def _first_bucket(self):
+        if self._cur not in self._buckets:
+            self._cur = min(self._buckets)
+        return self._buckets[self._cur]
+
+    def push(self, time, event_type, payload):
+        idx = self._bucket(time)
+        entry = (time, event_type, next(self._seq), payload)
+        bucket = self._buckets.get(idx)
+        if bucket is None:
+            self._buckets[idx] = [entry]
+        else:
+            heapq.heappush(bucket, entry)
+        if self._cur is None or idx < self._cur:
+            self._cur = idx
+        self._size += 1
+
+    def push_sorted(self, events):
+        entries = self._entries(events)
+        for idx, group in itertools.groupby(entries,
+                                            lambda e: self._bucket(e[0])):
+            group = list(group)
+            bucket = self._buckets.get(idx)
+            if bucket is None:
+                self._buckets[idx] = group
+            else:
+                bucket.extend(group)
+                heapq.heapify(bucket)
+            if self._cur is None or idx < self._cur:
+                self._cur = idx
+            self._size += len(group)
+
+    def pop(self):
+        if not self._size:
+            return None
+        bucket = self._first_bucket()
+        time, event_type, seq, payload = heapq.heappop(bucket)
+        if not bucket:
+            del self._buckets[self._cur]
+        self._size -= 1
+        return time, event_type, payload
+
+    def peek_time(self):
+        if not self._size:
+            return None
+        return self._first_bucket()[0][0]
+
+    def __len__(self):
+        return self._size
+
+    def _pending_entries(self):
+        return [entry for bucket in self._buckets.itervalues() for entry in bucket]
+
+
+CALENDAR_TYPES = {
+    HEAP_CALENDAR : HeapCalendar,
+    CALENDAR_QUEUE : CalendarQueue
+}
+
+def make_calendar(calendar_type=HEAP_CALENDAR, **kwargs):
+    if calendar_type not in CALENDAR_TYPES:
+        raise ValueError('Unknown event calendar type %r' % calendar_type)
+    return CALENDAR_TYPES[calendar_type](**kwargs)
@@ -9,13 +9,22 @@ from scipy.stats import poisson
 import numpy
 import random
 from simulation_logic import SimulationLogic
+from random_streams import DEPARTURES, DESTINATIONS
+from model_tables import GammaTable, KeyedTable, flatten
+from trip_buffer import *
+from sim_clock import HOUR
 import datetime
 from dateutil import rrule
 from collections import defaultdict
-import bisect
+
+# Most departures of a station drawn at once, see _departure_block
+MAX_BLOCK = 256
 
 class ExponentialLogic(SimulationLogic):
 
+    SNAPSHOT_ATTRIBUTES = SimulationLogic.SNAPSHOT_ATTRIBUTES + ['station_draws']
+    MODEL_TYPES = ['exp_lambda', 'gamma', 'dest_distr']
+
     def __init__(self, session):
         SimulationLogic.__init__(self, session)
 
@@ -25,6 +34,14 @@ class ExponentialLogic(SimulationLogic):
         self.time_of_first_data = datetime.datetime(2010, 10, 01)
         self.time_of_last_data = datetime.datetime(2013, 07, 01)
 
+        self.ensure_models(start_time, end_time)
+        self.init_active_hours()
+
+        print "\tInitializing Trips"
+        self.initialize_trips()
+        self.moving_bikes = 0
+
+    def load_models(self, start_time, end_time):
         print "\tLoading Exp Distributions"
         self.exp_distrs = self.load_exp_lambdas(start_time, end_time)
         print "\tLoading gamma distributions"
@@ -32,126 +49,199 @@ class ExponentialLogic(SimulationLogic):
         print "\tLoading dest_distrs distributions"
         self.dest_distrs = self.load_dest_distrs(start_time, end_time)
 
-        print "\tInitializing Trips"
-        self.initialize_trips()
-        self.moving_bikes = 0
+    def model_arrays(self):
+        arrays = self.exp_distrs.arrays('exp_distrs')
+        arrays.update(self.duration_distrs.arrays('gammas'))
+        arrays.update(self.dest_distrs.arrays('dest_distrs'))
+        return arrays
+
+    def set_model_arrays(self, arrays):
+        self.exp_distrs = KeyedTable.from_arrays(arrays, 'exp_distrs')
+        self.duration_distrs = GammaTable.from_arrays(self.station_index, arrays, 'gammas')
+        self.dest_distrs = KeyedTable.from_arrays(arrays, 'dest_distrs')
 
     def update(self, timestep):
         '''Moves the simulation forward one timestep from given time'''
-        self.rebalance_stations(self.time)
         # Increment after we run for the current timestep?
-        self.time += timestep
+        self.now += int(timestep.total_seconds())
         self.resolve_trips()
 
+    def init_active_hours(self):
+        '''
+        Indexes the models by the run's hours: self.hour_rates holds the
+        [station index, hour] mean wait between departures (NaN where the
+        station has no ExpLambda), self.active_hours the sorted hours of
+        every station that have one.
+        '''
+        num_hours = len(self.clock.hour_table)
+        station_ids = self.station_index.ids.tolist()
+        self.hour_rates = numpy.empty((len(station_ids), num_hours))
+        self.hour_rates.fill(numpy.nan)
+        # Hours of every (year, month, is_week_day, hour) of the run
+        slots = defaultdict(list)
+        for h, (year, month, weekday, hour) in enumerate(self.clock.hour_table):
+            slots[(year, month, weekday < 5, hour)].append(h)
+        for (year, month, is_week_day, hour), hours in slots.iteritems():
+            for s_idx, s_id in enumerate(station_ids):
+                rates = self.exp_distrs.get((s_id, year, month, is_week_day, hour))
+                if rates and rates[0][0] > 0:
+                    self.hour_rates[s_idx, hours] = rates[0][0]
+        self.active_hours = [numpy.flatnonzero(~numpy.isnan(rates))
+                             for rates in self.hour_rates]
+        # Station index -> (hour, first draw, departure times), see _departure_block
+        self.departure_blocks = {}
+        # RandomStreams the blocks were drawn from
+        self.block_streams = None
+
     def initialize_trips(self):
-        hour = self.start_time.hour
-        day = self.start_time.day
+        # Number of trips generated so far at every station, keys its random draws
+        self.station_draws = numpy.zeros(len(self.station_index), dtype=numpy.int64)
         for s_id in self.stations.iterkeys():
-            new_trip = self.generate_trip(s_id, self.start_time)
-            self.pending_departures.put((new_trip.start_date, new_trip))
+            new_row = self.generate_trip(s_id, self.now)
+            if new_row is not None:
+                self.schedule_departure(new_row)
+
+    def _next_departure(self, s_idx, time):
+        '''
+        (start time, draw) of the next departure from s_idx after time, the
+        time of its previous one. Stations without an ExpLambda at time
+        sleep until their next active hour. None if there's none left.
+        '''
+        hour = self.clock.hour_index(time)
+        if hour >= self.hour_rates.shape[1]:
+            return None
+        if numpy.isnan(self.hour_rates[s_idx, hour]):
+            active_hours = self.active_hours[s_idx]
+            i = numpy.searchsorted(active_hours, hour)
+            if i == len(active_hours):
+                return None
+            time = self.clock.hour_start(time) + int(active_hours[i] - hour) * HOUR
+            hour = int(active_hours[i])
+        draw = int(self.station_draws[s_idx])
+        self.station_draws[s_idx] += 1
+        return self._departure_block(s_idx, time, hour, draw), draw
+
+    def _departure_block(self, s_idx, time, hour, draw):
+        '''
+        Start time of the draw-th departure from s_idx, following one at
+        time in hour. The waits of the departures left in the hour are
+        drawn as one block and their start times kept, the next ones are
+        read from the block while they follow on in the same hour. Draws
+        are keyed by their number, so blocks draw what one wait at a time
+        would.
+        '''
+        if self.block_streams is not self.random_streams:
+            # Drawn from other random numbers (restore, alter...)
+            self.departure_blocks = {}
+            self.block_streams = self.random_streams
+        block = self.departure_blocks.get(s_idx)
+        if block is not None:
+            block_hour, first_draw, times = block
+            i = draw - first_draw
+            if block_hour == hour and 0 < i < len(times) and times[i - 1] == time:
+                return int(times[i])
 
-    def generate_trip(self, s_id, time):
-        # Check weekday or weekend
-        idx = 0 if  time.weekday() < 5 else 1
-        exp_l = self.exp_distrs[s_id][time.year][time.month]\
-                               [time.weekday() < 5][time.hour] 
-
-        # Never generated a trip, defer it until we have a feasible lambda
-        # Test using if its greater than x hours too (possibly deal with bad latenight hours
-        if not exp_l:# or exp_l.rate > 3600 * 2:
-            # Test it out to see how this works
-            # Have it look again the next hour
-            return Trip('-1', "Casual", 2, time + datetime.timedelta(seconds=3601), 
-                        None, s_id, s_id)
-
-        # Returns time till next event in seconds
         # Function takes in 1/rate = "scale" but it works better the other way...
-        wait_time = numpy.random.exponential(exp_l.rate*(3./4))
-        #if wait_time > 3600:
-        #    return Trip('-1', "Casual", 2, time + datetime.timedelta(seconds=3601), 
-        #                None, s_id, s_id)
+        scale = self.hour_rates[s_idx, hour] * (3./4)
+        hour_end = self.clock.hour_start(time) + HOUR
+        size = min(int((hour_end - time) / scale) + 2, MAX_BLOCK)
+        # Draws of the n-th trip of every station are shared between scenarios
+        waits = self.random_streams.exponentials(DEPARTURES, scale,
+                                                 self.station_index.id_of(s_idx),
+                                                 numpy.arange(draw, draw + size))
+        times = time + numpy.cumsum(waits.astype(numpy.int64))
+        self.departure_blocks[s_idx] = (hour, draw, times)
+        return int(times[0])
+
+    def generate_trip(self, s_id, time):
+        '''
+        Adds the next trip leaving s_id after time (simulation seconds) to
+        self.trips, returns its row, or None if s_id has no departure left
+        in the run
+        '''
+        s_idx = self.station_index.index_of(s_id)
+        departure = self._next_departure(s_idx, time)
+        if departure is None:
+            return None
+        trip_start_time, draw = departure
 
-        trip_start_time = time + datetime.timedelta(seconds=wait_time)
         # It should go somewhere depending on when the hour of its start_time (could be far in the future)
-        end_station_id = self._get_destination(s_id, trip_start_time)
+        end_station_id = self._get_destination(s_id, trip_start_time, draw)
         if end_station_id not in self.stations:
             print "ERROR END_ID",end_station_id,"NOT IN STATIONS, FROM s_id",s_id
 
         #print "Desire",(s_id,end_station_id)
         gamma = self.duration_distrs.get((s_id, end_station_id), None)
         if gamma:
-            trip_duration = self.get_trip_duration(gamma)
+            trip_duration = self.get_trip_duration(gamma, s_id, end_station_id, draw)
             trip_end_time = trip_start_time + trip_duration
-
-            #TODO Add new TripType 
-            new_trip = data_model.Trip(str(random.randint(1,500)), 
-                "Casual", 2, trip_start_time, trip_end_time, s_id, end_station_id)
         else:
             #print "GAMMA ERROR:"
             #print "Generate a trip from ",s_id,"for",wait_time,"seconds in the future"
             #print "start station",s_id,"end station",end_station_id
             #TODO !!! What to do if we've never seen trips between two stations????
             trip_end_time = trip_start_time
-            new_trip = data_model.Trip(str(random.randint(1,500)), 
-                "Casual", 2, trip_start_time, trip_end_time, s_id, end_station_id)
             #raise Exception("Gamma doesn't exist")
-        return new_trip
+        return self.trips.append(s_idx, self.station_index.index_of(end_station_id),
+                                 trip_start_time, trip_end_time)
 
-    def _get_destination(self, s_id, time):
+    def _get_destination(self, s_id, time, draw):
         '''
-            Returns a destination station given dest_distrs
+            Returns a destination station given dest_distrs, draw is the
+            number of the trip at s_id
         '''
-        vectors = self.dest_distrs[s_id][time.year][time.month][time.weekday() < 5][time.hour]
-        if len(vectors) > 0:
+        year, month, weekday, hour = self.clock.hour_key(time)
+        vectors = self.dest_distrs.get((s_id, year, month, weekday < 5, hour))
+        if vectors:
             cum_prob_vector = vectors[0]
             station_vector = vectors[1]
 
             # http://docs.python.org/3/library/random.html (very bottom of page)
-            x = random.random() * cum_prob_vector[-1]
+            x = self.random_streams.uniform(DESTINATIONS, s_id, draw) * cum_prob_vector[-1]
         
-            return station_vector[bisect.bisect(cum_prob_vector, x)]
+            return int(station_vector[numpy.searchsorted(cum_prob_vector, x, side='right')])
         else:
             # Send it to one of 273 randomly
-            return random.choice(self.stations.keys())
+            return self.station_index.id_of(self.random_streams.integer(
+                    DESTINATIONS, len(self.station_index), s_id, draw))
 
 
     def load_gammas(self):
         '''
-        Caches gaussian distribution variables into a dictionary.
+        Caches gamma distribution variables into a GammaTable.
         '''
-        gamma_distr = self.session.query(data_model.Gamma)
-        distr_dict = {}
-        for gamma in gamma_distr:
-            distr_dict[(gamma.start_station_id, gamma.end_station_id)] = gamma 
-        return distr_dict
+        gammas = self.model_artifacts.get('gamma')
+        return GammaTable.from_columns(self.station_index, gammas['start_station_id'],
+                                       gammas['end_station_id'], gammas['shape'],
+                                       gammas['scale'])
 
     def load_exp_lambdas(self, start_time, end_time):
         '''
-        Caches exp lambdas into dictionary of 
-        s_id->year->month->[weekend, weekday]->hours
+        Caches exp lambdas into a KeyedTable of
+        (s_id, year, month, is_week_day, hour) -> [rate]
         '''
         # kind of gross but makes for easy housekeeping
         distr_dict = defaultdict(lambda: defaultdict(lambda: 
                         defaultdict(lambda: defaultdict(lambda: defaultdict(list)))))
 
-        distrs = self.session.query(data_model.ExpLambda)\
-                             .filter(ExpLambda.year >= start_time.year)\
-                             .filter(ExpLambda.month >= start_time.month)\
-                             .filter(ExpLambda.year <= end_time.year)\
-                             .filter(ExpLambda.month <= end_time.month)\
-                             .filter(ExpLambda.station_id.in_(self.stations.keys()))\
-                             .yield_per(5000)
-
         num_ds = 0 
-        for d in distrs:
-            distr_dict[d.station_id][d.year][d.month][d.is_week_day][d.hour] = d
-            num_ds += 1
+        for year in range(start_time.year, end_time.year + 1):
+            for month in range(start_time.month, end_time.month + 1):
+                distrs = self.model_artifacts.get('exp_lambda', (year, month, None))
+                in_stations = numpy.in1d(distrs['station_id'], self.station_index.ids)
+                for s_id, d_year, d_month, is_week_day, hour, rate in \
+                        zip(*[distrs[name][in_stations].tolist()
+                              for name in ['station_id', 'year', 'month', 'is_week_day',
+                                           'hour', 'rate']]):
+                    distr_dict[s_id][d_year][d_month][is_week_day][hour] = [rate]
+                    num_ds += 1
         print "Loaded %i distributions" % num_ds
-        return distr_dict
+        runs = {key:(rates,) for key, rates in flatten(distr_dict, 5).iteritems()}
+        return KeyedTable.from_dict(runs, 5, [numpy.float64])
 
     def load_dest_distrs(self, start_time, end_time):
         '''
-        Caches destination distributions into dictionary of day -> hour -> start_station_id -> [cumulative_distr, corresponding stations]
+        Caches destination distributions into a KeyedTable of (start_station_id, year, month, is_week_day, hour) -> [cumulative_distr, corresponding stations]
         # Change to a list of lists, faster, more space efficient
         '''
         time_diff = end_time - start_time 
@@ -186,33 +276,33 @@ class ExponentialLogic(SimulationLogic):
                 year = day.year
             print "Year", year
 
-            date_distrs = self.session.query(data_model.DestDistr) \
-               .filter(DestDistr.year == year)\
-               .filter(DestDistr.month == day.month-1)\
-               .filter(DestDistr.is_week_day == (dow < 5)) \
-               .filter(DestDistr.hour.between(start_hour, end_hour))\
-               .yield_per(10000)
+            # Months of destination distributions start at 0
+            distrs = self.model_artifacts.get('dest_distr', (year, day.month-1, dow < 5))
+            in_hours = (distrs['hour'] >= start_hour) & (distrs['hour'] <= end_hour)
+            date_distrs = zip(*[distrs[name][in_hours].tolist()
+                                for name in ['start_station_id', 'end_station_id', 'year',
+                                             'month', 'is_week_day', 'hour', 'prob']])
             print "Start hour, end hour",start_hour,end_hour
-            print date_distrs
+            print "Distrs", len(date_distrs)
 
             # TODO REMOVE count stuff
             count = 0
             s_count = 0
-            for distr in date_distrs:
+            for s_id, e_id, d_year, d_month, is_week_day, hour, prob in date_distrs:
                 count += 1
-                # Faster to do this than be smart about the db query
-                if distr.start_station_id in self.stations \
-                        and distr.end_station_id in self.stations:
+                # Faster to do this than be smart about the artifact
+                if s_id in self.stations \
+                        and e_id in self.stations:
                     s_count += 1
-                    result = distr_dict[distr.start_station_id][distr.year][distr.month+1][distr.is_week_day][distr.hour]
+                    result = distr_dict[s_id][d_year][d_month+1][is_week_day][hour]
 
                     # Unencountered  day, hour, start_station_id -> Create the list of lists containing distribution probability values and corresponding end station ids.
                     if len(result) == 0:
-                        distr_dict[distr.start_station_id][distr.year][distr.month+1][distr.is_week_day]\
-                                  [distr.hour] = [[distr.prob], [distr.end_station_id]]
+                        distr_dict[s_id][d_year][d_month+1][is_week_day]\
+                                  [hour] = [[prob], [e_id]]
                     else:
-                        result[0].append(distr.prob)
-                        result[1].append(distr.end_station_id)
+                        result[0].append(prob)
+                        result[1].append(e_id)
                     num_distrs += 1
 
             print "\t\tStarting reductions"
@@ -227,43 +317,39 @@ class ExponentialLogic(SimulationLogic):
                         cum_prob_vector = reduce(lambda a, x: a + [a[-1] + x], prob_vector[1:], [prob_vector[0]])
                         vectors[0] = cum_prob_vector
         print "Loaded %d distrs" % num_distrs
-        return distr_dict
+        runs = {key:vectors for key, vectors in flatten(distr_dict, 5).iteritems()
+                if len(vectors) == 2}
+        return KeyedTable.from_dict(runs, 5, [numpy.float64, numpy.int64])
 
 
 
 
-    def get_trip_duration(self, gamma):
-        '''
-        Samples from a gamma distribution and returns a timedelta representing
-        a trip length
-        '''
-        trip_length = numpy.random.gamma(gamma.shape, gamma.scale)
-        return datetime.timedelta(seconds=trip_length)
-
-    def resolve_departure(self, trip):
-        '''Decrement station count, put in pending_arrivals queue. If station is empty, put it in the disappointments list.'''
-        departure_station_ID = trip.start_station_id
+    def resolve_departure(self, row):
+        '''Decrement station count, schedule its arrival. If station is empty, log a disappointment.'''
+        trips = self.trips
+        s_idx = trips.start_station[row]
+        departure_station_ID = self.station_index.id_of(s_idx)
+        start_time = int(trips.start_time[row])
 
         # No bike to depart on, log a dissapointment
-        if self.station_counts[departure_station_ID] == 0:
-            new_disappointment = Disappointment(departure_station_ID, trip.start_date, trip_id=None, is_full=False)
-            self.session.add(new_disappointment)
-            self.disappointments.append(new_disappointment)
-            self.resolve_sad_departure(trip)
-
-        # Using trip_end_time=None to indicate that we should just generate another trip
-        # -> if it has an end_date then it's a normal trip
-        elif trip.end_date:
-            self.station_counts[departure_station_ID] -= 1
-            self.pending_arrivals.put((trip.end_date, trip))
+        if self.station_counts[s_idx] == 0:
+            trips.status[row] = TRIP_NO_BIKE
+            self.disappointment_log.append(s_idx, start_time, False, row)
+            self.resolve_sad_departure(row)
+
+        else:
+            trips.status[row] = TRIP_RIDING
+            self.station_counts[s_idx] -= 1
+            self.count_changed(s_idx)
+            self.schedule_arrival(row)
             # Perfect time to denote a now empty station
-            if self.station_counts[departure_station_ID] == 0\
-                   and not trip.start_station_id in self.unavailable_stations:
-                self.unavailable_stations.add(departure_station_ID)
-                self.empty_stations.put((trip.start_date, departure_station_ID))
+            if self.station_counts[s_idx] == 0\
+                   and not self.unavailable_stations[s_idx]:
+                self.mark_empty(s_idx, start_time)
 
-        new_trip = self.generate_trip(departure_station_ID, trip.start_date)
-        self.pending_departures.put((new_trip.start_date, new_trip))
+        new_row = self.generate_trip(departure_station_ID, start_time)
+        if new_row is not None:
+            self.schedule_departure(new_row)
 
     def clean_up(self):
         pass
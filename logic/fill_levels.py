@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+'''
+    fill_levels.py
+
+    Stations bucketed by spare capacity (capacity - bike count), so
+    rebalancing can walk the fullest stations first without sorting every
+    station. Moving a station to another bucket when its count changes is
+    O(1); capacities are small integers, so there are few buckets.
+'''
+
+
+class FillLevels:
+
+    def __init__(self, spare):
+        '''spare: array of the spare capacity of every station index'''
+        self.spare = spare.tolist()
+        # spare capacity -> set of station indexes
+        self.buckets = {}
+        for s_idx, s_spare in enumerate(self.spare):
+            self.buckets.setdefault(s_spare, set()).add(s_idx)
+
+    def update(self, s_idx, spare):
+        spare = int(spare)
+        old_spare = self.spare[s_idx]
+        if spare == old_spare:
+            return
+        bucket = self.buckets[old_spare]
+        bucket.discard(s_idx)
+        if not bucket:
+            del self.buckets[old_spare]
+        self.buckets.setdefault(spare, set()).add(s_idx)
+        self.spare[s_idx] = spare
+
+    def fullest(self):
+        '''
+        Yields station indexes by increasing spare capacity, ties by index,
+        in the order they had when called: stations updated while iterating
+        aren't yielded twice.
+        '''
+        seen = set()
+        for spare in sorted(self.buckets):
+            for s_idx in sorted(self.buckets.get(spare, ())):
+                if s_idx not in seen:
+                    seen.add(s_idx)
+                    yield s_idx
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+'''
+    lambda_store.py
+
+    Compact storage of the pairwise Poisson lambdas used by PoissonLogic.
+    Every (year, month, is_week_day, hour) slice is one sparse CSR matrix
+    indexed by [start station index, end station index] holding float32
+    values. Pairs without a lambda are simply not stored.
+'''
+import bisect
+import numpy
+from scipy import sparse
+
+
+class LambdaStore:
+
+    def __init__(self, station_index):
+        self.station_index = station_index
+        # (year, month, is_week_day, hour) -> csr_matrix
+        self.slices = {}
+        # Same slices as lists, built on demand for single lookups
+        self._lookup_arrays = LookupArrays(self.slices)
+
+    def __len__(self):
+        '''Number of stored (non-zero) lambdas'''
+        return sum(m.nnz for m in self.slices.itervalues())
+
+    def add(self, rows):
+        '''
+        rows: iterable of (year, month, is_week_day, hour, start id, end id, value).
+        Rows of stations that aren't indexed are dropped. A slice that was
+        already stored is replaced.
+        '''
+        columns = zip(*rows)
+        if columns:
+            self.add_columns(*[numpy.array(column) for column in columns])
+
+    def add_columns(self, years, months, is_week_days, hours, start_ids, end_ids, values):
+        '''Vectorized add, from parallel arrays of the rows' fields'''
+        ids = self.station_index.ids
+        indexed = numpy.in1d(start_ids, ids) & numpy.in1d(end_ids, ids)
+        years, months, hours = years[indexed], months[indexed], hours[indexed]
+        is_week_days = numpy.asarray(is_week_days[indexed], dtype=bool)
+        starts = self.station_index.indexes_of(start_ids[indexed])
+        ends = self.station_index.indexes_of(end_ids[indexed])
+        values = numpy.asarray(values[indexed], dtype=numpy.float32)
+        if not len(values):
+            return
+
+        # Group the rows by slice
+        order = numpy.lexsort((hours, is_week_days, months, years))
+        keys = numpy.column_stack((years, months, is_week_days, hours))[order]
+        group_starts = numpy.flatnonzero(numpy.r_[True, (keys[1:] != keys[:-1]).any(axis=1)])
+        group_ends = numpy.r_[group_starts[1:], len(order)]
+
+        num_stations = len(self.station_index)
+        for first, last in zip(group_starts.tolist(), group_ends.tolist()):
+            year, month, is_week_day, hour = keys[first].tolist()
+            rows = order[first:last]
+            matrix = sparse.csr_matrix((values[rows], (starts[rows], ends[rows])),
+                                       shape=(num_stations, num_stations))
+            matrix.sort_indices()
+            key = (year, month, bool(is_week_day), hour)
+            self.slices[key] = matrix
+            self._lookup_arrays.pop(key, None)
+
+    def get(self, year, month, is_week_day, hour):
+        '''The CSR matrix of a slice, None if nothing was loaded for it'''
+        return self.slices.get((year, month, bool(is_week_day), hour))
+
+    def lookup(self, year, month, is_week_day, hour, s_idx, e_idx):
+        '''
+        Lambda value between two station indexes, or None as we only
+        store non-zero lambdas.
+        '''
+        arrays = self._lookup_arrays.get((year, month, bool(is_week_day), hour))
+        if arrays is None:
+            return None
+        indptr, indices, data = arrays
+        # Rows are short, a bisect on plain lists beats numpy call overhead
+        lo, hi = indptr[s_idx], indptr[s_idx + 1]
+        pos = bisect.bisect_left(indices, e_idx, lo, hi)
+        if pos < hi and indices[pos] == e_idx:
+            return data[pos]
+        return None
+
+    def slice_keys(self, month, is_week_day, hour):
+        '''Keys of the stored slices of the given month/day type/hour in any year'''
+        return [key for key in self.slices
+                if key[1:] == (month, bool(is_week_day), hour)]
+
+    def arrays(self, prefix):
+        '''
+        The slices flattened into a few arrays (see SharedModels): their
+        keys, their indptr with one row per slice, and their indices and
+        data one after another.
+        '''
+        keys = sorted(self.slices)
+        matrices = [self.slices[key] for key in keys]
+        num_stations = len(self.station_index)
+        offsets = numpy.zeros(len(keys) + 1, dtype=numpy.int64)
+        offsets[1:] = numpy.cumsum([m.nnz for m in matrices])
+        empty = numpy.zeros(0)
+        return {prefix + '_keys':numpy.array(keys, dtype=numpy.int64).reshape(len(keys), 4),
+                prefix + '_offsets':offsets,
+                prefix + '_indptr':numpy.array([m.indptr for m in matrices],
+                                               dtype=numpy.int32).reshape(len(keys), num_stations + 1),
+                prefix + '_indices':numpy.concatenate([m.indices for m in matrices] + [empty])
+                                        .astype(numpy.int32),
+                prefix + '_data':numpy.concatenate([m.data for m in matrices] + [empty])
+                                     .astype(numpy.float32)}
+
+    @classmethod
+    def from_arrays(cls, station_index, arrays, prefix):
+        '''The store of arrays, its matrices are views of them'''
+        store = cls(station_index)
+        offsets = arrays[prefix + '_offsets'].tolist()
+        indptr = arrays[prefix + '_indptr']
+        indices = arrays[prefix + '_indices']
+        data = arrays[prefix + '_data']
+        num_stations = len(station_index)
+        for i, (year, month, is_week_day, hour) in enumerate(arrays[prefix + '_keys'].tolist()):
+            first, last = offsets[i], offsets[i + 1]
+            store.slices[(year, month, bool(is_week_day), hour)] = sparse.csr_matrix(
+                    (data[first:last], indices[first:last], indptr[i]),
+                    shape=(num_stations, num_stations), copy=False)
+        return store
+
+    def nbytes(self):
+        '''Memory held by the matrices' arrays'''
+        return sum(m.data.nbytes + m.indices.nbytes + m.indptr.nbytes
+                   for m in self.slices.itervalues())
+
+
+class LookupArrays(dict):
+    '''
+    Lazily converts a slice's CSR arrays to lists the first time a single
+    value is looked up in it.
+    '''
+
+    def __init__(self, slices):
+        dict.__init__(self)
+        self.slices = slices
+
+    def __missing__(self, key):
+        matrix = self.slices.get(key)
+        if matrix is None:
+            return None
+        arrays = (matrix.indptr.tolist(), matrix.indices.tolist(), matrix.data.tolist())
+        self[key] = arrays
+        return arrays
+
+    def get(self, key):
+        return self[key]
+
+
+def nonzero_pairs(matrix):
+    '''
+    Returns parallel arrays (start indexes, end indexes, values) of the
+    non-zero entries of a CSR matrix.
+    '''
+    starts = numpy.repeat(numpy.arange(matrix.shape[0]), numpy.diff(matrix.indptr))
+    return starts, matrix.indices, matrix.data
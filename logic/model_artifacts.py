@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+'''
+    model_artifacts.py
+
+    Local cache of the trained model tables (lambdas, gammas, destination
+    distributions...) compiled into binary artifacts. An artifact holds the
+    rows of one model type in one calendar slice as a directory of .npy
+    column files, memory-mapped when loaded, so the logics read a slice in
+    milliseconds instead of fetching it row by row through the ORM.
+
+    Artifacts are keyed by model type, training version and calendar slice.
+    The training version is the number of times the trainers invalidated
+    the model type, plus the largest id in its table: trainers rewrite
+    tables by deleting and inserting rows, which always raises it, so stale
+    artifacts are never read even if invalidate wasn't called.
+
+    The cache is bounded in size; least recently used artifacts are
+    evicted first. Usage:
+
+        python -m logic.model_artifacts <compile|invalidate> [model types]
+'''
+from models import *
+from collections import namedtuple
+from sqlalchemy import Boolean, Integer
+from sqlalchemy.sql import func
+import json
+import numpy
+import os
+import shutil
+import sys
+import tempfile
+
+# Bumped when the layout of artifacts changes
+ARTIFACT_FORMAT = 1
+ARTIFACT_DIR = os.environ.get('SIMBA_ARTIFACT_DIR',
+                              os.path.join(os.path.expanduser('~'), '.simba', 'artifacts'))
+# Size bound of the cache
+MAX_BYTES = 2 * 1024**3
+VERSIONS_FILE = 'versions.json'
+# Artifacts being written, see ModelArtifacts._compile
+COMPILING_PREFIX = '.compiling-'
+
+# model type -> (table, columns stored in artifacts, columns a calendar
+# slice filters on)
+MODEL_TYPES = {
+    'lambda' : (Lambda, ['start_station_id', 'end_station_id', 'year', 'month',
+                         'is_week_day', 'hour', 'value'],
+                ['year', 'month', 'is_week_day']),
+    'exp_lambda' : (ExpLambda, ['station_id', 'year', 'month', 'is_week_day',
+                                'hour', 'rate'],
+                    ['year', 'month', 'is_week_day']),
+    'dest_distr' : (DestDistr, ['start_station_id', 'end_station_id', 'year',
+                                'month', 'is_week_day', 'hour', 'prob'],
+                    ['year', 'month', 'is_week_day']),
+    'gamma' : (Gamma, ['start_station_id', 'end_station_id', 'shape', 'scale'], [])
+}
+
+# Light stand-ins for the ORM rows the logics keep
+GammaParams = namedtuple('GammaParams', ['shape', 'scale'])
+ExpRate = namedtuple('ExpRate', ['rate'])
+
+
+class ModelArtifacts:
+
+    def __init__(self, session, cache_dir=ARTIFACT_DIR, max_bytes=MAX_BYTES):
+        self.session = session
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def get(self, model_type, calendar_slice=()):
+        '''
+        Columns (name -> read-only array) of the rows of model_type in
+        calendar_slice, compiling the artifact from the DB if it isn't
+        cached yet. calendar_slice has one value per slice column of the
+        model type, None leaves that column unfiltered.
+        '''
+        table, columns, slice_columns = MODEL_TYPES[model_type]
+        path = self._path(model_type, calendar_slice)
+        if os.path.isdir(path):
+            # Marks it as recently used
+            os.utime(path, None)
+        else:
+            self._compile(model_type, calendar_slice, path)
+            self._evict(keep=path)
+        return {name:_load_column(os.path.join(path, name + '.npy'))
+                for name in columns}
+
+    def training_version(self, model_type):
+        table = MODEL_TYPES[model_type][0]
+        max_id = self.session.query(func.max(table.id)).scalar() or 0
+        return read_versions(self.cache_dir).get(model_type, 0), max_id
+
+    def _path(self, model_type, calendar_slice):
+        slice_columns = MODEL_TYPES[model_type][2]
+        if len(calendar_slice) != len(slice_columns):
+            raise ValueError('%s slices are (%s)' % (model_type, ', '.join(slice_columns)))
+        version = 'f%d-v%d-%d' % ((ARTIFACT_FORMAT,) + self.training_version(model_type))
+        slice_name = '-'.join('%s%s' % (column, 'all' if value is None else int(value))
+                              for column, value in zip(slice_columns, calendar_slice))
+        return os.path.join(self.cache_dir, model_type, version, slice_name or 'all')
+
+    def _compile(self, model_type, calendar_slice, path):
+        '''Fetches the slice's rows as plain columns and writes them to path'''
+        table, columns, slice_columns = MODEL_TYPES[model_type]
+        query = self.session.query(*[getattr(table, name) for name in columns])
+        for name, value in zip(slice_columns, calendar_slice):
+            if value is not None:
+                query = query.filter(getattr(table, name) == value)
+        rows = query.all()
+        values = zip(*rows) if rows else [()] * len(columns)
+
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent):
+            try:
+                os.makedirs(parent)
+            except OSError:
+                # Made by a concurrent worker
+                pass
+        # Written aside then renamed, readers never see half an artifact
+        temp_path = tempfile.mkdtemp(prefix=COMPILING_PREFIX, dir=parent)
+        for name, column in zip(columns, values):
+            numpy.save(os.path.join(temp_path, name + '.npy'),
+                       numpy.array(column, dtype=_column_dtype(getattr(table, name))))
+        try:
+            os.rename(temp_path, path)
+        except OSError:
+            # Compiled by a concurrent worker in the meantime
+            shutil.rmtree(temp_path, ignore_errors=True)
+
+    def _evict(self, keep=None):
+        '''Removes least recently used artifacts until the cache fits max_bytes'''
+        artifacts = []
+        total = 0
+        for model_type in MODEL_TYPES:
+            type_dir = os.path.join(self.cache_dir, model_type)
+            if not os.path.isdir(type_dir):
+                continue
+            for version in os.listdir(type_dir):
+                version_dir = os.path.join(type_dir, version)
+                for slice_name in os.listdir(version_dir):
+                    if slice_name.startswith(COMPILING_PREFIX):
+                        continue
+                    path = os.path.join(version_dir, slice_name)
+                    size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+                    artifacts.append((os.path.getmtime(path), path, size))
+                    total += size
+        for used, path, size in sorted(artifacts):
+            if total <= self.max_bytes:
+                break
+            if path != keep:
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+
+
+def _column_dtype(column):
+    if isinstance(column.type, Boolean):
+        return bool
+    if isinstance(column.type, Integer):
+        return numpy.int32
+    return numpy.float64
+
+def _load_column(file_name):
+    try:
+        return numpy.load(file_name, mmap_mode='r')
+    except ValueError:
+        # Empty arrays can't be memory-mapped
+        return numpy.load(file_name)
+
+def read_versions(cache_dir=ARTIFACT_DIR):
+    '''model type -> number of times it was invalidated'''
+    try:
+        with open(os.path.join(cache_dir, VERSIONS_FILE)) as f:
+            return json.load(f)
+    except IOError:
+        return {}
+
+def model_version(session, cache_dir=ARTIFACT_DIR):
+    '''
+    Training version of every model type (see ModelArtifacts), as one
+    string: changes whenever any model is retrained.
+    '''
+    artifacts = ModelArtifacts(session, cache_dir)
+    return ' '.join('%s-v%d-%d' % ((model_type,) + artifacts.training_version(model_type))
+                    for model_type in sorted(MODEL_TYPES))
+
+def invalidate(model_type, cache_dir=ARTIFACT_DIR):
+    '''
+    To call after rewriting the table of model_type: bumps its training
+    version and removes its artifacts.
+    '''
+    if model_type not in MODEL_TYPES:
+        raise ValueError('Unknown model type %r' % model_type)
+    versions = read_versions(cache_dir)
+    versions[model_type] = versions.get(model_type, 0) + 1
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    temp_name = os.path.join(cache_dir, VERSIONS_FILE + '.tmp')
+    with open(temp_name, 'w') as f:
+        json.dump(versions, f)
+    os.rename(temp_name, os.path.join(cache_dir, VERSIONS_FILE))
+    shutil.rmtree(os.path.join(cache_dir, model_type), ignore_errors=True)
+
+def compile_all(session, model_type, cache_dir=ARTIFACT_DIR):
+    '''Compiles the artifact of every calendar slice in the table of model_type'''
+    table, columns, slice_columns = MODEL_TYPES[model_type]
+    artifacts = ModelArtifacts(session, cache_dir)
+    if slice_columns:
+        calendar_slices = session.query(*[getattr(table, name) for name in slice_columns])\
+                                 .distinct().all()
+    else:
+        calendar_slices = [()]
+    for calendar_slice in calendar_slices:
+        artifacts.get(model_type, tuple(calendar_slice))
+    print "Compiled %d %s artifacts" % (len(calendar_slices), model_type)
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in ('compile', 'invalidate'):
+        sys.exit("Usage: python -m logic.model_artifacts <compile|invalidate> [%s]"
+                 % "|".join(sorted(MODEL_TYPES)))
+    model_types = sys.argv[2:] or sorted(MODEL_TYPES)
+    if sys.argv[1] == 'invalidate':
+        for model_type in model_types:
+            invalidate(model_type)
+        return
+
+    from utils import Connector
+    session = Connector().getDBSession()
+    for model_type in model_types:
+        compile_all(session, model_type)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+'''
+    model_tables.py
+
+    Read-only model tables flattened into a few numpy arrays, so they can
+    be shared between worker processes without copies (see SharedModels):
+    - GammaTable: trip duration gammas of every station pair, dense over
+      station indexes
+    - KeyedTable: runs of rows of parallel columns looked up by integer
+      key tuples, e.g. destination distributions by (station, year, month,
+      is_week_day, hour)
+'''
+import numpy
+
+from model_artifacts import GammaParams
+
+
+class GammaTable:
+
+    def __init__(self, station_index, shapes, scales, has_gamma):
+        self.station_index = station_index
+        # [start index, end index] arrays
+        self.shapes = shapes
+        self.scales = scales
+        self.has_gamma = has_gamma
+
+    @classmethod
+    def from_columns(cls, station_index, start_ids, end_ids, shapes, scales):
+        '''Gammas of the rows whose stations are both indexed'''
+        ids = station_index.ids
+        indexed = numpy.in1d(start_ids, ids) & numpy.in1d(end_ids, ids)
+        starts = station_index.indexes_of(start_ids[indexed])
+        ends = station_index.indexes_of(end_ids[indexed])
+        num_stations = len(station_index)
+        table = cls(station_index, numpy.zeros((num_stations, num_stations)),
+                    numpy.zeros((num_stations, num_stations)),
+                    numpy.zeros((num_stations, num_stations), dtype=bool))
+        table.shapes[starts, ends] = shapes[indexed]
+        table.scales[starts, ends] = scales[indexed]
+        table.has_gamma[starts, ends] = True
+        return table
+
+    def get(self, pair, default=None):
+        '''GammaParams of a (start id, end id) pair, like a dict'''
+        s_id, e_id = pair
+        index = self.station_index.index
+        if s_id not in index or e_id not in index:
+            return default
+        s_idx, e_idx = index[s_id], index[e_id]
+        if not self.has_gamma[s_idx, e_idx]:
+            return default
+        return GammaParams(float(self.shapes[s_idx, e_idx]),
+                           float(self.scales[s_idx, e_idx]))
+
+    def arrays(self, prefix):
+        return {prefix + '_shapes':self.shapes, prefix + '_scales':self.scales,
+                prefix + '_has_gamma':self.has_gamma}
+
+    @classmethod
+    def from_arrays(cls, station_index, arrays, prefix):
+        return cls(station_index, arrays[prefix + '_shapes'], arrays[prefix + '_scales'],
+                   arrays[prefix + '_has_gamma'])
+
+
+class KeyedTable:
+
+    def __init__(self, keys, offsets, columns):
+        # Key tuple of every run, one per row
+        self.keys = keys
+        # Rows of run i are offsets[i]:offsets[i + 1] of every column
+        self.offsets = offsets
+        self.columns = columns
+        self._runs = {key:i for i, key in enumerate(map(tuple, keys.tolist()))}
+
+    def __len__(self):
+        return len(self._runs)
+
+    @classmethod
+    def from_dict(cls, runs, key_length, dtypes):
+        '''
+        runs: {key tuple : [values of every column]}, all the columns of a
+        run having the same length. dtypes: dtype of every column.
+        '''
+        keys = sorted(runs)
+        lengths = [len(runs[key][0]) for key in keys]
+        offsets = numpy.zeros(len(keys) + 1, dtype=numpy.int64)
+        offsets[1:] = numpy.cumsum(lengths)
+        columns = []
+        for i, dtype in enumerate(dtypes):
+            column = numpy.zeros(offsets[-1], dtype=dtype)
+            for key, first, last in zip(keys, offsets[:-1].tolist(), offsets[1:].tolist()):
+                column[first:last] = runs[key][i]
+            columns.append(column)
+        return cls(numpy.array(keys, dtype=numpy.int64).reshape(len(keys), key_length),
+                   offsets, columns)
+
+    def get(self, key, default=None):
+        '''Views of the run of key in every column'''
+        i = self._runs.get(key)
+        if i is None:
+            return default
+        first, last = self.offsets[i], self.offsets[i + 1]
+        return [column[first:last] for column in self.columns]
+
+    def arrays(self, prefix):
+        arrays = {prefix + '_keys':self.keys, prefix + '_offsets':self.offsets}
+        for i, column in enumerate(self.columns):
+            arrays['%s_column%d' % (prefix, i)] = column
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix):
+        num_columns = len([name for name in arrays if name.startswith(prefix + '_column')])
+        return cls(arrays[prefix + '_keys'], arrays[prefix + '_offsets'],
+                   [arrays['%s_column%d' % (prefix, i)] for i in range(num_columns)])
+
+
+def flatten(nested, depth):
+    '''{a : {b : value}} -> {(a, b) : value} for dicts nested depth deep'''
+    if depth == 1:
+        return {(key,):value for key, value in nested.iteritems()}
+    return {(key,) + sub_key:value for key, sub in nested.iteritems()
+            for sub_key, value in flatten(sub, depth - 1).iteritems()}
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+'''
+    nearest_stations.py
+
+    Where trips that find their end station full are rerouted to: the
+    station_distances table is loaded once into a dense distance matrix,
+    from which every run takes the k nearest stations of each of its
+    stations, closest first, restricted to the stations of the run.
+'''
+from models import StationDistance
+import numpy
+
+from station_index import StationIndex
+
+
+class StationDistances:
+
+    def __init__(self, station_index, distances):
+        # Every station in station_distances
+        self.station_index = station_index
+        # [station1 index, station2 index] distance, inf if unknown
+        self.distances = distances
+
+    @classmethod
+    def load(cls, session):
+        '''Loads the whole station_distances table in one query'''
+        rows = session.query(StationDistance.station1_id, StationDistance.station2_id,
+                             StationDistance.distance).all()
+        station1_ids, station2_ids, distances = zip(*rows) if rows else ([], [], [])
+        station_index = StationIndex(set(station1_ids) | set(station2_ids))
+        matrix = numpy.empty((len(station_index), len(station_index)))
+        matrix.fill(numpy.inf)
+        matrix[station_index.indexes_of(station1_ids),
+               station_index.indexes_of(station2_ids)] = distances
+        return cls(station_index, matrix)
+
+    def between(self, station_index):
+        '''Distance matrix of the stations of station_index, in its indexes'''
+        num_stations = len(station_index)
+        matrix = numpy.empty((num_stations, num_stations))
+        matrix.fill(numpy.inf)
+        known = numpy.array([s_id in self.station_index
+                             for s_id in station_index.ids.tolist()], dtype=bool)
+        idx = numpy.flatnonzero(known)
+        own_idx = self.station_index.indexes_of(station_index.ids[known])
+        matrix[numpy.ix_(idx, idx)] = self.distances[numpy.ix_(own_idx, own_idx)]
+        return matrix
+
+    def nearest(self, station_index, k):
+        '''
+        For every station of station_index, the indexes of its k nearest
+        stations of station_index, closest first. Stations without k known
+        distances get fewer.
+        '''
+        distances = self.between(station_index)
+        numpy.fill_diagonal(distances, numpy.inf)
+        num_stations = len(station_index)
+        k = min(k, max(num_stations - 1, 0))
+        if k == 0:
+            return [[] for i in xrange(num_stations)]
+        # Only the k nearest of every row get sorted
+        candidates = numpy.argpartition(distances, k - 1, axis=1)[:, :k]
+        rows = numpy.arange(num_stations)[:, numpy.newaxis]
+        order = numpy.lexsort((candidates, distances[rows, candidates]))
+        candidates = candidates[rows, order]
+        known = numpy.isfinite(distances[rows, candidates])
+        return [row[row_known].tolist() for row, row_known in zip(candidates, known)]
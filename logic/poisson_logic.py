@@ -7,15 +7,17 @@
 '''
 from utils import Connector
 from models import *
-from scipy.stats import poisson
 from scipy import stats
 import numpy
 import random
 from simulation_logic import SimulationLogic
+from random_streams import DEPARTURES
+from lambda_store import LambdaStore, nonzero_pairs
+from model_tables import GammaTable
 import datetime
 from dateutil import rrule
-from collections import defaultdict
 import math
+from scipy import sparse
 from sqlalchemy.sql import func,label
 from dateutil.relativedelta import relativedelta
 
@@ -42,6 +44,7 @@ OLD = 9
 
 class PoissonLogic(SimulationLogic):
 
+    MODEL_TYPES = ['lambda', 'gamma']
 
     def __init__(self, session):
         SimulationLogic.__init__(self, session)
@@ -52,11 +55,8 @@ class PoissonLogic(SimulationLogic):
         #TODO: Don't just hard-code the last day of data
         self.time_of_first_data = datetime.datetime(2010, 10, 01)
         self.time_of_last_data = datetime.datetime(2013, 07, 01)
-        print "Starting to load lambdas"
-        self.lambda_distrs = self.load_lambdas(start_time, end_time)
-        print "Loaded Lambdas"
-        self.duration_distrs = self.load_gammas()
-        print "Loaded Gammas"
+        self.last_data_second = self.clock.seconds(self.time_of_last_data)
+        self.ensure_models(start_time, end_time)
         self.moving_bikes = 0
         if end_time > self.time_of_last_data:
             self.regression_type = JEFFLINEAR
@@ -65,6 +65,24 @@ class PoissonLogic(SimulationLogic):
             self.monthly_intercept = regression_data[1]
 
 
+    def load_models(self, start_time, end_time):
+        print "Starting to load lambdas"
+        self.lambda_distrs = self.load_lambdas(start_time, end_time)
+        print "Loaded Lambdas"
+        self.duration_distrs = self.load_gammas()
+        self.gamma_shapes, self.gamma_scales, self.has_gamma = self.get_gamma_arrays()
+        print "Loaded Gammas"
+
+    def model_arrays(self):
+        arrays = self.lambda_distrs.arrays('lambdas')
+        arrays.update(self.duration_distrs.arrays('gammas'))
+        return arrays
+
+    def set_model_arrays(self, arrays):
+        self.lambda_distrs = LambdaStore.from_arrays(self.station_index, arrays, 'lambdas')
+        self.duration_distrs = GammaTable.from_arrays(self.station_index, arrays, 'gammas')
+        self.gamma_shapes, self.gamma_scales, self.has_gamma = self.get_gamma_arrays()
+
     def init_regression(self):
         if self.regression_type == LINEAR or self.regression_type == LINEARLASTYEAR:
             return self.init_regression_LINEAR_hardcoded()
@@ -209,91 +227,106 @@ class PoissonLogic(SimulationLogic):
 
     def update(self, timestep):
         '''Moves the simulation forward one timestep from given time'''
-        #print "Num bikes at stations", sum([x for x in self.station_counts.itervalues()])
-        #print "Num bikes in transit", self.pending_arrivals.qsize()
+        #print "Num bikes at stations", self.station_counts.sum()
+        #print "Num bikes in transit", len(self.event_calendar)
         #print "Moving bikes", self.moving_bikes
-        #print "Total?", sum([x for x in self.station_counts.itervalues()]) + self.pending_arrivals.qsize() + self.moving_bikes
-        #print "Stations with more count than cap? ", len([s_id for s_id, count in self.station_counts.iteritems() if count > self._get_station_cap(s_id)])
-        #print [(count, self._get_station_cap(s_id)) for s_id, count in self.station_counts.iteritems()]
+        #print "Total?", self.station_counts.sum() + len(self.event_calendar) + self.moving_bikes
+        #print "Stations with more count than cap? ", (self.station_counts > self.station_caps).sum()
+        #print zip(self.station_counts, self.station_caps)
 
-        """
-        x = len(self.unavailable_stations)
-        if x > 0:
-            print "BEFORE: Num unavailable", x
-            """
-        self.rebalance_stations(self.time)
-        """
-        if x > 0:
-            print "AFTER: Num unavailable", len(self.unavailable_stations)
-            """
-        self.generate_new_trips(self.time)
-        self.time+=timestep
+        self.generate_new_trips(self.now)
+        self.now += int(timestep.total_seconds())
         self.resolve_trips()
 
 
     def generate_new_trips(self, start_time):
+        '''
+        Draws the number of trips of every station pair with a non-zero lambda
+        in one Poisson call and schedules all of them as a single batch.
+        '''
         # Note that Monday is day 0 and Sunday is day 6. Is this the same for data_model?
-#        self.print_lambda_dict()
-        station_count = 0
-        for start_station_id in self.station_counts:
-            station_count += 1
-            for end_station_id in self.station_counts:
-                # Check if predicting a future date 
-                if start_time > self.time_of_last_data:
-                    lam = self.predict_future_lambda(start_time, start_station_id, end_station_id)
-                else:    
-                    lam = self.get_lambda(start_time.year, start_time.month,
-                                          start_time.weekday(), start_time.hour,
-                                          start_station_id, end_station_id)
-                gamma = self.duration_distrs.get((start_station_id, end_station_id), None)
-                # Check for invalid queries
-                if lam and gamma:
-                    num_trips = self.get_num_trips(lam)
- #                   print "lambda =", lam, " & ", num_trips, "trips during", start_time
-                    for i in range(num_trips):
-                        # Starting time of the trip is randomly chosen within the Lambda's time range, which is hard-coded to be an hour.
-                        added_time = datetime.timedelta(minutes=random.randint(0, 59), seconds=random.randint(0, 59))
-                        trip_start_time = start_time + added_time
-                        trip_duration = self.get_trip_duration(gamma)
-                        trip_end_time = trip_start_time + trip_duration
-                        new_trip = Trip(str(random.randint(1,500)), "Casual", 2, \
-                                trip_start_time, trip_end_time, start_station_id, end_station_id)
-                        self.pending_departures.put((trip_start_time, new_trip))
-
-
-    def predict_future_lambda(self, start_time, start_station_id, end_station_id):
+        lambdas = self.get_hour_lambdas(start_time)
+        if lambdas is None:
+            return
+        start_idx, end_idx, lam_values = nonzero_pairs(lambdas)
+
+        # Check for invalid queries
+        valid = (lam_values > 0) & self.has_gamma[start_idx, end_idx]
+        start_idx = start_idx[valid]
+        end_idx = end_idx[valid]
+
+        # Trip counts are drawn per station pair and hour
+        keys = (self.station_index.ids_of(start_idx), self.station_index.ids_of(end_idx),
+                self.clock.origin + start_time)
+        # when using all data (training + testing)
+        # num_trips = self.random_streams.poissons(DEPARTURES, lam_values[valid], *keys)
+        # when using only training data
+        num_trips = self.random_streams.poissons(DEPARTURES, lam_values[valid] * (4./3), *keys)
+
+        # Starting time of the trip is randomly chosen within the Lambda's time range, which is hard-coded to be an hour.
+        start_idx = numpy.repeat(start_idx, num_trips)
+        end_idx = numpy.repeat(end_idx, num_trips)
+        self.schedule_trip_batch(start_time, start_idx, end_idx,
+                                 self.gamma_shapes[start_idx, end_idx],
+                                 self.gamma_scales[start_idx, end_idx])
+
+    def get_hour_lambdas(self, start_time):
+        '''
+        Returns the sparse matrix of lambdas between station indexes during
+        the hour of start_time (simulation seconds), None if there are none.
+        '''
+        # Check if predicting a future date
+        if start_time > self.last_data_second:
+            return self.predict_future_lambdas(self.clock.to_datetime(start_time))
+        year, month, weekday, hour = self.clock.hour_key(start_time)
+        return self.lambda_distrs.get(year, month, weekday < 5, hour)
+
+
+    def predict_future_lambdas(self, start_time):
+        '''
+        Predicts the sparse matrix of lambdas of a future hour from the
+        lambdas of the same hour in the years we have data for.
+        '''
         month = start_time.month
+        is_week_day = start_time.weekday() < 5
         if self.regression_type == JEFFLOG or self.regression_type == JEFFLINEAR:
             slope = self.monthly_slope[0]
             intercept = self.monthly_intercept[0]
         else:
             slope = self.monthly_slope[month-1]
             intercept = self.monthly_intercept[month-1]
-        lam_prediction = 0
+
         if self.regression_type == LASTYEAR or self.regression_type == LOGLASTYEAR or self.regression_type == LINEARLASTYEAR:
-            lam_prediction = self.predict_from_last_year(start_time, start_station_id, end_station_id)
+            lam_prediction = self.predict_from_last_year(start_time, slope, intercept)
         elif self.regression_type == OLD:
-            lam_prediction = self.old_predict(start_time, start_station_id, end_station_id)
+            lam_prediction = self.old_predict_matrix(start_time)
         else:
+            # Predictions are linear in the previous year's lambda, so whole
+            # slices can be scaled at once. Missing lambdas count as 0.
+            lam_prediction = None
             for prev_year in self.get_year_range_of_data(month):
-                prev_year_lambda = self.get_lambda(prev_year, month, start_time.weekday(), start_time.hour, start_station_id, end_station_id) 
-                if not prev_year_lambda: continue
-                lam_prediction += self.predict_from_one_year(prev_year, prev_year_lambda, slope, intercept, start_time)
-            lam_prediction /= len(self.get_year_range_of_data(month))
-
-        if lam_prediction <= 0:
+                prev_year_lambdas = self.lambda_distrs.get(prev_year, month, is_week_day, start_time.hour)
+                if prev_year_lambdas is None: continue
+                prediction = self.predict_from_one_year(prev_year, prev_year_lambdas, slope, intercept, start_time)
+                lam_prediction = prediction if lam_prediction is None else lam_prediction + prediction
+            if lam_prediction is not None:
+                lam_prediction = lam_prediction / len(self.get_year_range_of_data(month))
+
+        if lam_prediction is None:
             return None
-        return Lambda(start_station_id, end_station_id, start_time.hour, start_time.weekday()<5, start_time.year, month, lam_prediction)
+        # Only keep positive predictions
+        lam_prediction = lam_prediction.tocsr()
+        lam_prediction.data[lam_prediction.data < 0] = 0
+        lam_prediction.eliminate_zeros()
+        return lam_prediction
 
 
-    def predict_from_last_year(self, start_time, start_station_id, end_station_id):
+    def predict_from_last_year(self, start_time, slope, intercept):
         year = 2013 if start_time.month <= 6 else 2012
-        lam = self.get_lambda(year, start_time.month, start_time.weekday(), start_time.hour, start_station_id, end_station_id)
-        if not lam: return 0
-        slope = self.monthly_slope[start_time.month-1]    
-        intercept = self.monthly_intercept[start_time.month-1]
+        lam = self.lambda_distrs.get(year, start_time.month, start_time.weekday() < 5, start_time.hour)
+        if lam is None: return None
         if self.regression_type == LASTYEAR:
-            return lam.value
+            return lam
         elif self.regression_type == LOGLASTYEAR:
             return self.log_predict_with_year_deltas(2013, lam, slope, intercept, start_time)
         elif self.regression_type == LINEARLASTYEAR:
@@ -301,6 +334,9 @@ class PoissonLogic(SimulationLogic):
 
 
     def predict_from_one_year(self, prev_year, prev_year_lambda, slope, intercept, start_time):
+        '''
+        prev_year_lambda may be a single lambda value or a matrix of them
+        '''
         if self.regression_type == LINEAR:
             return self.linear_predict(prev_year, prev_year_lambda, slope, intercept, start_time)
         elif self.regression_type == LOG1:
@@ -324,7 +360,7 @@ class PoissonLogic(SimulationLogic):
                     start_time.month - self.time_of_first_data.month - 5
         prev_year_trips = slope * prev_month + intercept
         future_year_trips = slope * future_month + intercept
-        lam_prediction = prev_year_lambda.value * future_year_trips / prev_year_trips
+        lam_prediction = prev_year_lambda * future_year_trips / prev_year_trips
         return lam_prediction 
 
     def jeff_log_predict(self, prev_year, prev_year_lambda, slope, intercept, start_time):
@@ -338,21 +374,21 @@ class PoissonLogic(SimulationLogic):
             prev_month = 0
         prev_year_trips = slope * math.log(prev_month+1) + intercept
         future_year_trips = slope * math.log(future_month+1) + intercept
-        lam_prediction = prev_year_lambda.value * future_year_trips / prev_year_trips
+        lam_prediction = prev_year_lambda * future_year_trips / prev_year_trips
         return lam_prediction 
 
 
     def linear_predict(self, prev_year, prev_year_lambda, slope, intercept, start_time):
         prev_year_trips = slope * prev_year + intercept
         future_year_trips = slope * start_time.year + intercept
-        lam_prediction = prev_year_lambda.value * future_year_trips / prev_year_trips
+        lam_prediction = prev_year_lambda * future_year_trips / prev_year_trips
         return lam_prediction
 
 
     def log_predict(self, prev_year, prev_year_lambda, slope, intercept, start_time):
         prev_year_trips = slope * math.log(prev_year) + intercept
         future_year_trips = slope * math.log(start_time.year) + intercept
-        lam_prediction = prev_year_lambda.value * future_year_trips / prev_year_trips
+        lam_prediction = prev_year_lambda * future_year_trips / prev_year_trips
         return lam_prediction
 
     
@@ -360,17 +396,35 @@ class PoissonLogic(SimulationLogic):
         # Hopefully these are reasonable
         prev_year_trips = slope * math.log(prev_year-2010+2) + intercept
         future_year_trips = slope * math.log(start_time.year-2010+2) + intercept
-        lam_prediction = prev_year_lambda.value * future_year_trips / prev_year_trips
+        lam_prediction = prev_year_lambda * future_year_trips / prev_year_trips
         return lam_prediction
 
 
     def log_predict_with_real_years(self, prev_year, prev_year_lambda, slope, intercept, start_time):
         prev_year_trips = self.monthly_trips[prev_year][start_time.month-1]
         future_year_trips = slope * math.log(start_time.year-2010+2) + intercept
-        lam_prediction = prev_year_lambda.value * future_year_trips / prev_year_trips
+        lam_prediction = prev_year_lambda * future_year_trips / prev_year_trips
         return lam_prediction
 
 
+    def old_predict_matrix(self, start_time):
+        '''
+        Runs old_predict for every pair with a lambda in some year
+        '''
+        keys = self.lambda_distrs.slice_keys(start_time.month, start_time.weekday() < 5, start_time.hour)
+        if not keys:
+            return None
+        num_stations = len(self.station_index)
+        candidates = sparse.csr_matrix((num_stations, num_stations))
+        for key in keys:
+            candidates = candidates + self.lambda_distrs.slices[key]
+        start_idx, end_idx, _ = nonzero_pairs(candidates)
+        ids = self.station_index.ids_of
+        values = [self.old_predict(start_time, ids(s_idx), ids(e_idx))
+                  for s_idx, e_idx in zip(start_idx, end_idx)]
+        return sparse.csr_matrix((values, (start_idx, end_idx)),
+                                 shape=(num_stations, num_stations))
+
     def old_predict(self, start_time, start_station_id, end_station_id):
         x_dates = []
         y_lambdas = []
@@ -380,7 +434,7 @@ class PoissonLogic(SimulationLogic):
             lam = self.get_lambda(year, start_time.month, start_time.weekday(), start_time.hour, start_station_id, end_station_id)
 #            print year, start_time.hour, lam
             x_dates.append(year)
-            y_lambdas.append(lam.value if lam else 0)
+            y_lambdas.append(lam if lam else 0)
            
         if len(x_dates) == 0:
             return 0
@@ -397,7 +451,7 @@ class PoissonLogic(SimulationLogic):
 #        print slope, intercept, new_lam_val
         if new_lam_val <= 0:
             new_lam_val = self.avg_lambda(y_lambdas)
-        return Lambda(start_station_id, end_station_id, start_time.hour, start_time.weekday()<5, start_time.year, start_time.month, new_lam_val)
+        return new_lam_val
 
 
     def get_year_range_of_data(self, month):
@@ -421,26 +475,6 @@ class PoissonLogic(SimulationLogic):
             return []
 
 
-    def get_num_trips(self, lam):
-        """
-        Samples a poisson distribution with the given lambda and returns the number
-        of trips produced from the dist. Returns -1 if lambda = 0 -> undefined function.
-        """
-        probability = random.random()
-        while probability == 0:
-            probability = random.random()
-            
-        # when using all data (training + testing)
-        # num_trips = poisson.ppf(probability, lam.value)
-
-        # when using only training data
-        num_trips = poisson.ppf(probability, lam.value * (4./3))
-
-        if numpy.isnan(num_trips):
-            num_trips = -1
-        return int(round(num_trips))
-
-
     def load_gaussians(self):
         """
         Caches gaussian distribution values into a dictionary.
@@ -455,40 +489,48 @@ class PoissonLogic(SimulationLogic):
 
     def load_gammas(self):
         '''
-        Caches gaussian distribution variables into a dictionary.
+        Caches gamma distribution variables of the simulated stations into
+        a GammaTable.
         '''
-        gamma_distr = self.session.query(Gamma)\
-                          .filter(Gamma.start_station_id.in_(self.stations.keys()))
+        gammas = self.model_artifacts.get('gamma')
+        return GammaTable.from_columns(self.station_index, gammas['start_station_id'],
+                                       gammas['end_station_id'], gammas['shape'],
+                                       gammas['scale'])
 
-        distr_dict = {}
-        for gamma in gamma_distr:
-            distr_dict[(gamma.start_station_id, gamma.end_station_id)] = gamma 
-        return distr_dict
+    def get_gamma_arrays(self):
+        '''
+        Dense [start index, end index] arrays of gamma shapes and scales, plus
+        a mask of the pairs that have a gamma at all.
+        '''
+        table = self.duration_distrs
+        return table.shapes, table.scales, table.has_gamma
 
     def get_lambda(self, year, month, day, hour, start_station, end_station):
         '''
-        If there is a lambda, return it. Otherwise return None as we only 
+        If there is a lambda, return its value. Otherwise return None as we only 
         load non-zero lambdas from the database for performance reasons.
         '''
-        return self.lambda_distrs.get(year, {}).get(month, {}).get(day < 5, {}).get(hour, {}).get((start_station, end_station), None)
+        if start_station not in self.station_index or end_station not in self.station_index:
+            return None
+        return self.lambda_distrs.lookup(year, month, day < 5, hour,
+                                         self.station_index.index_of(start_station),
+                                         self.station_index.index_of(end_station))
 
     def load_lambdas(self, start_time, end_time):
         '''
-        Caches lambdas into dictionary of day -> hour -> (start_id, end_id) -> lambda
+        Caches lambdas into a LambdaStore holding one sparse matrix per
+        (year, month, is_week_day, hour).
         Note: DB only has values > 0.
         '''
         print "Start time",start_time, "End time",end_time
-        # kind of gross but makes for easy housekeeping
-        distr_dict = defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: defaultdict(float)))))
-
-        # keep track of when we've hit the database for a particular request
-        requested_dict = defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: defaultdict(bool))))
+        # (year or None for every year, month, is_week_day) -> [first hour, last hour]
+        requested = {}
+        def request(year, day, start_hour, end_hour):
+            key = (year, day.month, day.weekday() < 5)
+            hours = requested.setdefault(key, [start_hour, end_hour])
+            hours[0] = min(hours[0], start_hour)
+            hours[1] = max(hours[1], end_hour)
 
-        num_added = 0
-        # Inclusive
-        
-        print start_time, end_time
-        
         # If some part of the simulation is in the future, load lambdas for that time
         # every year so regression can be done later
         if end_time > self.time_of_last_data:
@@ -497,69 +539,29 @@ class PoissonLogic(SimulationLogic):
             print "The future is now"
             for day in rrule.rrule(rrule.DAILY, dtstart=dt_start, until=end_time):
                 dow = day.weekday()
-                
                 start_hour = dt_start.hour if dt_start.weekday() == dow else 0
                 end_hour = end_time.hour if end_time.weekday() == dow else 24
-    
-                month = day.month
-                is_week_day = dow < 5
-                
-                lambda_poisson = self.session.query(data_model.Lambda) \
-                    .filter(data_model.Lambda.is_week_day == is_week_day) \
-                    .filter(data_model.Lambda.month == month) \
-                    .filter(data_model.Lambda.hour.between(start_hour, end_hour))
-  
-                for lam in lambda_poisson:
-                    distr_dict[lam.year][month][lam.is_week_day][lam.hour][(lam.start_station_id, lam.end_station_id)] = lam
-                    num_added += 1
-                        
-
-        station_list = self.stations.keys()
+                request(None, day, start_hour, end_hour)
+
         for day in rrule.rrule(rrule.DAILY, dtstart=start_time, until=end_time):
             dow = day.weekday()
-            
             start_hour = start_time.hour if start_time.weekday() == dow else 0
             end_hour = end_time.hour if end_time.weekday() == dow else 24
+            request(day.year, day, start_hour, end_hour)
 
-            year = day.year
-            month = day.month
-            is_week_day = dow < 5
-
+        # Every slice is read once from its artifact
+        store = LambdaStore(self.station_index)
+        for (year, month, is_week_day), (start_hour, end_hour) in requested.iteritems():
             # For now we're only loading in lambdas that have non-zero values. 
-            # We'll assume zero value if it's not in the dictionary
-            lambda_poisson = self.session.query(data_model.Lambda) \
-                .filter(data_model.Lambda.is_week_day == is_week_day) \
-                .filter(data_model.Lambda.year == year) \
-                .filter(data_model.Lambda.month == month) \
-                .filter(data_model.Lambda.hour.between(start_hour, end_hour))        
-            
-            if not requested_dict[month][year][is_week_day][(start_hour, end_hour)]:
-                lambda_poisson = self.session \
-                                     .query(Lambda) \
-                                     .filter(Lambda.month == month) \
-                                     .filter(Lambda.year == year) \
-                                     .filter(Lambda.is_week_day == is_week_day) \
-                                     .filter(Lambda.hour.between(start_hour, end_hour))\
-                                     .filter(Lambda.start_station_id.in_(station_list))\
-                                     .filter(Lambda.end_station_id.in_(station_list))
-                requested_dict[month][year][is_week_day][(start_hour, end_hour)] = True
-                
-            for lam in lambda_poisson:
-                distr_dict[lam.year][lam.month][lam.is_week_day][lam.hour][(lam.start_station_id, lam.end_station_id)] = lam
-                num_added += 1
-
-        return distr_dict
-
-    def get_trip_duration(self, gamma):
-        '''
-        Samples from a gamma distribution and returns a timedelta representing
-        a trip length
-        '''
-        #TODO Fix this
-        if gamma.shape <= 0 or gamma.scale <= 0:
-            return datetime.timedelta(seconds=0)
-        trip_length = numpy.random.gamma(gamma.shape, gamma.scale)
-        return datetime.timedelta(seconds=trip_length)
+            # We'll assume zero value if it's not in the store
+            lambdas = self.model_artifacts.get('lambda', (year, month, is_week_day))
+            in_hours = (lambdas['hour'] >= start_hour) & (lambdas['hour'] <= end_hour)
+            store.add_columns(*[lambdas[name][in_hours]
+                                for name in ['year', 'month', 'is_week_day', 'hour',
+                                             'start_station_id', 'end_station_id', 'value']])
+
+        print "Loaded %d lambdas (%d bytes)" % (len(store), store.nbytes())
+        return store
 
     def clean_up(self):
         pass
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+'''
+    progress.py
+
+    Progress of simulation runs, see Simulator.run. A ProgressReporter
+    follows a run's timesteps and hands a progress dict (steps done,
+    simulated time, events/sec, ETA...) to a callback, at most every
+    min_interval seconds.
+
+    Runs of other processes are followed through the ProgressBoard: a
+    small table of progress records in shared memory (see shared_models),
+    one per job id, which the web app (views/app.py) reads without locks.
+    Every record has a sequence number that is odd while it's being
+    written, readers retry until they see the same even number before and
+    after their copy. A writer killed mid-write leaves its record odd, so
+    readers give up after READ_TRIES tries, and the next writer of the
+    slot starts over from it.
+'''
+from collections import OrderedDict
+from contextlib import contextmanager
+import fcntl
+import numpy
+import os
+import time
+
+from shared_models import SHM_DIR
+from sim_clock import epoch_seconds, from_epoch_seconds
+
+# Job of the runs that don't say which job they are
+DEFAULT_JOB = 'default'
+BOARD_PATH = os.path.join(SHM_DIR, 'simba-progress')
+# Jobs followed at once, the least recently updated job makes room
+NUM_SLOTS = 256
+# Seconds between two progress updates of a run
+MIN_INTERVAL = 0.5
+# Copies a reader tries before giving up on a record being written
+READ_TRIES = 1000
+
+RECORD = numpy.dtype([('seq', numpy.int64),
+                      ('job_id', 'S64'),
+                      ('updated', numpy.float64),
+                      ('total_steps', numpy.int64),
+                      ('done_steps', numpy.int64),
+                      ('current_time', numpy.int64),
+                      ('events', numpy.int64),
+                      ('events_per_sec', numpy.float64),
+                      ('eta_seconds', numpy.float64),
+                      ('finished', bool)])
+# Fields of the progress dicts, besides percent_progress
+FIELDS = ['total_steps', 'done_steps', 'current_time', 'events',
+          'events_per_sec', 'eta_seconds', 'finished']
+
+
+class ProgressReporter:
+
+    def __init__(self, callback, min_interval=MIN_INTERVAL):
+        '''callback: function of a progress dict'''
+        self.callback = callback
+        self.min_interval = min_interval
+        self.last_report = None
+
+    def start(self, total_steps, current_time, events=0):
+        self.total_steps = total_steps
+        self.done_steps = 0
+        self.began = time.time()
+        self.first_events = events
+        self.progress = {'total_steps':total_steps, 'done_steps':0,
+                         'current_time':current_time, 'events':events,
+                         'events_per_sec':0., 'eta_seconds':None, 'finished':False,
+                         'percent_progress':0. if total_steps > 0 else 100.}
+        self._report()
+
+    def step(self, current_time, events):
+        '''Records one more timestep, done at current_time'''
+        self.done_steps += 1
+        now = time.time()
+        if now - self.last_report < self.min_interval:
+            return
+        self._update(current_time, events, now)
+        self._report()
+
+    def finish(self, current_time, events):
+        self._update(current_time, events, time.time())
+        self.progress['finished'] = True
+        self.progress['eta_seconds'] = 0.
+        self._report()
+
+    def _update(self, current_time, events, now):
+        elapsed = now - self.began
+        progress = self.progress
+        progress['done_steps'] = self.done_steps
+        progress['current_time'] = current_time
+        progress['events'] = events
+        if elapsed > 0:
+            progress['events_per_sec'] = (events - self.first_events) / elapsed
+        if self.done_steps:
+            progress['eta_seconds'] = max(self.total_steps - self.done_steps, 0)\
+                                      * elapsed / self.done_steps
+        if self.total_steps > 0:
+            progress['percent_progress'] = min(100. * self.done_steps / self.total_steps, 100.)
+
+    def _report(self):
+        self.last_report = time.time()
+        self.callback(dict(self.progress))
+
+
+class ProgressBoard:
+
+    def __init__(self, path=BOARD_PATH, num_slots=NUM_SLOTS):
+        self.path = path
+        self.num_slots = num_slots
+        self._records = None
+        # job id -> slot, of the jobs this process publishes
+        self._slots = {}
+        # job id -> last progress dict read, least recently read first, see get
+        self._last = OrderedDict()
+
+    @contextmanager
+    def _locked(self):
+        '''
+        Exclusive lock to hold while creating the board or giving out
+        slots. A job's record is only written by the process running it.
+        '''
+        with open(self.path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _open(self):
+        if self._records is None:
+            size = self.num_slots * RECORD.itemsize
+            with self._locked():
+                if not os.path.exists(self.path) or os.path.getsize(self.path) != size:
+                    with open(self.path, 'wb') as f:
+                        f.write('\0' * size)
+            self._records = numpy.memmap(self.path, RECORD, 'r+', shape=(self.num_slots,))
+        return self._records
+
+    def _free_slot(self, job_id):
+        '''The slot of job_id if it has one, else the one to give it'''
+        records = self._records
+        slots = numpy.flatnonzero(records['job_id'] == job_id)
+        if len(slots):
+            return slots[0]
+        # Free slots were never updated
+        return numpy.argmin(records['updated'])
+
+    def _write(self, slot, values, owner=None):
+        '''
+        Writes values to the record of slot if it's still owner's (any
+        record's if None), returns whether it did
+        '''
+        records = self._records
+        seq = records['seq'][slot]
+        # Odd if its last writer was killed mid-write
+        seq += seq % 2
+        records['seq'][slot] = seq + 1
+        # Checked once readers know the record is being written
+        if owner is not None and records['job_id'][slot] != owner:
+            records['seq'][slot] = seq + 2
+            return False
+        for name, value in values.iteritems():
+            records[name][slot] = value
+        records['seq'][slot] = seq + 2
+        return True
+
+    def publish(self, job_id, progress):
+        '''Posts a progress dict of ProgressReporter for job_id'''
+        job_id = _key(job_id)
+        values = {name:progress[name] for name in FIELDS}
+        values['current_time'] = epoch_seconds(progress['current_time'])
+        if values['eta_seconds'] is None:
+            values['eta_seconds'] = numpy.nan
+        values['job_id'] = job_id
+        values['updated'] = time.time()
+
+        records = self._open()
+        slot = self._slots.get(job_id)
+        if slot is not None and self._write(slot, values, owner=job_id):
+            return
+        # The job's first record, or its slot was given to another job
+        with self._locked():
+            slot = self._free_slot(job_id)
+            self._write(slot, values)
+        self._slots[job_id] = slot
+
+    def publisher(self, job_id):
+        '''A ProgressReporter callback publishing for job_id'''
+        return lambda progress: self.publish(job_id, progress)
+
+    def get(self, job_id):
+        '''
+        The last progress dict published for job_id, None if there's none.
+        If its record stays mid-write, the last one this board read.
+        '''
+        job_id = _key(job_id)
+        records = self._open()
+        for i in xrange(READ_TRIES):
+            slots = numpy.flatnonzero(records['job_id'] == job_id)
+            if not len(slots):
+                return None
+            slot = slots[0]
+            seq = records['seq'][slot]
+            if seq % 2:
+                continue
+            record = records[slot].copy()
+            if records['seq'][slot] == seq and record['job_id'] == job_id:
+                break
+        else:
+            return self._last.get(job_id)
+        progress = {name:record[name].item() for name in FIELDS}
+        progress['current_time'] = from_epoch_seconds(progress['current_time'])
+        if numpy.isnan(progress['eta_seconds']):
+            progress['eta_seconds'] = None
+        if progress['total_steps'] > 0:
+            progress['percent_progress'] = min(100. * progress['done_steps']
+                                               / progress['total_steps'], 100.)
+        else:
+            progress['percent_progress'] = 100.
+        self._last.pop(job_id, None)
+        self._last[job_id] = progress
+        if len(self._last) > self.num_slots:
+            self._last.popitem(last=False)
+        return dict(progress)
+
+
+def _key(job_id):
+    return str(job_id)[:RECORD['job_id'].itemsize]
+
+# ProgressBoard of this process, see board()
+_board = None
+
+def board():
+    '''The ProgressBoard at BOARD_PATH, opened once per process'''
+    global _board
+    if _board is None:
+        _board = ProgressBoard()
+    return _board
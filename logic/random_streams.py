@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+'''
+    random_streams.py
+
+    Common random numbers for comparing scenarios. Every random draw of the
+    simulation has a purpose (departures, durations, destinations...) and
+    keys (station ids, station pair, hour, occurrence...), and its uniform
+    is a hash of (seed, purpose, keys) instead of the next value of a
+    global stream. Two runs with the same seed therefore draw the same
+    numbers for the same station, pair or hour even where the scenarios
+    differ elsewhere, e.g. in station_caps or drop_stations.
+
+    Samples come from the uniforms through inverse CDFs, so they are
+    monotone in u and an antithetic run (using 1 - u everywhere) is
+    negatively correlated with the plain run of the same seed.
+
+    Keys must be integers that mean the same in every scenario: station
+    ids rather than station indexes, epoch hours rather than positions.
+'''
+import math
+import numpy
+from scipy import stats, special
+
+# Purposes
+INITIAL_COUNTS = 1
+DEPARTURES = 2
+START_OFFSETS = 3
+DESTINATIONS = 4
+DURATIONS = 5
+
+MASK = (1 << 64) - 1
+GOLDEN = 0x9E3779B97F4A7C15
+MIX1 = 0xBF58476D1CE4E5B9
+MIX2 = 0x94D049BB133111EB
+# 53 random bits give a double in (0, 1)
+UNIT = 2.0 ** -53
+
+def _mix(x):
+    '''SplitMix64 finalizer on a python int'''
+    x = ((x ^ (x >> 30)) * MIX1) & MASK
+    x = ((x ^ (x >> 27)) * MIX2) & MASK
+    return x ^ (x >> 31)
+
+def _mix_array(x):
+    '''SplitMix64 finalizer on a uint64 array, wrapping like _mix'''
+    x = (x ^ (x >> numpy.uint64(30))) * numpy.uint64(MIX1)
+    x = (x ^ (x >> numpy.uint64(27))) * numpy.uint64(MIX2)
+    return x ^ (x >> numpy.uint64(31))
+
+
+class RandomStreams:
+
+    def __init__(self, seed, antithetic=False):
+        # Plain int, numpy integers don't mix with the long constants
+        self.seed = int(seed)
+        self.antithetic = antithetic
+        self._seed_hash = _mix((self.seed + GOLDEN) & MASK)
+
+    def uniform(self, purpose, *keys):
+        '''The uniform in (0, 1) of one draw'''
+        h = _mix(self._seed_hash ^ ((purpose + GOLDEN) & MASK))
+        for key in keys:
+            h = _mix(h ^ ((int(key) + GOLDEN) & MASK))
+        u = ((h >> 11) + 0.5) * UNIT
+        return 1 - u if self.antithetic else u
+
+    def uniforms(self, purpose, *keys):
+        '''
+        Vectorized uniform, keys are integers or arrays of integers that
+        broadcast together. uniforms(p, a, b)[i] == uniform(p, a[i], b[i])
+        '''
+        with numpy.errstate(over='ignore'):
+            h = numpy.uint64(_mix(self._seed_hash ^ ((purpose + GOLDEN) & MASK)))
+            for key in keys:
+                key = numpy.asarray(key).astype(numpy.int64).astype(numpy.uint64)
+                h = _mix_array(h ^ (key + numpy.uint64(GOLDEN)))
+        u = ((numpy.asarray(h) >> numpy.uint64(11)).astype(float) + 0.5) * UNIT
+        return 1 - u if self.antithetic else u
+
+    def integer(self, purpose, n, *keys):
+        '''An integer in [0, n)'''
+        return int(self.uniform(purpose, *keys) * n)
+
+    def integers(self, purpose, n, *keys):
+        return (self.uniforms(purpose, *keys) * n).astype(numpy.int64)
+
+    def normal(self, purpose, mean, std, *keys):
+        return mean + std * special.ndtri(self.uniform(purpose, *keys))
+
+    def exponential(self, purpose, scale, *keys):
+        return -scale * math.log1p(-self.uniform(purpose, *keys))
+
+    def exponentials(self, purpose, scale, *keys):
+        return -scale * numpy.log1p(-self.uniforms(purpose, *keys))
+
+    def gamma(self, purpose, shape, scale, *keys):
+        return special.gammaincinv(shape, self.uniform(purpose, *keys)) * scale
+
+    def gammas(self, purpose, shapes, scales, *keys):
+        return special.gammaincinv(shapes, self.uniforms(purpose, *keys)) * scales
+
+    def poissons(self, purpose, lams, *keys):
+        '''Poisson draws of the given means, one per entry of lams'''
+        lams = numpy.asarray(lams, dtype=float)
+        u = self.uniforms(purpose, *keys) * numpy.ones(len(lams))
+        counts = numpy.zeros(len(lams), dtype=numpy.int64)
+        # Means are mostly small, most draws are 0 and need no ppf
+        nonzero = u > numpy.exp(-lams)
+        if nonzero.any():
+            counts[nonzero] = stats.poisson.ppf(u[nonzero], lams[nonzero])
+        return counts
+
+    def choice(self, purpose, cum_probs, *keys):
+        '''Index drawn from a cumulative (not necessarily normalized) distribution'''
+        cum_probs = numpy.asarray(cum_probs)
+        return int(numpy.searchsorted(cum_probs, self.uniform(purpose, *keys) * cum_probs[-1],
+                                      side='right'))
+
+    def choices(self, purpose, cum_probs, *keys):
+        cum_probs = numpy.asarray(cum_probs)
+        return numpy.searchsorted(cum_probs, self.uniforms(purpose, *keys) * cum_probs[-1],
+                                  side='right')
+
+
+def occurrences(*keys):
+    '''
+    For parallel arrays of keys, how many earlier entries have the same
+    keys, e.g. [(1,2), (1,2), (3,4), (1,2)] -> [0, 1, 0, 2]. Used as the
+    last key of repeated draws.
+    '''
+    num = len(keys[0])
+    if num == 0:
+        return numpy.zeros(0, dtype=numpy.int64)
+    order = numpy.lexsort(keys[::-1])
+    sorted_keys = [numpy.asarray(k)[order] for k in keys]
+    new_group = numpy.zeros(num, dtype=bool)
+    new_group[0] = True
+    for k in sorted_keys:
+        new_group[1:] |= k[1:] != k[:-1]
+    group_starts = numpy.flatnonzero(new_group)
+    group_sizes = numpy.diff(numpy.append(group_starts, num))
+    sorted_counts = numpy.arange(num) - numpy.repeat(group_starts, group_sizes)
+    counts = numpy.empty(num, dtype=numpy.int64)
+    counts[order] = sorted_counts
+    return counts
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+'''
+    replications.py
+
+    Seeds and statistics for running the same scenario several times, see
+    Simulator.run_replications. Every replication is reduced to a small
+    summary of its flush() results so summaries are cheap to send back
+    from worker processes.
+'''
+import math
+import numpy
+from scipy import stats
+
+# Metrics with one value per replication
+SCALAR_METRICS = ['trips', 'full_station_disappointments',
+                  'empty_station_disappointments', 'total_rebalances']
+# Metrics with one {station id : value} dict per replication
+STATION_METRICS = ['arr_dis_stations', 'dep_dis_stations']
+
+def replication_seeds(num_replications, seed=None):
+    '''
+    Seeds of every replication, drawn from one master stream so the same
+    seed always gives the same replications, whatever runs them.
+    '''
+    return numpy.random.RandomState(seed).randint(0, 2**31 - 1,
+                                                  size=num_replications).tolist()
+
+def replication_summary(results):
+    '''Reduces the flush() dictionary of one run to the merged metrics'''
+    return {'trips':len(results['trips']),
+            'full_station_disappointments':len(results['full_station_disappointments']),
+            'empty_station_disappointments':len(results['empty_station_disappointments']),
+            'total_rebalances':results['total_rebalances'],
+            'arr_dis_stations':results['arr_dis_stations'],
+            'dep_dis_stations':results['dep_dis_stations']}
+
+def describe(values, confidence=0.95):
+    '''
+    Mean, sample standard deviation and the Student t confidence interval
+    of the mean of the given values.
+    '''
+    values = numpy.asarray(values, dtype=float)
+    n = len(values)
+    mean = values.mean()
+    if n < 2:
+        return {'mean':mean, 'std':0.0, 'ci':(mean, mean)}
+    std = values.std(ddof=1)
+    half_width = stats.t.ppf((1 + confidence) / 2., n - 1) * std / math.sqrt(n)
+    return {'mean':mean, 'std':std, 'ci':(mean - half_width, mean + half_width)}
+
+def merge_replications(summaries, confidence=0.95):
+    '''
+    Merges replication summaries into the description (see describe) of
+    every metric. Per-station metrics are described per station id; a
+    station missing from a replication's dict counts as 0 there.
+    '''
+    merged = {'replications':len(summaries)}
+    for metric in SCALAR_METRICS:
+        merged[metric] = describe([s[metric] for s in summaries], confidence)
+    for metric in STATION_METRICS:
+        station_ids = set()
+        for s in summaries:
+            station_ids.update(s[metric])
+        merged[metric] = {s_id:describe([s[metric].get(s_id, 0) for s in summaries],
+                                        confidence)
+                          for s_id in station_ids}
+    return merged
+
+def average_summaries(plain, antithetic):
+    '''The summary averaging a plain and an antithetic run of the same seed'''
+    averaged = {}
+    for metric in SCALAR_METRICS:
+        averaged[metric] = (plain[metric] + antithetic[metric]) / 2.
+    for metric in STATION_METRICS:
+        station_ids = set(plain[metric]) | set(antithetic[metric])
+        averaged[metric] = {s_id:(plain[metric].get(s_id, 0) + antithetic[metric].get(s_id, 0)) / 2.
+                            for s_id in station_ids}
+    return averaged
+
+def compare_replications(summaries_a, summaries_b, confidence=0.95,
+                         antithetic_a=None, antithetic_b=None):
+    '''
+    Compares two scenarios run with the same seeds, summaries_a[i] and
+    summaries_b[i] sharing their random numbers. Besides merging each
+    scenario, describes the paired difference (a - b) of every scalar
+    metric with its variance_reduction: the variance of the difference of
+    independent runs over the variance of the paired difference, i.e. how
+    many times fewer replications give the same confidence.
+
+    With the antithetic runs of the same seeds, every replication is the
+    average of its plain and antithetic runs, and antithetic_reduction is
+    the variance of the plain paired difference over twice the variance of
+    the averaged one (twice as it costs two runs).
+    '''
+    if antithetic_a is not None:
+        plain_a, plain_b = summaries_a, summaries_b
+        summaries_a = [average_summaries(p, a) for p, a in zip(plain_a, antithetic_a)]
+        summaries_b = [average_summaries(p, a) for p, a in zip(plain_b, antithetic_b)]
+
+    comparison = {'replications':len(summaries_a),
+                  'a':merge_replications(summaries_a, confidence),
+                  'b':merge_replications(summaries_b, confidence),
+                  'difference':{}}
+    for metric in SCALAR_METRICS:
+        values_a = numpy.array([s[metric] for s in summaries_a], dtype=float)
+        values_b = numpy.array([s[metric] for s in summaries_b], dtype=float)
+        difference = describe(values_a - values_b, confidence)
+        difference['variance_reduction'] = _variance_ratio(
+                _variance(values_a) + _variance(values_b), _variance(values_a - values_b))
+        if antithetic_a is not None:
+            plain_difference = numpy.array([a[metric] - b[metric]
+                                            for a, b in zip(plain_a, plain_b)], dtype=float)
+            difference['antithetic_reduction'] = _variance_ratio(
+                    _variance(plain_difference), 2 * _variance(values_a - values_b))
+        comparison['difference'][metric] = difference
+    return comparison
+
+def _variance(values):
+    return values.var(ddof=1) if len(values) > 1 else 0.0
+
+def _variance_ratio(variance, reduced_variance):
+    '''None if there's nothing to compare'''
+    if reduced_variance > 0:
+        return variance / reduced_variance
+    return None
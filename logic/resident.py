@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+'''
+    resident.py
+
+    Sim logics kept alive across the runs of a long-lived worker process
+    (see views/jobs.py), so a run only sets up its own state: the DB
+    session, the station distances and the models loaded by earlier runs
+    stay in memory. Every initialize still checks the models' training
+    versions and loads them again once trainers publish new ones (see
+    SimulationLogic.ensure_models).
+
+    Call warm_up when the worker starts, resident_logic for every run and
+    end_run once it's over.
+'''
+from utils import Connector
+from nearest_stations import StationDistances
+import numpy
+import random
+
+# Session of the resident logics of this process, see session()
+_session = None
+# Logic class -> its resident logic
+_logics = {}
+
+
+def session():
+    '''The DB session of this process, made on first use'''
+    global _session
+    if _session is None:
+        _session = Connector().getDBSession()
+    return _session
+
+def resident_logic(logic_class):
+    '''The logic_class sim logic of this process, made on first use'''
+    logic = _logics.get(logic_class)
+    if logic is None:
+        logic = logic_class(session())
+        # Workers load every model once between them, as in Simulator.run_jobs
+        logic.share_models = True
+        _logics[logic_class] = logic
+    return logic
+
+def warm_up(logic_classes):
+    '''
+    Makes the resident logics of logic_classes and loads what doesn't
+    depend on the run (station distances) ahead of the first run
+    '''
+    # Forked workers would all draw the seeds of unseeded runs alike
+    random.seed()
+    numpy.random.seed()
+    distances = None
+    for logic_class in logic_classes:
+        logic = resident_logic(logic_class)
+        if logic.station_distances is None:
+            if distances is None:
+                distances = StationDistances.load(session())
+            logic.station_distances = distances
+    end_run()
+
+def end_run():
+    '''
+    Ends the session's transaction and hands back its connection, so idle
+    workers hold neither. Objects loaded by the run stay usable.
+    '''
+    if _session is not None:
+        _session.close()
@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+'''
+    result_sinks.py
+
+    Sinks get the results of a run while it goes, see Simulator.run: after
+    every timestep, each sink's write receives the trips completed and the
+    disappointments logged during that timestep, as a TripBuffer and a
+    DisappointmentLog. With retain=False the run lets go of every batch
+    once written, so runs of any length take constant memory.
+
+    - CSVSink: csv files of at most rows_per_file rows
+    - ColumnSink: .npz files of the raw columns, read back with load_columns
+    - AggregateSink: running counts in memory
+    - QueueSink: hands the batches to a consumer thread through a bounded queue
+    - LiveSink: hands partial results to a callback every so often
+'''
+import Queue
+import csv
+import glob
+import os
+from time import time as wall_clock
+import numpy
+
+TRIP_FIELDS = ['start_station_id', 'end_station_id', 'start_date', 'end_date']
+DISAPPOINTMENT_FIELDS = ['station_id', 'date', 'is_full']
+
+
+def format_dates(origin, seconds):
+    '''
+    Datetime strings (as str of a datetime) of an array of simulation
+    seconds, origin being the epoch seconds of time 0
+    '''
+    dates = numpy.datetime_as_string((origin + seconds).astype('datetime64[s]'))
+    return numpy.char.replace(dates, 'T', ' ').tolist()
+
+def trip_columns(trips):
+    '''Station ids and epoch seconds of a TripBuffer, by TRIP_FIELDS'''
+    return {'start_station_id':trips.start_station_ids(),
+            'end_station_id':trips.end_station_ids(),
+            'start_date':trips.origin + trips.start_time,
+            'end_date':trips.origin + trips.end_time}
+
+def disappointment_columns(disappointments):
+    '''Station ids and epoch seconds of a DisappointmentLog, by DISAPPOINTMENT_FIELDS'''
+    return {'station_id':disappointments.station_index.ids_of(disappointments.station),
+            'date':disappointments.origin + disappointments.time,
+            'is_full':disappointments.is_full.copy()}
+
+
+class ResultSink(object):
+    '''Interface of all sinks'''
+
+    def bind(self, sim_logic):
+        '''Called before open with the run's sim logic, for sinks following its state'''
+        pass
+
+    def open(self):
+        '''Called before the first timestep'''
+        pass
+
+    def write(self, time, trips, disappointments):
+        '''
+        Takes the results of the timestep ending at time (a datetime).
+        The batches are the sink's own, they can be kept.
+        '''
+        raise NotImplementedError
+
+    def close(self):
+        '''Called after the last timestep, or when the run fails'''
+        pass
+
+
+class _ChunkedCSV:
+    '''Rows written to name_00000.csv, name_00001.csv... of rows_per_file rows'''
+
+    def __init__(self, directory, name, header, rows_per_file):
+        self.directory = directory
+        self.name = name
+        self.header = header
+        self.rows_per_file = rows_per_file
+        self.num_files = 0
+        self.rows_left = 0
+        self.out_file = None
+        self.writer = None
+
+    def _next_file(self):
+        self.close()
+        path = os.path.join(self.directory, '%s_%05d.csv' % (self.name, self.num_files))
+        self.num_files += 1
+        self.out_file = open(path, 'wb')
+        self.writer = csv.writer(self.out_file)
+        self.writer.writerow(self.header)
+        self.rows_left = self.rows_per_file
+
+    def write(self, rows):
+        while rows:
+            if not self.rows_left:
+                self._next_file()
+            self.writer.writerows(rows[:self.rows_left])
+            written = min(len(rows), self.rows_left)
+            self.rows_left -= written
+            rows = rows[written:]
+
+    def close(self):
+        if self.out_file is not None:
+            self.out_file.close()
+            self.out_file = None
+
+
+class CSVSink(ResultSink):
+    '''
+    Writes trips to directory/trips_00000.csv... and disappointments to
+    directory/disappointments_00000.csv..., rows_per_file rows per file
+    '''
+
+    def __init__(self, directory, rows_per_file=100000):
+        self.directory = directory
+        self.rows_per_file = rows_per_file
+
+    def open(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.trip_files = _ChunkedCSV(self.directory, 'trips', TRIP_FIELDS,
+                                      self.rows_per_file)
+        self.disappointment_files = _ChunkedCSV(self.directory, 'disappointments',
+                                                DISAPPOINTMENT_FIELDS, self.rows_per_file)
+
+    def write(self, time, trips, disappointments):
+        if len(trips):
+            self.trip_files.write(zip(trips.start_station_ids().tolist(),
+                                      trips.end_station_ids().tolist(),
+                                      format_dates(trips.origin, trips.start_time),
+                                      format_dates(trips.origin, trips.end_time)))
+        if len(disappointments):
+            station_ids = disappointments.station_index.ids_of(disappointments.station)
+            self.disappointment_files.write(zip(station_ids.tolist(),
+                                                format_dates(disappointments.origin,
+                                                             disappointments.time),
+                                                disappointments.is_full.astype(int).tolist()))
+
+    def close(self):
+        self.trip_files.close()
+        self.disappointment_files.close()
+
+
+class ColumnSink(ResultSink):
+    '''
+    Writes the columns of trip_columns and disappointment_columns to
+    directory/trips_00000.npz... and directory/disappointments_00000.npz...
+    Batches are held until rows_per_file rows are in, one file per
+    rows_per_file rows, see load_columns.
+    '''
+
+    def __init__(self, directory, rows_per_file=1000000):
+        self.directory = directory
+        self.rows_per_file = rows_per_file
+
+    def open(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # name -> [list of column dicts held, number of rows held, files written]
+        self.pending = {'trips':[[], 0, 0], 'disappointments':[[], 0, 0]}
+
+    def _add(self, name, columns, num_rows):
+        if not num_rows:
+            return
+        pending = self.pending[name]
+        pending[0].append(columns)
+        pending[1] += num_rows
+        if pending[1] >= self.rows_per_file:
+            self._save(name)
+
+    def _save(self, name):
+        batches, num_rows, num_files = self.pending[name]
+        if not num_rows:
+            return
+        path = os.path.join(self.directory, '%s_%05d.npz' % (name, num_files))
+        numpy.savez(path, **{field:numpy.concatenate([b[field] for b in batches])
+                             for field in batches[0]})
+        self.pending[name] = [[], 0, num_files + 1]
+
+    def write(self, time, trips, disappointments):
+        self._add('trips', trip_columns(trips), len(trips))
+        self._add('disappointments', disappointment_columns(disappointments),
+                  len(disappointments))
+
+    def close(self):
+        self._save('trips')
+        self._save('disappointments')
+
+
+def load_columns(directory, name='trips'):
+    '''
+    Concatenates the name (trips or disappointments) files a ColumnSink
+    wrote to directory, as a {field : array} dict
+    '''
+    fields = TRIP_FIELDS if name == 'trips' else DISAPPOINTMENT_FIELDS
+    chunks = [numpy.load(path) for path in
+              sorted(glob.glob(os.path.join(directory, '%s_*.npz' % name)))]
+    if not chunks:
+        return {field:numpy.zeros(0, dtype=numpy.int64) for field in fields}
+    return {field:numpy.concatenate([chunk[field] for chunk in chunks])
+            for field in fields}
+
+
+class AggregateSink(ResultSink):
+    '''
+    Running counts of the run's results, in memory that doesn't grow with
+    the run. The per-station arrays are by station index (see
+    station_dict), [empty, full] arrays are indexed by is_full.
+    '''
+
+    def __init__(self):
+        self.station_index = None
+        self.num_trips = 0
+        self.total_duration = 0
+        self.departures = None
+        self.arrivals = None
+        # Completed trips by start hour of the day
+        self.trip_hours = numpy.zeros(24, dtype=numpy.int64)
+        # [empty, full] disappointments by station / hour of the day
+        self.station_disappointments = None
+        self.hour_disappointments = numpy.zeros((2, 24), dtype=numpy.int64)
+
+    def _start(self, station_index):
+        self.station_index = station_index
+        num_stations = len(station_index)
+        self.departures = numpy.zeros(num_stations, dtype=numpy.int64)
+        self.arrivals = numpy.zeros(num_stations, dtype=numpy.int64)
+        self.station_disappointments = numpy.zeros((2, num_stations), dtype=numpy.int64)
+
+    def write(self, time, trips, disappointments):
+        if self.station_index is None:
+            self._start(trips.station_index)
+        self.num_trips += len(trips)
+        self.total_duration += int(trips.durations().sum())
+        self.departures += trips.departure_counts()
+        self.arrivals += trips.arrival_counts()
+        self.trip_hours += numpy.bincount(trips.start_hours(), minlength=24)
+        self.station_disappointments += disappointments.station_counts
+        self.hour_disappointments += disappointments.hour_counts
+
+    def disappointment_total(self, is_full):
+        return int(self.hour_disappointments[int(is_full)].sum())
+
+    def mean_duration(self):
+        '''Mean length in seconds of the completed trips'''
+        return self.total_duration / float(self.num_trips) if self.num_trips else 0.
+
+    def station_dict(self, values):
+        '''{station id : value} of the nonzero values of a per-station array'''
+        ids = self.station_index.ids.tolist()
+        return {ids[i]:value for i, value in enumerate(values.tolist()) if value}
+
+
+# What QueueSink puts on its queue once the run is over
+END_OF_RUN = None
+
+class QueueSink(ResultSink):
+    '''
+    Puts (time, trips, disappointments) batches on a Queue of at most
+    maxsize batches, for a consumer thread to take (see batches). The run
+    waits for the consumer whenever the queue is full.
+    '''
+
+    def __init__(self, maxsize=16):
+        self.queue = Queue.Queue(maxsize)
+
+    def write(self, time, trips, disappointments):
+        self.queue.put((time, trips, disappointments))
+
+    def close(self):
+        self.queue.put(END_OF_RUN)
+
+    def batches(self):
+        '''Yields the batches as they come, until the run is over'''
+        while True:
+            batch = self.queue.get()
+            if batch is END_OF_RUN:
+                return
+            yield batch
+
+
+def _hour_counts(seconds):
+    '''{hour : count} of epoch seconds, hours as '%Y-%m-%d %H:00:00' strings'''
+    hours, counts = numpy.unique(seconds // 3600 * 3600, return_counts=True)
+    return dict(zip(format_dates(0, hours), counts.tolist()))
+
+class LiveSink(ResultSink):
+    '''
+    Hands partial results of the run to callback while it goes, as dicts
+    of plain (JSON serializable) values, at most every min_interval
+    seconds and once more when the run is over:
+
+        time: simulated time the update goes up to
+        trips: {hour : number of trips completed}, by start hour
+        empty_disappointments, full_disappointments: {hour : number}
+        occupancy: {station id : change in number of bikes}
+
+    Every update only holds what happened since the previous one.
+    '''
+
+    def __init__(self, callback, min_interval=1.):
+        self.callback = callback
+        self.min_interval = min_interval
+        self.sim_logic = None
+
+    def bind(self, sim_logic):
+        self.sim_logic = sim_logic
+
+    def open(self):
+        self.last_update = wall_clock()
+        self.time = None
+        self.last_counts = None
+        if self.sim_logic is not None:
+            self.last_counts = self.sim_logic.station_counts.copy()
+        self._clear()
+
+    def _clear(self):
+        # Epoch seconds of the trips' starts, empty and full disappointments
+        self.trip_starts = []
+        self.empty_times = []
+        self.full_times = []
+
+    def write(self, time, trips, disappointments):
+        self.time = time
+        self.trip_starts.append(trips.origin + trips.start_time)
+        times = disappointments.origin + disappointments.time
+        self.empty_times.append(times[~disappointments.is_full])
+        self.full_times.append(times[disappointments.is_full])
+        if wall_clock() - self.last_update >= self.min_interval:
+            self._send()
+
+    def close(self):
+        self._send()
+
+    def _send(self):
+        # Nothing written since the last update
+        if not self.trip_starts:
+            return
+        update = {'time' : self.time.strftime('%Y-%m-%d %H:%M:%S'),
+                  'trips' : _hour_counts(numpy.concatenate(self.trip_starts)),
+                  'empty_disappointments' : _hour_counts(numpy.concatenate(self.empty_times)),
+                  'full_disappointments' : _hour_counts(numpy.concatenate(self.full_times)),
+                  'occupancy' : {}}
+        if self.last_counts is not None:
+            counts = self.sim_logic.station_counts.copy()
+            changed = numpy.flatnonzero(counts != self.last_counts)
+            ids = self.sim_logic.station_index.ids_of(changed)
+            update['occupancy'] = dict(zip(ids.tolist(),
+                                           (counts - self.last_counts)[changed].tolist()))
+            self.last_counts = counts
+        self._clear()
+        self.last_update = wall_clock()
+        self.callback(update)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+'''
+    shared_models.py
+
+    Named segments of read-only model arrays shared by the simulation
+    worker processes. A segment is a directory of .npy files in shared
+    memory (/dev/shm where available) that every process memory-maps, so
+    N workers hold one copy of the models instead of N.
+
+    Every attached process holds a shared flock on the segment's lock
+    file, which is its reference. When a process releases the segment (at
+    the latest when it exits) and nobody else holds a reference, the
+    segment is removed. Locks go away with their process, so segments of
+    crashed workers are removed by the next publish.
+'''
+from contextlib import contextmanager
+from multiprocessing.util import Finalize
+import fcntl
+import numpy
+import os
+import shutil
+import tempfile
+
+if os.path.isdir('/dev/shm'):
+    SHM_DIR = '/dev/shm'
+else:
+    SHM_DIR = tempfile.gettempdir()
+SHM_DIR = os.environ.get('SIMBA_SHM_DIR', SHM_DIR)
+SEGMENT_PREFIX = 'simba-models-'
+LOCK_FILE = 'lock'
+# Only present while the segment can be attached
+READY_FILE = 'ready'
+
+
+class SharedModels:
+
+    def __init__(self, name, directory=SHM_DIR):
+        self.name = name
+        self.directory = directory
+        self.path = os.path.join(directory, SEGMENT_PREFIX + name)
+        # Open while attached, holds our reference
+        self._lock_file = None
+        self._finalizer = None
+
+    def attach(self):
+        '''
+        The arrays of the segment (name -> read-only memory-mapped array),
+        or None if nobody published it. Holds a reference until release.
+        '''
+        self.release()
+        try:
+            lock_file = open(os.path.join(self.path, LOCK_FILE))
+        except IOError:
+            return None
+        fcntl.flock(lock_file, fcntl.LOCK_SH)
+        if not os.path.exists(os.path.join(self.path, READY_FILE)):
+            # Removed by its last user in the meantime
+            lock_file.close()
+            return None
+        self._lock_file = lock_file
+        self._finalizer = Finalize(self, self.release, exitpriority=10)
+        return {f[:-len('.npy')]:_load_array(os.path.join(self.path, f))
+                for f in os.listdir(self.path) if f.endswith('.npy')}
+
+    def publish(self, arrays):
+        '''
+        Writes arrays (name -> array) to the segment and attaches it. If
+        another process published it first, attaches that one instead.
+        '''
+        sweep(self.directory)
+        temp_path = tempfile.mkdtemp(prefix='.' + SEGMENT_PREFIX, dir=self.directory)
+        for name, array in arrays.iteritems():
+            numpy.save(os.path.join(temp_path, name + '.npy'), array)
+        open(os.path.join(temp_path, LOCK_FILE), 'w').close()
+        open(os.path.join(temp_path, READY_FILE), 'w').close()
+        try:
+            os.rename(temp_path, self.path)
+        except OSError:
+            shutil.rmtree(temp_path, ignore_errors=True)
+        return self.attach()
+
+    @contextmanager
+    def loading(self):
+        '''
+        Exclusive lock to hold while loading the models to publish, so
+        concurrent workers wait and attach them instead of all loading.
+        '''
+        with open(self.path + '.loading', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def release(self):
+        '''Drops this process' reference, removes the segment if it was the last one'''
+        if self._lock_file is None:
+            return
+        self._lock_file.close()
+        self._lock_file = None
+        self._finalizer.cancel()
+        self._finalizer = None
+        remove_if_unused(self.path)
+
+
+def _load_array(file_name):
+    try:
+        return numpy.load(file_name, mmap_mode='r')
+    except ValueError:
+        # Empty arrays can't be memory-mapped
+        return numpy.load(file_name)
+
+def remove_if_unused(path):
+    '''Removes the segment at path if no process holds a reference to it'''
+    try:
+        lock_file = open(os.path.join(path, LOCK_FILE))
+    except IOError:
+        return
+    try:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            # Still attached somewhere
+            return
+        if not os.path.exists(os.path.join(path, READY_FILE)):
+            # Removed by another process meanwhile
+            return
+        os.remove(os.path.join(path, READY_FILE))
+        shutil.rmtree(path, ignore_errors=True)
+        if os.path.exists(path + '.loading'):
+            os.remove(path + '.loading')
+    finally:
+        lock_file.close()
+
+def sweep(directory=SHM_DIR):
+    '''Removes the segments nobody is attached to, e.g. left by crashed workers'''
+    for name in os.listdir(directory):
+        if name.startswith(SEGMENT_PREFIX) and not name.endswith('.loading'):
+            remove_if_unused(os.path.join(directory, name))
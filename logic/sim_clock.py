@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+'''
+    sim_clock.py
+
+    The simulation runs on integer seconds since its start time. SimClock
+    converts between those and datetimes, and keeps a table of the
+    (year, month, weekday, hour) of every wall-clock hour the simulation
+    reaches so the logics never need datetime arithmetic while stepping.
+
+    Datetimes are naive and read as UTC, i.e. epoch_seconds and
+    from_epoch_seconds round trip without any timezone shift.
+'''
+import calendar
+import datetime
+
+EPOCH = datetime.datetime(1970, 1, 1)
+HOUR = 3600
+
+def epoch_seconds(time):
+    '''Whole seconds between EPOCH and a naive datetime'''
+    return calendar.timegm(time.timetuple())
+
+def from_epoch_seconds(seconds):
+    return EPOCH + datetime.timedelta(seconds=int(seconds))
+
+
+class SimClock:
+
+    def __init__(self, start_time, end_time=None):
+        self.start_time = start_time
+        # Epoch seconds of the simulation's second 0
+        self.origin = epoch_seconds(start_time)
+        # Seconds between the top of start_time's hour and start_time
+        self.hour_offset = self.origin % HOUR
+        # (year, month, weekday, hour) of every wall-clock hour, starting
+        # with the one start_time falls in
+        self.hour_table = []
+        if end_time is not None:
+            self._extend(self.hour_index(self.seconds(end_time)) + 1)
+
+    def _extend(self, num_hours):
+        first_hour = from_epoch_seconds(self.origin - self.hour_offset)
+        for i in xrange(len(self.hour_table), num_hours):
+            t = first_hour + datetime.timedelta(seconds=i * HOUR)
+            self.hour_table.append((t.year, t.month, t.weekday(), t.hour))
+
+    def seconds(self, time):
+        '''Simulation seconds of a datetime'''
+        return epoch_seconds(time) - self.origin
+
+    def to_datetime(self, seconds):
+        return from_epoch_seconds(self.origin + seconds)
+
+    def hour_index(self, seconds):
+        '''Position in hour_table of the hour containing the given second'''
+        return (int(seconds) + self.hour_offset) // HOUR
+
+    def hour_start(self, seconds):
+        '''Simulation seconds of the top of the hour containing the given second'''
+        seconds = int(seconds)
+        return seconds - (seconds + self.hour_offset) % HOUR
+
+    def hour_key(self, seconds):
+        '''(year, month, weekday, hour) of the hour containing the given second'''
+        idx = self.hour_index(seconds)
+        if idx >= len(self.hour_table):
+            self._extend(idx + 1)
+        return self.hour_table[idx]
@@ -12,98 +12,178 @@ import Queue
 import random
 import datetime
 import operator as op
+import copy
+from event_calendar import make_calendar, HEAP_CALENDAR
+from station_index import StationIndex
+from trip_buffer import *
+from sim_clock import SimClock
+from random_streams import *
+from snapshot import *
+from model_artifacts import ModelArtifacts
+from shared_models import SharedModels
+from nearest_stations import StationDistances
+from fill_levels import FillLevels
+from disappointment_log import DisappointmentLog, COLUMNS as DISAPPOINTMENT_COLUMNS
+from data_collection.occupancy_rollup import hourly_occupancy, max_fleet_size, mean_std
+import hashlib
 # # Might need to move this to simulator eventually
 
 DEPARTURE_TYPE = 0
 ARRIVAL_TYPE = 1
+# Rebalancing deadline of a full/empty station. Sorts first so stations
+# are rebalanced before the trips of the same second are resolved.
+REBALANCE_TYPE = -1
 DEBUG = False
+# Least number of resolved trips worth compacting self.trips for, see
+# discard_resolved_trips
+MIN_DISCARDED_TRIPS = 4096
 
 class SimulationLogic:
 
+    # Attributes holding plain data (numbers, arrays, lists, dicts) that
+    # make up the state of a run and are copied as is by snapshot
+    SNAPSHOT_ATTRIBUTES = ['now', 'start_time', 'end_time', 'models_key',
+                           'station_counts', 'station_caps', 'unavailable_stations',
+                           'total_num_bikes',
+                           'nearest_stations', 'events_resolved', 'trip_disappointments',
+                           'bike_shortages', 'dock_shortages', 'rebalancing_time',
+                           'total_rebalances', 'moving_bikes']
+    # Model types (see ModelArtifacts) the logic's models are built from
+    MODEL_TYPES = []
+
     def __init__(self, session):
 
         # For database connectivity
         self.session = session
-        # self.time is a datetime, representing the current time in the simulator.
-        self.time = None
+        # Trained model tables, compiled to local binary artifacts
+        self.model_artifacts = ModelArtifacts(session)
+        # Whether loaded models are shared with other processes, see
+        # ensure_models. Set in simulation worker processes.
+        self.share_models = False
+        # SharedModels segment the models are attached to
+        self.shared_models = None
+        # Converts between datetimes and the simulation's integer seconds
+        self.clock = None
+        # Where all random draws come from, see RandomStreams
+        self.random_streams = None
+        # self.now is the current time in the simulator, in seconds since start_time.
+        # All event and station times are kept in these seconds.
+        self.now = None
         self.start_time = None
         self.end_time = None
 
         # STATION STATES
         # s_id -> station object
         self.stations = {}
-        # {stID : station's bike count at self.time}
-        self.station_counts = {}
-        # Another dictionary?! YES. Rather than accidentally mess up the 
-        # capacities in the database we will store off capacities here.
-        # Too easy for a commit to overwrite DB.
-        self.station_caps = {}
-        
-        # Pending departures/arrivals includes tuples (endTime, trip)
-        self.pending_departures = Queue.PriorityQueue()
-        self.pending_arrivals = Queue.PriorityQueue()
-        # Contains all resolved trips
-        self.trip_list = []
-        self.disappointments = []
-        self.full_station_disappointments = []
-        self.empty_station_disappointments = []
+        # Distances between all stations, see StationDistances
+        self.station_distances = None
+        # Maps station ids to dense indexes, set once stations are loaded.
+        # All per-station state below is an array over those indexes.
+        self.station_index = None
+        # Station's bike count at self.now
+        self.station_counts = None
+        # Rather than accidentally mess up the capacities in the database
+        # we will store off capacities here. Too easy for a commit to overwrite DB.
+        self.station_caps = None
+
+        # Pending departures and arrivals, ordered by event time.
+        # Events refer to trips by their row in self.trips
+        self.event_calendar = make_calendar(HEAP_CALENDAR)
+        self.events_resolved = 0
+        # Contains all generated trips, see TripBuffer for their status
+        self.trips = None
+        # trip row -> set of stations it found full, for rerouting
+        self.trip_disappointments = {}
+        # Every full/empty station disappointment, with their counts by
+        # station and hour, see DisappointmentLog
+        self.disappointment_log = None
+        # Rows of the trips completed since the last take_results, None
+        # unless results are streamed, see stream_results
+        self.completed_rows = None
+        # Disappointments logged before that row were already taken
+        self.taken_disappointments = 0
+        # Whether the run keeps the results it hands out, see stream_results
+        self.retain_results = True
 
         # List of trips that didn't end at the desired station due to a shortage
         self.bike_shortages = []
         self.dock_shortages = []
 
-        # Max time which we allow a station to be empty/full
+        # Max time (seconds) which we allow a station to be empty/full
         self.rebalancing_time = None
         self.total_rebalances = 0
-        # Keys: all currently empty/full station ids. Values: empty or full
+        # (time, station index) of all currently empty/full stations
         # Priority queue will allow us to designate how long a bike station remains unavailable
         self.full_stations = Queue.PriorityQueue()
         self.empty_stations = Queue.PriorityQueue()
-        # Don't necessarily care which it is, just want to make sure we don't want 
-        # to keep adding/removing it
-        self.unavailable_stations = set()
-
-        self.arr_dis_stations = {}
-        self.dep_dis_stations = {}
+        # Stations by spare capacity, where rebalancing takes bikes from
+        self.fill_levels = None
+        # True for stations that are either empty or full. Don't necessarily
+        # care which it is, just want to make sure we don't want to keep
+        # adding/removing it
+        self.unavailable_stations = None
         self.total_num_bikes = -1
 
+        # What the loaded models (lambdas, gammas...) were loaded for, so
+        # repeated runs of the same scenario don't query them again
+        self.models_key = None
+        self.loaded_models_key = None
+        # Training versions of the loaded models, see model_versions
+        self.loaded_model_versions = None
+        # Keyword arguments of the last initialize, kept for snapshots
+        self.options = {}
+
     def getDBSession(self):
         return self.session
 
     def initialize(self, start_time, end_time, 
                     rebalancing_time=datetime.timedelta(seconds=7200),
-                    bike_total=None, station_caps={}, drop_stations=[]):#32006, 31062, 31063, 31064, 31065, 31066, 31269, 31270, 31513, 31271, 31272, 31633, 31514, 31067, 31068, 31069, 32001, 32002, 32003, 32004, 32005, 32000, 32007, 32008, 32009, 32010, 32011, 32012, 32013, 32014, 31119, 31634, 31120, 31635, 32015, 32016, 32020, 32021, 32023, 31118, 32018]):
+                    bike_total=None, station_caps={}, drop_stations=[],
+                    calendar_type=HEAP_CALENDAR, rng_seed=None, antithetic=False):#32006, 31062, 31063, 31064, 31065, 31066, 31269, 31270, 31513, 31271, 31272, 31633, 31514, 31067, 31068, 31069, 32001, 32002, 32003, 32004, 32005, 32000, 32007, 32008, 32009, 32010, 32011, 32012, 32013, 32014, 31119, 31634, 31120, 31635, 32015, 32016, 32020, 32021, 32023, 31118, 32018]):
         '''
         Sets states of stations at the start_time
+        calendar_type: which EventCalendar backend holds pending events
+        rng_seed: seed of the RandomStreams. Runs of different scenarios with
+            the same seed share their random numbers. Drawn from numpy.random
+            if None.
+        antithetic: whether to use the antithetic numbers of rng_seed
         '''
-        self.time = start_time
+        if rng_seed is None:
+            rng_seed = numpy.random.randint(2**31 - 1)
+        self.options = {'rebalancing_time':rebalancing_time, 'bike_total':bike_total,
+                        'station_caps':station_caps, 'drop_stations':drop_stations,
+                        'calendar_type':calendar_type, 'rng_seed':rng_seed,
+                        'antithetic':antithetic}
+        self.random_streams = RandomStreams(rng_seed, antithetic)
+        self.clock = SimClock(start_time, end_time)
+        self.now = 0
 
         self.start_time = start_time
         self.end_time = end_time
     
         self.total_rebalances = 0
-        # Keys: all station ids. Values: number of disappointments
-        self.arr_dis_stations = {}
-        self.dep_dis_stations = {}
-
         self.total_num_bikes = -1
+        # Bikes taken away by rebalancing and not given back yet
+        self.moving_bikes = 0
 
 
-        self.pending_departures = Queue.PriorityQueue()
-        self.pending_arrivals = Queue.PriorityQueue()
-        self.trip_list = []
-        self.full_station_disappointments = []
-        self.empty_station_disappointments = []
+        self.event_calendar = make_calendar(calendar_type)
+        self.events_resolved = 0
+        self.trip_disappointments = {}
+        # Defaults to instant rebalancing
+        self.rebalancing_time = int(rebalancing_time.total_seconds())
         print "\tInitializing stations"
         # Make sure all stations are initialized correctly
-        self.stations = {}
-        self.station_counts = {}
-        self.station_caps = station_caps
+        self.full_stations = Queue.PriorityQueue()
+        self.empty_stations = Queue.PriorityQueue()
         self._initialize_stations(start_time, bike_total,
                                   station_caps, drop_stations)
+        self.trips = TripBuffer(self.station_index, self.clock.origin)
+        self.disappointment_log = DisappointmentLog(self.station_index, self.clock.origin)
+        self.completed_rows = None
+        self.retain_results = True
+        self.models_key = (start_time, end_time, tuple(self.station_index.ids.tolist()))
         self._initialize_station_distances()
-        # Defaults to instant rebalancing
-        self.rebalancing_time = rebalancing_time
 
     def _get_total_num_bikes(self):
         '''
@@ -112,25 +192,86 @@ class SimulationLogic:
         '''
         # Check the days we have  and grab the largest count
         # provides a good upperbound on the total number of bikes
-        max_bike_count= max(self.session.query(func.sum(StationStatus.bike_count))\
-                .group_by(StationStatus.status_group_id).all())[0]
-        return max_bike_count
+        return max_fleet_size(self.session)
      
-    def _get_station_cap(self, s_id):
-        return self.station_caps[s_id]
+    def model_versions(self):
+        '''Training versions of the logic's MODEL_TYPES, see ModelArtifacts'''
+        return [self.model_artifacts.training_version(model_type)
+                for model_type in self.MODEL_TYPES]
+
+    def models_loaded(self, versions=None):
+        '''
+        True if the models of a previous initialize apply to this run as
+        well, and weren't retrained since. versions: model_versions, if
+        already known
+        '''
+        if versions is None:
+            versions = self.model_versions()
+        return self.loaded_models_key == self.models_key\
+               and self.loaded_model_versions == versions
+
+    def ensure_models(self, start_time, end_time):
+        '''
+        Loads the models of the run unless they are loaded already, and
+        loads them again once they're retrained. With share_models, the
+        models are attached from a SharedModels segment if another process
+        published them, else loaded and published.
+        '''
+        versions = self.model_versions()
+        if self.models_loaded(versions):
+            return
+        if self.shared_models is not None:
+            self.shared_models.release()
+            self.shared_models = None
+        if not self.share_models:
+            self.load_models(start_time, end_time)
+            self.loaded_models_key = self.models_key
+            self.loaded_model_versions = versions
+            return
+
+        segment = SharedModels(self.models_segment_name(versions))
+        arrays = segment.attach()
+        if arrays is None:
+            with segment.loading():
+                # Published while we were waiting?
+                arrays = segment.attach()
+                if arrays is None:
+                    self.load_models(start_time, end_time)
+                    arrays = segment.publish(self.model_arrays())
+        if arrays is not None:
+            # Even the publisher uses the shared copy and drops its own
+            self.set_model_arrays(arrays)
+            self.shared_models = segment
+        self.loaded_models_key = self.models_key
+        self.loaded_model_versions = versions
+
+    def models_segment_name(self, versions):
+        '''Name of the SharedModels segment of the models of this run'''
+        key = repr((self.__class__.__name__, self.models_key, versions))
+        return hashlib.sha1(key).hexdigest()
+
+    def load_models(self, start_time, end_time):
+        '''Loads the logic's models (lambdas, gammas...) for the run'''
+        pass
+
+    def model_arrays(self):
+        '''The loaded models as arrays (name -> array), see set_model_arrays'''
+        return {}
+
+    def set_model_arrays(self, arrays):
+        '''Uses the models of model_arrays, typically attached from shared memory'''
+        pass
+
+    def _get_station_cap(self, s_idx):
+        return self.station_caps[s_idx]
 
     def _initialize_station_distances(self, nearest=8):
-        # Retrieve StationDistance objects representing the five closest
-        # stations for each stations.
-        self.nearest_station_dists = {}
-        station_ids = self.stations.keys()
-        for s_id in station_ids:
-            nearest_distances = self.session.query(StationDistance)\
-                    .filter(StationDistance.station1_id == s_id)\
-                    .filter(StationDistance.station1_id.in_(station_ids))\
-                    .filter(StationDistance.station2_id.in_(station_ids))\
-                    .order_by(StationDistance.distance)[:8]
-            self.nearest_station_dists[s_id] = nearest_distances
+        # The closest stations of every station, from the distances
+        # loaded by the first initialize.
+        if self.station_distances is None:
+            self.station_distances = StationDistances.load(self.session)
+        # Station index -> indexes of its nearest stations, closest first
+        self.nearest_stations = self.station_distances.nearest(self.station_index, nearest)
 
 
     def _initialize_stations(self, start_time, bike_total, 
@@ -157,260 +298,278 @@ class SimulationLogic:
                                    .filter(~Station.id.in_(drop_stations))
         else:
             stations = self.session.query(Station)
-        for s in stations:
+        self.stations = {s.id:s for s in stations}
+        self.station_index = StationIndex(self.stations.keys())
+        num_stations = len(self.station_index)
+        self.station_counts = numpy.zeros(num_stations, dtype=numpy.int64)
+        self.station_caps = numpy.zeros(num_stations, dtype=numpy.int64)
+        self.unavailable_stations = numpy.zeros(num_stations, dtype=bool)
+
+        # The cron_job now has hourly data (more or less)
+        occupancy = hourly_occupancy(self.session, start_hour)
+        for s_idx, s_id in enumerate(self.station_index.ids.tolist()):
+            s = self.stations[s_id]
             # Initialize capacity
             if s.id in station_caps:
                 s_cap = station_caps[s.id]
             else:
                 s_cap = s.capacity
             
-            # The cron_job now has hourly data (more or less)
-            bike_counts = list(self.session.query(StationStatus.bike_count)\
-                    .filter(StationStatus.station_id == s.id)\
-                    .join(StatusGroup, aliased=True)\
-                    .filter(extract('hour', StatusGroup.time) == start_hour))
-            
-            avg_count = numpy.average(bike_counts)
-            std_count = numpy.std(bike_counts)
-
-            if len(bike_counts) > 0:
-                count = int(random.gauss(avg_count, std_count))
+            if s.id in occupancy:
+                avg_count, std_count = mean_std(*occupancy[s.id])
+                count = int(self.random_streams.normal(INITIAL_COUNTS, avg_count, std_count, s.id))
                 if count > s_cap:
                     count = s_cap
                 elif count < 0:
                     count = 0
             else:
                 print 'Error initializing stations, unknown station'
-                count = random.randint(0, s_cap)
+                count = self.random_streams.integer(INITIAL_COUNTS, s_cap + 1, s.id)
             distributed_bikes += count
-            self.stations[s.id] = s
-            self.station_counts[s.id] = count
-            self.station_caps[s.id] = s_cap
+            self.station_counts[s_idx] = count
+            self.station_caps[s_idx] = s_cap
         # If we distribute too many bikes, reclaim them, otherwise redistribute more bikes
         bike_delta = bike_total - distributed_bikes
-
-        # We need to distribute integer numbers (either pos or neg) so we need 
-        # to sleect the correct function to distribute the greatest value from 0
-        round_func = math.ceil
-        if bike_delta < 0:
-            round_func = math.floor
-        
-        # Don't keep trying to reassign bikes to full stations
-        full_stations = set()
-        while bike_delta > 0 and len(full_stations) < len(self.stations): 
-            # Determine the proportion of bikes to add to each station based on percentage of total
-            bike_sum = sum([s_count for s_id, s_count in 
-                            self.station_counts.iteritems() 
-                            if s_id not  in full_stations])
-            # Some stations had no bikes originally distributed to them. 
-            # Evenly distribute them across all remaining stations
-            if bike_sum == 0:
-                # Rare case
-                station_bike_prop = {s_id:1./(len(self.stations)-len(full_stations))
-                                      for s_id, s_count in self.station_counts.iteritems()
-                                      if s_id not in full_stations}
-
-            else:
-                station_bike_prop = {s_id:float(s_count)/bike_sum
-                                        for s_id, s_count in self.station_counts.iteritems()
-                                             if s_id not in full_stations}
-            for s_id, prop in station_bike_prop.iteritems():
-                added_bikes = int(round_func(prop * bike_delta))
-                s = self.stations[s_id]
-                # if you can't add the desired proportion, add as much as you can
-                if added_bikes + self.station_counts[s.id] >= self._get_station_cap(s_id):
-                    added_bikes = self._get_station_cap(s_id)  - self.station_counts[s.id]
-                    # If cap=count, the station is full and we shouldn't consider it in the future
-                    if added_bikes == 0:
-                        full_stations.add(s.id)
-
-                bike_delta -= added_bikes
-                self.station_counts[s.id] += added_bikes
-
+        self.station_counts, bike_delta = distribute_bikes(self.station_counts,
+                                                           self.station_caps, bike_delta)
         if bike_delta > 0:
             print "WARNING: Number bikes exceed summed capacities across all stations"
-    
-        for s_id, s in self.stations.iteritems():
-            if self._get_station_cap(s_id) <= self.station_counts[s_id]:
-                print "\t\tFull station ",s_id, self._get_station_cap(s_id), self.station_counts[s.id]
+        # Stations that start full, cap=0 ones included
+        full_stations = self.station_counts >= self.station_caps
+
+        for s_idx in numpy.flatnonzero(self.station_caps <= self.station_counts):
+            print "\t\tFull station ", self.station_index.id_of(s_idx), self.station_caps[s_idx], self.station_counts[s_idx]
 
-        for s_id in full_stations:
-            self.unavailable_stations.add(s_id)
-            self.full_stations.put((self.time, s_id))
+        for s_idx in numpy.flatnonzero(full_stations).tolist():
+            self.mark_full(s_idx, self.now)
 
-        for s_id, count in self.station_counts.iteritems():
-            # The second condition is to deal with the cap=0 case
-            if count == 0 and s_id not in self.unavailable_stations:
-                self.unavailable_stations.add(s_id)
-                self.empty_stations.put((self.time, s_id))
+        # The second condition is to deal with the cap=0 case
+        for s_idx in numpy.flatnonzero((self.station_counts == 0) & ~self.unavailable_stations).tolist():
+            self.mark_empty(s_idx, self.now)
+        self.fill_levels = FillLevels(self.station_caps - self.station_counts)
 
         if DEBUG:
-            for s_id, count in self.station_counts.iteritems():
-                assert 0 <= count <= self._get_station_cap(s_id)    
+            self.check_station_invariants()
+
+    def check_station_invariants(self):
+        '''Asserts counts are within capacities and no station is both empty and full'''
+        assert ((0 <= self.station_counts) & (self.station_counts <= self.station_caps)).all()
+        in_both = numpy.intersect1d([s_idx for t, s_idx in self.full_stations.queue],
+                                    [s_idx for t, s_idx in self.empty_stations.queue])
+        assert len(in_both) == 0
 
 
     def update(self, timestep):
         '''Moves the simulation forward one timestep from given time'''
-        self.generate_new_trips(self.time)
-        self.time += timestep
+        self.generate_new_trips(self.now)
+        self.now += int(timestep.total_seconds())
         self.resolve_trips()
 
         
-    def generate_new_trips(self, timestep):
+    def generate_new_trips(self, hour_start):
         '''Generates trips COMPLETELY RANDOMLY WOOO'''
-        for station in self.station_counts:
-            num_trips = random.randint(0, self.station_counts[station])
+        num_stations = len(self.station_index)
+        for s_idx in range(num_stations):
+            num_trips = random.randint(0, self.station_counts[s_idx])
             for i in range(num_trips):
-                end_station_ID = random.choice(self.station_counts.keys())
-                start_time = self.time + datetime.timedelta(minutes=random.randint(0, timestep.total_seconds()/60))
+                end_idx = random.randrange(num_stations)
+                start_time = hour_start + random.randint(0, 60) * 60
                 # Nobody takes longer than 2 hours to bike anywhere, duh!
-                end_time = start_time + datetime.timedelta(minutes=random.randint(0, 120))
-                new_trip = data_model.Trip(str(random.randint(1,500)), "Casual", "Produced", start_time, end_time, station, end_station_ID)
-                self.pending_departures.put((start_time, new_trip))
+                end_time = start_time + random.randint(0, 120) * 60
+                row = self.trips.append(s_idx, end_idx, start_time, end_time)
+                self.schedule_departure(row)
 
+    def schedule_departure(self, row):
+        self.event_calendar.push(int(self.trips.start_time[row]), DEPARTURE_TYPE, row)
 
-    def resolve_trips(self):
-        '''Resolves departures & arrivals within the current time interval'''
+    def schedule_arrival(self, row):
+        self.event_calendar.push(int(self.trips.end_time[row]), ARRIVAL_TYPE, row)
+
+    def schedule_trip_batch(self, start_time, start_idx, end_idx,
+                            shapes, scales, period=3600):
+        '''
+        Adds one trip per entry of the given (parallel) arrays of station
+        indexes and gamma parameters to self.trips and schedules their
+        departures. Start times within [start_time, start_time + period)
+        seconds and gamma trip durations are drawn for the whole batch at once,
+        keyed by station pair, start_time and occurrence of the pair.
+        '''
+        num_trips = len(start_idx)
+        if not num_trips:
+            return
+        keys = (self.station_index.ids_of(start_idx), self.station_index.ids_of(end_idx),
+                self.clock.origin + start_time)
+        keys += (occurrences(*keys[:2]),)
+        offsets = self.random_streams.integers(START_OFFSETS, period, *keys)
+        durations = self.draw_trip_durations(shapes, scales, *keys).astype(numpy.int64)
+
+        # Ordering by offset orders by start time, the calendar can take it as is
+        order = numpy.argsort(offsets, kind='mergesort')
+        trip_start_times = start_time + offsets[order]
+        first_row = self.trips.extend(numpy.asarray(start_idx)[order],
+                                      numpy.asarray(end_idx)[order],
+                                      trip_start_times,
+                                      trip_start_times + durations[order])
+        self.event_calendar.push_sorted(
+                (trip_start, DEPARTURE_TYPE, first_row + i)
+                for i, trip_start in enumerate(trip_start_times.tolist()))
+
+    def get_trip_duration(self, gamma, *keys):
+        '''
+        Samples from a gamma distribution and returns a trip length in
+        whole seconds, keys identify the draw (see RandomStreams)
+        '''
+        #TODO Fix this
+        if gamma.shape <= 0 or gamma.scale <= 0:
+            return 0
+        return int(self.random_streams.gamma(DURATIONS, gamma.shape, gamma.scale, *keys))
+
+    def draw_trip_durations(self, shapes, scales, *keys):
+        '''
+        Vectorized version of get_trip_duration, returns trip lengths in seconds.
+        Trips with invalid gamma parameters take no time.
+        '''
+        shapes = numpy.asarray(shapes, dtype=float)
+        scales = numpy.asarray(scales, dtype=float)
+        valid = (shapes > 0) & (scales > 0)
+        with numpy.errstate(invalid='ignore'):
+            durations = self.random_streams.gammas(DURATIONS, shapes, scales, *keys)
+        durations[~valid] = 0
+        return durations
 
-        # Get the first event, be it a departure or arrival.
-        eventTuple = self.get_first_trip_event()
-        eventType = eventTuple[0]
-        trip = eventTuple[1]
-        while eventType != None:
-            # This is kind of gross, we just get the current time from the current trip...
-            if eventType == DEPARTURE_TYPE:
-                self.rebalance_stations(trip.start_date)
-                if trip.start_date > self.time:
-                    # Put trip back in proper queue if it's over the time, and stop the while loop
-                    self.pending_departures.put((trip.start_date, trip))
-                    break
-                else:
-                    self.resolve_departure(trip)
-            elif eventType == ARRIVAL_TYPE:
-                self.rebalance_stations(trip.end_date)
-                if trip.end_date > self.time:
-                    self.pending_arrivals.put((trip.end_date, trip))
-                    break
-                else:
-                    self.resolve_arrival(trip)
 
-            eventTuple = self.get_first_trip_event()
-            eventType = eventTuple[0]
-            trip = eventTuple[1]
+    def resolve_trips(self):
+        '''Resolves departures & arrivals within the current time interval'''
+        calendar = self.event_calendar
+        while not calendar.empty():
+            event_time = calendar.peek_time()
+            # Leave anything past the current time for the next timestep
+            if event_time > self.now:
+                break
+            event_time, event_type, trip = calendar.pop()
+            if event_type == REBALANCE_TYPE:
+                self.rebalance_stations(event_time)
+                continue
+            if event_type == DEPARTURE_TYPE:
+                self.resolve_departure(trip)
+            else:
+                self.resolve_arrival(trip)
+            self.events_resolved += 1
             
         
-    def resolve_departure(self, trip):
-        '''Decrement station count, put in pending_arrivals queue. If station is empty, put it in the disappointments list.'''
-        departure_station_ID = trip.start_station_id
-
-        if self.station_counts[departure_station_ID] < 1:
-            new_disappointment = Disappointment(departure_station_ID, trip.start_date, trip_id=None, is_full=False)
-            self.session.add(new_disappointment) # ??????
-            self.dep_dis_stations[departure_station_ID] = self.dep_dis_stations.get(departure_station_ID, 0) + 1
-            self.empty_station_disappointments.append(new_disappointment)
-            self.resolve_sad_departure(trip)
+    def resolve_departure(self, row):
+        '''Decrement station count, schedule its arrival. If station is empty, log a disappointment.'''
+        trips = self.trips
+        s_idx = trips.start_station[row]
+
+        if self.station_counts[s_idx] < 1:
+            trips.status[row] = TRIP_NO_BIKE
+            self.disappointment_log.append(s_idx, int(trips.start_time[row]), False, row)
+            self.resolve_sad_departure(row)
         else:
-            self.station_counts[departure_station_ID] -= 1
-            self.pending_arrivals.put((trip.end_date, trip))
+            trips.status[row] = TRIP_RIDING
+            self.station_counts[s_idx] -= 1
+            self.count_changed(s_idx)
+            self.schedule_arrival(row)
 
             # Perfect time to denote a now empty station
-            if self.station_counts[departure_station_ID] <= 0\
-                   and not departure_station_ID in self.unavailable_stations:
-                self.unavailable_stations.add(departure_station_ID)
-                self.empty_stations.put((trip.start_date, departure_station_ID))
+            if self.station_counts[s_idx] <= 0\
+                   and not self.unavailable_stations[s_idx]:
+                self.mark_empty(s_idx, int(trips.start_time[row]))
 
             
-    def resolve_sad_departure(self, trip):
+    def resolve_sad_departure(self, row):
         '''When you want a bike but the station is empty'''
         pass #station_caps
 
 
-    def resolve_arrival(self, trip):
-        '''Increment station count, put in trips list. If desired station is full, add a disappointment, set a new end station, and try again.'''
-        arrival_station_ID = trip.end_station_id
+    def resolve_arrival(self, row):
+        '''Increment station count, mark the trip completed. If desired station is full, add a disappointment, set a new end station, and try again.'''
+        trips = self.trips
+        s_idx = trips.end_station[row]
 
-        capacity = self._get_station_cap(arrival_station_ID)
-        if self.station_counts[arrival_station_ID] >= capacity:
-            new_disappointment = Disappointment(arrival_station_ID, trip.end_date, trip_id=None, is_full=True)
-            self.arr_dis_stations[arrival_station_ID] = self.arr_dis_stations.get(arrival_station_ID, 0) + 1
-            self.full_station_disappointments.append(new_disappointment)
-            self.resolve_sad_arrival(trip)
+        capacity = self.station_caps[s_idx]
+        if self.station_counts[s_idx] >= capacity:
+            self.disappointment_log.append(s_idx, int(trips.end_time[row]), True, row)
+            self.trip_disappointments.setdefault(row, set()).add(s_idx)
+            self.resolve_sad_arrival(row)
         else:
-            self.station_counts[arrival_station_ID] += 1
-            self.trip_list.append(trip)
+            self.station_counts[s_idx] += 1
+            self.count_changed(s_idx)
+            trips.status[row] = TRIP_COMPLETED
+            self.trip_disappointments.pop(row, None)
+            if self.completed_rows is not None:
+                self.completed_rows.append(row)
 
             # Check here to see if it's full for rebalancing to work perfectly
-            if self.station_counts[arrival_station_ID] >= capacity\
-                    and not arrival_station_ID in self.unavailable_stations:
-                self.unavailable_stations.add(arrival_station_ID)
-                self.full_stations.put((trip.end_date, arrival_station_ID))
+            if self.station_counts[s_idx] >= capacity\
+                    and not self.unavailable_stations[s_idx]:
+                self.mark_full(s_idx, int(trips.end_time[row]))
 
 
-    def resolve_sad_arrival(self, trip):
+    def resolve_sad_arrival(self, row):
         '''When you want to drop off a bike but the station is full'''
-        station_list_index = 0
-        nearest_station = self.nearest_station_dists.get(trip.end_station_id)[station_list_index].station2_id
-        visited_stations = [disappointment.station_id for disappointment in trip.disappointments]
-        while nearest_station in visited_stations:
-            station_list_index+=1
-            nearest_station = self.nearest_station_dists.get(trip.end_station_id)[station_list_index].station2_id
-        
-        gamma = self.duration_distrs.get((trip.end_station_id, nearest_station), None)
-        if gamma:
-            trip.end_station_id = nearest_station
-            trip_duration = self.get_trip_duration(gamma)
-            trip.end_date += trip_duration
-            self.pending_arrivals.put((trip.end_date, trip))
+        trips = self.trips
+        end_idx = trips.end_station[row]
+        visited_stations = self.trip_disappointments.get(row, ())
+        nearest_idx = None
+        for s_idx in self.nearest_stations[end_idx]:
+            if s_idx not in visited_stations:
+                nearest_idx = s_idx
+                break
 
-    def get_first_trip_event(self):
-        '''Returns a tuple for the first departure or arrival's trip including (type of event, trip). Type of event is either departure, arrival, or None.'''
-        
-        if self.pending_departures.empty() and self.pending_arrivals.empty():
-            trip = None
-            eventType = None
-        elif self.pending_arrivals.empty():
-            trip = self.pending_departures.get()[1]
-            eventType = DEPARTURE_TYPE
-        elif self.pending_departures.empty():
-            trip = self.pending_arrivals.get()[1]
-            eventType = ARRIVAL_TYPE
+        gamma = None
+        if nearest_idx is not None:
+            end_id = self.station_index.id_of(end_idx)
+            nearest_id = self.station_index.id_of(nearest_idx)
+            gamma = self.duration_distrs.get((end_id, nearest_id), None)
+        if gamma:
+            trips.end_station[row] = nearest_idx
+            trips.end_time[row] += self.get_trip_duration(gamma, end_id, nearest_id,
+                                                          self.clock.origin + trips.end_time[row])
+            self.schedule_arrival(row)
         else:
-            # Peek at the first elements of both queues
-            first_departure = self.pending_departures.queue[0][1]
-            first_arrival = self.pending_arrivals.queue[0][1]
-
-            # If a departure and arrival happen at the exact same time, departures resolve first. This decision was completely arbitrary.
-            if (first_departure.start_date <= first_arrival.end_date):
-                trip = first_departure
-                eventType = DEPARTURE_TYPE
-                # Remove departure from q
-                self.pending_departures.get()
-            else:
-                trip = first_arrival
-                eventType = ARRIVAL_TYPE
-                # Remove the arrival from the awaiting q
-                self.pending_arrivals.get()
-        return (eventType, trip)
-
-    def rebalance_stations(self, cur_time):		
-        # Check to see if anything has exceeded that time
-        # NOTE: potential error, if you have a rebalance time < 1 hour 
-        # could potentially exceed that time
+            # Nowhere left to go
+            trips.status[row] = TRIP_STRANDED
+            self.trip_disappointments.pop(row, None)
+
+    def mark_full(self, s_idx, time):
+        '''Station s_idx got full at time, rebalancing is due rebalancing_time later'''
+        self.unavailable_stations[s_idx] = True
+        self.full_stations.put((time, s_idx))
+        self.event_calendar.push(time + self.rebalancing_time, REBALANCE_TYPE, None)
+
+    def mark_empty(self, s_idx, time):
+        '''Station s_idx got empty at time, rebalancing is due rebalancing_time later'''
+        self.unavailable_stations[s_idx] = True
+        self.empty_stations.put((time, s_idx))
+        self.event_calendar.push(time + self.rebalancing_time, REBALANCE_TYPE, None)
+
+    def count_changed(self, s_idx):
+        '''To call after changing the count or capacity of station s_idx'''
+        self.fill_levels.update(s_idx, self.station_caps[s_idx] - self.station_counts[s_idx])
+
+    def rebalance_stations(self, cur_time):
+        '''
+        Rebalances the stations that have been full/empty for
+        rebalancing_time at cur_time. Runs when a REBALANCE_TYPE event of
+        mark_full/mark_empty comes due.
+        '''
 
         if DEBUG:
-            in_both = set([v for k,v in self.full_stations.queue]).intersection(set([v for k,v in self.empty_stations.queue]))
-            assert len(in_both) == 0
+            self.check_station_invariants()
 
         while not self.full_stations.empty():
             time = self.full_stations.queue[0][0]
             if cur_time - time  >= self.rebalancing_time:
-                time, s_id  = self.full_stations.get()
+                time, s_idx  = self.full_stations.get()
                 # might not necessarily be full anymore, but take half remaining
-                to_remove = self.station_counts[s_id]/2
-                self.station_counts[s_id] -= to_remove
+                to_remove = self.station_counts[s_idx]/2
+                self.station_counts[s_idx] -= to_remove
+                self.count_changed(s_idx)
                 self.moving_bikes += to_remove
                 self.total_rebalances += to_remove
-                self.unavailable_stations.remove(s_id)
+                self.unavailable_stations[s_idx] = False
             else:
                 break
 
@@ -420,69 +579,266 @@ class SimulationLogic:
             # Peak at the time
             time = self.empty_stations.queue[0][0]
             if cur_time - time >= self.rebalancing_time:
-                time, s_id = self.empty_stations.get()
-                need_bikes.append(s_id)
+                time, s_idx = self.empty_stations.get()
+                need_bikes.append(s_idx)
             else:
                 break
 
-        crowded_stations = sorted(self.stations,
-            key=lambda x: self._get_station_cap(x) - self.station_counts[x])
-
-        i = 0 
-        # If any of the stations are fuller than others take from them
-        # Also we'll give every station more than 1 bike
-        while self.moving_bikes < len(need_bikes) * 5 and i < len(crowded_stations):
-            s_id = crowded_stations[i]
-            i += 1
-            to_remove = self.station_counts[s_id] - self._get_station_cap(s_id) / 2
-            if to_remove < 0:
-                # Try removing to down to less than half
-                if self.station_counts[s_id] > 2:
-                    to_remove = self.station_counts[s_id] / 2
-                else:
+        if len(need_bikes) > 0:
+            # If any of the stations are fuller than others take from them
+            # Also we'll give every station more than 1 bike
+            for s_idx in self.fill_levels.fullest():
+                if self.moving_bikes >= len(need_bikes) * 5:
                     break
+                to_remove = self.station_counts[s_idx] - self.station_caps[s_idx] / 2
+                if to_remove < 0:
+                    # Try removing to down to less than half
+                    if self.station_counts[s_idx] > 2:
+                        to_remove = self.station_counts[s_idx] / 2
+                    else:
+                        break
+
+                self.station_counts[s_idx] -= to_remove
+                self.count_changed(s_idx)
+                self.moving_bikes += to_remove
+                self.total_rebalances += to_remove
 
-            self.station_counts[s_id] -= to_remove
-            self.moving_bikes += to_remove
-            self.total_rebalances += to_remove
-
-        if len(need_bikes) > 0:
             bikes_to_distr = self.moving_bikes / len(need_bikes) 
-            for s_id in need_bikes:
+            for s_idx in need_bikes:
                 # Want to mostly fill, but not all the way. For now we'll cap it at 2/3
-                available_space = min(self._get_station_cap(s_id) - self.station_counts[s_id],
-                                      2. * self._get_station_cap(s_id)/3)
+                available_space = min(self.station_caps[s_idx] - self.station_counts[s_idx],
+                                      2. * self.station_caps[s_idx]/3)
                 max_bikes = int(min(bikes_to_distr, available_space))
 
-                self.station_counts[s_id] += max_bikes
+                self.station_counts[s_idx] += max_bikes
+                self.count_changed(s_idx)
                 self.moving_bikes -= max_bikes
-                self.unavailable_stations.remove(s_id)
+                self.unavailable_stations[s_idx] = False
 
         if DEBUG:
-            for s_id, count in self.station_counts.iteritems():
-                assert 0 <= count <= self._get_station_cap(s_id)    
+            self.check_station_invariants()
 
-            in_both = set([v for k,v in self.full_stations.queue]).intersection(set([v for k,v in self.empty_stations.queue]))
-            assert len(in_both) == 0
 
 
+    def stream_results(self, retain=True):
+        '''
+        Starts collecting the results resolved from now on, see
+        take_results. Unless retain, the run lets go of them once taken:
+        the disappointment log only keeps its counts and resolved trips are
+        dropped from self.trips, so the run's memory stays bounded by the
+        trips in flight. flush then only has the run's totals.
+        '''
+        self.completed_rows = []
+        self.taken_disappointments = len(self.disappointment_log)
+        self.retain_results = retain
+
+    def take_results(self):
+        '''
+        The trips completed and the disappointments logged since the last
+        call (or stream_results), as a TripBuffer and a DisappointmentLog
+        '''
+        trips = self.trips.select(numpy.array(self.completed_rows, dtype=numpy.int64))
+        log = self.disappointment_log
+        disappointments = log.select(slice(self.taken_disappointments, None))
+        self.completed_rows = []
+        if self.retain_results:
+            self.taken_disappointments = len(log)
+        else:
+            log.clear()
+            self.taken_disappointments = 0
+            self.discard_resolved_trips()
+        return trips, disappointments
+
+    def discard_resolved_trips(self):
+        '''
+        Drops the trips no pending event refers to anymore, once they make
+        up most of self.trips. The rows of the others are renumbered.
+        '''
+        calendar = self.event_calendar
+        if len(self.trips) < 2 * len(calendar) + MIN_DISCARDED_TRIPS:
+            return
+        events = calendar.events()
+        live_rows = numpy.unique(numpy.array([row for time, event_type, row in events
+                                              if event_type != REBALANCE_TYPE],
+                                             dtype=numpy.int64))
+        new_rows = {row:i for i, row in enumerate(live_rows.tolist())}
+        self.trips = self.trips.select(live_rows)
+        self.event_calendar = make_calendar(calendar.calendar_type)
+        self.event_calendar.push_sorted(
+                (time, event_type, new_rows[row] if event_type != REBALANCE_TYPE else row)
+                for time, event_type, row in events)
+        self.trip_disappointments = {new_rows[row]:visited for row, visited
+                                     in self.trip_disappointments.iteritems()}
 
     def flush(self):
-        '''Returns list of all trips since initialization, or adds them to the database if to_database is True'''
-        return {'trips':self.trip_list,
-                'full_station_disappointments':self.full_station_disappointments,
-                'empty_station_disappointments':self.empty_station_disappointments,
-                'arr_dis_stations':self.arr_dis_stations,
-                'dep_dis_stations':self.dep_dis_stations,
-                'total_rebalances':self.total_rebalances,
+        '''
+        Returns all completed trips since initialization as a TripBuffer,
+        along with disappointment and rebalancing stats
+        '''
+        log = self.disappointment_log
+        if self.retain_results:
+            trips = self.trips.with_status(TRIP_COMPLETED)
+        else:
+            trips = self.trips.select(slice(0, 0))
+        return {'trips':trips,
+                'disappointments':log,
+                'full_station_disappointments':log.of_kind(True),
+                'empty_station_disappointments':log.of_kind(False),
+                'arr_dis_stations':self.station_dict(log.station_totals(True), nonzero=True),
+                'dep_dis_stations':self.station_dict(log.station_totals(False), nonzero=True),
+                'total_rebalances':int(self.total_rebalances),
                 'total_num_bikes':self.total_num_bikes,
-                'station_counts':self.station_counts,
-                'sim_station_caps':self.station_caps}
+                'station_counts':self.station_dict(self.station_counts),
+                'sim_station_caps':self.station_dict(self.station_caps)}
+
+    def snapshot(self):
+        '''
+        Copies the state of the run at self.now into a Snapshot. The run can
+        go on, the snapshot won't change. See restore.
+        '''
+        state = {name:copy.deepcopy(getattr(self, name))
+                 for name in self.SNAPSHOT_ATTRIBUTES}
+        state['station_ids'] = self.station_index.ids.copy()
+        state['random_streams'] = (self.random_streams.seed, self.random_streams.antithetic)
+        state['event_calendar'] = (self.event_calendar.calendar_type,
+                                   self.event_calendar.events())
+        state['trips'] = [getattr(self.trips, name).copy() for name, dtype in COLUMNS]
+        state['disappointment_log'] = [getattr(self.disappointment_log, name).copy()
+                                       for name, dtype in DISAPPOINTMENT_COLUMNS]
+        state['full_stations'] = sorted(self.full_stations.queue)
+        state['empty_stations'] = sorted(self.empty_stations.queue)
+        state['python_random'] = random.getstate()
+        state['numpy_random'] = numpy.random.get_state()
+        return Snapshot(self.__class__.__name__, dict(self.options), state)
+
+    def restore(self, snapshot):
+        '''
+        Puts the run back in the state of snapshot, after which update goes
+        on from snapshot.now. Models are only loaded (by initialize, with
+        the options of the snapshot's run) if this logic doesn't hold the
+        ones of the snapshot's run, e.g. in a new process.
+        '''
+        if snapshot.logic_name != self.__class__.__name__:
+            raise ValueError('Snapshot of a %s, not a %s' % (snapshot.logic_name,
+                                                           self.__class__.__name__))
+        state = snapshot.state
+        if self.loaded_models_key != state['models_key']:
+            self.initialize(state['start_time'], state['end_time'], **snapshot.options)
+        self.options = dict(snapshot.options)
+
+        for name in self.SNAPSHOT_ATTRIBUTES:
+            setattr(self, name, copy.deepcopy(state[name]))
+        self.clock = SimClock(self.start_time, self.end_time)
+        self.station_index = StationIndex(state['station_ids'].tolist())
+        self.random_streams = RandomStreams(*state['random_streams'])
+
+        calendar_type, events = state['event_calendar']
+        self.event_calendar = make_calendar(calendar_type)
+        self.event_calendar.push_sorted(events)
+
+        trip_columns = state['trips']
+        self.trips = TripBuffer(self.station_index, self.clock.origin,
+                                capacity=max(len(trip_columns[0]), 1024))
+        self.trips.extend(*trip_columns)
+        self.disappointment_log = DisappointmentLog(self.station_index, self.clock.origin)
+        self.disappointment_log.extend(*state['disappointment_log'])
+        self.completed_rows = None
+        self.retain_results = True
+
+        self.full_stations = Queue.PriorityQueue()
+        for entry in state['full_stations']:
+            self.full_stations.put(entry)
+        self.empty_stations = Queue.PriorityQueue()
+        for entry in state['empty_stations']:
+            self.empty_stations.put(entry)
+        self.fill_levels = FillLevels(self.station_caps - self.station_counts)
+        random.setstate(state['python_random'])
+        numpy.random.set_state(state['numpy_random'])
+
+    def alter(self, station_caps={}, rebalancing_time=None, rng_seed=None,
+              antithetic=None):
+        '''
+        Changes the scenario of the run from self.now on, typically right
+        after restoring a snapshot to fork what-ifs from it.
+        station_caps: {station id : new capacity}. Bikes over a lowered
+            capacity are taken away by rebalancing.
+        rebalancing_time: new max time (timedelta) a station stays empty/full
+        rng_seed, antithetic: draw the rest of the run from other RandomStreams
+        '''
+        for s_id, s_cap in station_caps.iteritems():
+            s_idx = self.station_index.index_of(s_id)
+            self.station_caps[s_idx] = s_cap
+            excess = max(self.station_counts[s_idx] - s_cap, 0)
+            self.station_counts[s_idx] -= excess
+            self.count_changed(s_idx)
+            self.moving_bikes += excess
+            self.total_rebalances += excess
+            if self.station_counts[s_idx] >= s_cap\
+                    and not self.unavailable_stations[s_idx]:
+                self.mark_full(s_idx, self.now)
+
+        if rebalancing_time is not None:
+            self.rebalancing_time = int(rebalancing_time.total_seconds())
+            # The stations waiting for rebalancing are now due at other times
+            for time, s_idx in self.full_stations.queue + self.empty_stations.queue:
+                self.event_calendar.push(max(time + self.rebalancing_time, self.now),
+                                         REBALANCE_TYPE, None)
+        if rng_seed is not None or antithetic is not None:
+            if rng_seed is None:
+                rng_seed = self.random_streams.seed
+            if antithetic is None:
+                antithetic = self.random_streams.antithetic
+            self.random_streams = RandomStreams(rng_seed, antithetic)
+
+    def station_dict(self, values, nonzero=False):
+        '''
+        Translates an array of per-station values to a {station id : value}
+        dict, optionally leaving out zero values
+        '''
+        ids = self.station_index.ids.tolist()
+        values = values.tolist()
+        return {ids[i]:values[i] for i in xrange(len(ids))
+                if values[i] or not nonzero}
         
 
     def cleanup(self):
         pass
 
+def distribute_bikes(counts, caps, bike_delta):
+    '''
+    Water-fills bike_delta bikes into the stations, or takes -bike_delta
+    bikes out of them, in proportion to their counts. Stations stop taking
+    part once full (or empty when taking bikes out) and the others share
+    what is left, evenly if none of them has bikes. Every pass either
+    places all the bikes left or fills up a station, so there are at most
+    as many passes as stations.
+    Returns the new counts and the bikes that couldn't be placed.
+    '''
+    counts = counts.copy()
+    sign = 1 if bike_delta > 0 else -1
+    remaining = abs(bike_delta)
+    # Bikes every station can still take (or give)
+    room = numpy.maximum(caps - counts if sign > 0 else counts, 0)
+    open_stations = numpy.flatnonzero(room)
+    while remaining > 0 and len(open_stations):
+        weights = counts[open_stations].astype(float)
+        if not weights.any():
+            # Rare case
+            weights[:] = 1
+        shares = weights / weights.sum() * remaining
+        moved = numpy.floor(shares).astype(counts.dtype)
+        # Bikes lost to rounding down go to the largest remainders
+        rounding = max(remaining - moved.sum(), 0)
+        if rounding:
+            moved[numpy.argsort(moved - shares, kind='mergesort')[:rounding]] += 1
+        # if you can't move the desired proportion, move as much as you can
+        moved = numpy.minimum(moved, room[open_stations])
+        counts[open_stations] += sign * moved
+        room[open_stations] -= moved
+        remaining -= moved.sum()
+        open_stations = open_stations[room[open_stations] > 0]
+    return counts, sign * remaining
+
 def main():
     conn = Connector()
     sess = conn.getDBSession()
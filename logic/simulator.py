@@ -3,8 +3,11 @@
 # System modules
 import csv
 import datetime
+import math
+import multiprocessing
 import sys
 import random
+import numpy
 
 # Our modules
 from models import *
@@ -12,10 +15,14 @@ from simulation_logic import SimulationLogic
 from poisson_logic import PoissonLogic
 from exponential_logic import ExponentialLogic
 from alt_poisson_logic import AltPoissonLogic
+from replications import *
+from result_sinks import *
+from bulk_writer import DBWriter, produced_trip_type, save_results
+from trip_files import save_trips, trip_file_columns
+from progress import DEFAULT_JOB, ProgressReporter, board
+from snapshot import save_snapshot, load_snapshot
 from utils import Connector
 
-import pickle
-
 class Simulator:
     def __init__(self, sim_logic):
         self.sim_logic = sim_logic
@@ -23,73 +30,234 @@ class Simulator:
 
     def run(self, start_time, end_time, 
             timestep=datetime.timedelta(seconds=3600),
-            logic_options={}):
+            logic_options={}, progress=True, checkpoint_file=None,
+            checkpoint_steps=24, sinks=(), retain=True, job_id=DEFAULT_JOB):
         '''
         logic_options must have keywords EXACTLY the sim_logic's named params
+        progress: True to publish the run's progress on the ProgressBoard
+            as job_id (see progress.py), a function to call with its
+            progress dicts instead, or False
+        checkpoint_file: if given, a snapshot of the run is saved there every
+            checkpoint_steps timesteps, see resume
+        sinks: ResultSinks (see result_sinks.py) written the trips completed
+            and disappointments logged after every timestep
+        retain: whether the run keeps its results for the returned flush().
+            Without it, results only go to the sinks and memory doesn't grow
+            with the run; flush() then only has the run's totals.
         '''
 
 	print "[simulator run] logic_options = "
 	print logic_options
 
         self.sim_logic.initialize(start_time, end_time, **logic_options)
+        return self.run_until(end_time, timestep, progress, checkpoint_file,
+                              checkpoint_steps, sinks, retain, job_id)
+
+    def resume(self, snapshot, end_time=None,
+               timestep=datetime.timedelta(seconds=3600), alterations={},
+               progress=True, checkpoint_file=None, checkpoint_steps=24,
+               sinks=(), retain=True, job_id=DEFAULT_JOB):
+        '''
+        Restores snapshot (a Snapshot or the file name of a checkpoint) into
+        the sim logic and runs on until end_time, the end of the snapshot's
+        run by default. alterations are the keywords of SimulationLogic.alter,
+        to fork a what-if scenario from the snapshot. Sinks only get the
+        results resolved after the snapshot.
+        '''
+        if isinstance(snapshot, basestring):
+            snapshot = load_snapshot(snapshot)
+        self.sim_logic.restore(snapshot)
+        self.sim_logic.alter(**alterations)
+        if end_time is None:
+            end_time = snapshot.end_time
+        return self.run_until(end_time, timestep, progress, checkpoint_file,
+                              checkpoint_steps, sinks, retain, job_id)
 
+    def run_until(self, end_time, timestep=datetime.timedelta(seconds=3600),
+                  progress=True, checkpoint_file=None, checkpoint_steps=24,
+                  sinks=(), retain=True, job_id=DEFAULT_JOB):
+        '''Steps the initialized (or restored) sim logic up to end_time'''
+        start_time = self.sim_logic.clock.to_datetime(self.sim_logic.now)
         cur_time = start_time
         print "cur time:", cur_time, "start time:", start_time, "end time:", end_time
-        progress_buffer = {}
-        progress_buffer["total_steps"] = (end_time - start_time).total_seconds()/timestep.seconds
-        progress_buffer["done_steps"] = 0
-        progress_buffer["current_time"] = start_time
-
-        nfile = open("progress_buffer.dat", "wb")
-        pickle.dump(progress_buffer, nfile)       
-        nfile.close()
-
-        while cur_time < end_time:
-            self.sim_logic.update(timestep)
-            cur_time += timestep
-            print "Finished time step ", cur_time
-            
-            progress_buffer["done_steps"] += 1
-            progress_buffer["current_time"] = cur_time
-
-            nfile = open("progress_buffer.dat", "wb")
-            pickle.dump(progress_buffer, nfile)       
-            nfile.close()
+        reporter = None
+        if progress:
+            reporter = ProgressReporter(board().publisher(job_id) if progress is True
+                                        else progress)
+            total_steps = int(math.ceil((end_time - start_time).total_seconds()
+                                        / timestep.total_seconds()))
+            reporter.start(total_steps, start_time, self.sim_logic.events_resolved)
+
+        streaming = sinks or not retain
+        if streaming:
+            self.sim_logic.stream_results(retain)
+        for sink in sinks:
+            sink.bind(self.sim_logic)
+            sink.open()
+        try:
+            steps = 0
+            while cur_time < end_time:
+                self.sim_logic.update(timestep)
+                cur_time += timestep
+                steps += 1
+                print "Finished time step ", cur_time
+
+                if streaming:
+                    trips, disappointments = self.sim_logic.take_results()
+                    for sink in sinks:
+                        sink.write(cur_time, trips, disappointments)
+
+                if reporter:
+                    reporter.step(cur_time, self.sim_logic.events_resolved)
+
+                if checkpoint_file and steps % checkpoint_steps == 0:
+                    save_snapshot(self.sim_logic.snapshot(), checkpoint_file)
+        finally:
+            for sink in sinks:
+                sink.close()
+        if reporter:
+            reporter.finish(cur_time, self.sim_logic.events_resolved)
 
         results = self.sim_logic.flush()
         self.sim_logic.clean_up()
         return results
-    
+
+    def run_replication(self, seed, start_time, end_time, timestep, logic_options,
+                        antithetic=False):
+        '''
+        One run with seed as the logic's rng_seed, reduced to its
+        replication_summary
+        '''
+        random.seed(seed)
+        numpy.random.seed(seed)
+        logic_options = dict(logic_options, rng_seed=seed, antithetic=antithetic)
+        results = self.run(start_time, end_time, timestep, logic_options,
+                           progress=False)
+        return replication_summary(results)
+
+    def run_replications(self, num_replications, start_time, end_time,
+                         timestep=datetime.timedelta(seconds=3600),
+                         logic_options={}, workers=None, seed=None,
+                         confidence=0.95):
+        '''
+        Runs the same scenario num_replications times and merges the results
+        into mean, std and confidence interval of every metric, see
+        merge_replications.
+
+        Replications are spread over a pool of workers processes (one per
+        core by default), each with its own DB session and sim logic so
+        models are only loaded once per worker. Every replication gets its
+        own seed from replication_seeds(num_replications, seed), so results
+        don't depend on the number of workers. workers=1 runs everything
+        in this process with self.sim_logic.
+        '''
+        jobs = [('run_replication', s, start_time, end_time, timestep, logic_options)
+                for s in replication_seeds(num_replications, seed)]
+        return merge_replications(self.run_jobs(jobs, workers), confidence)
+
+    def compare_scenarios(self, num_replications, start_time, end_time,
+                          logic_options_a, logic_options_b,
+                          timestep=datetime.timedelta(seconds=3600),
+                          workers=None, seed=None, antithetic=False,
+                          confidence=0.95):
+        '''
+        Runs two scenarios (e.g. different station_caps) num_replications
+        times each with common random numbers: the i-th replications of both
+        use the same rng_seed. With antithetic, every seed also runs in
+        antithetic mode. Returns compare_replications, whose variance
+        reductions tell how many fewer runs the pairing needed.
+        '''
+        seeds = replication_seeds(num_replications, seed)
+        modes = [False, True] if antithetic else [False]
+        jobs = [('run_replication', s, start_time, end_time, timestep, options, mode)
+                for mode in modes
+                for options in (logic_options_a, logic_options_b)
+                for s in seeds]
+        summaries = self.run_jobs(jobs, workers)
+        # Split back by mode and scenario
+        n = num_replications
+        groups = [summaries[i * n:(i + 1) * n] for i in range(len(summaries) / n)]
+        if antithetic:
+            return compare_replications(groups[0], groups[1], confidence,
+                                        antithetic_a=groups[2], antithetic_b=groups[3])
+        return compare_replications(groups[0], groups[1], confidence)
+
+    def fork_scenarios(self, snapshot, scenarios, end_time=None,
+                       timestep=datetime.timedelta(seconds=3600), workers=None):
+        '''
+        Runs every scenario of scenarios, a list of SimulationLogic.alter
+        keywords, from the warm state of snapshot instead of from
+        initialize. Returns their replication_summary in the same order.
+        '''
+        jobs = [('run_fork', snapshot, end_time, timestep, alterations)
+                for alterations in scenarios]
+        return self.run_jobs(jobs, workers)
+
+    def run_fork(self, snapshot, end_time, timestep, alterations):
+        '''One resume of snapshot, reduced to its replication_summary'''
+        results = self.resume(snapshot, end_time, timestep, alterations,
+                              progress=False)
+        return replication_summary(results)
+
+    def run_jobs(self, jobs, workers=None):
+        '''
+        Runs every job, a (method name, arguments...) tuple of a Simulator
+        method returning a summary, over a pool of workers processes (one
+        per core by default), and returns the summaries in order. Each worker has its own DB session and sim logic, so models
+        are only loaded once per worker. workers=1 runs everything in this
+        process with self.sim_logic.
+        '''
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        workers = min(workers, len(jobs))
+
+        if workers <= 1:
+            return [getattr(self, job[0])(*job[1:]) for job in jobs]
+        pool = multiprocessing.Pool(workers, _init_worker,
+                                    (self.sim_logic.__class__,))
+        try:
+            return pool.map(_run_job, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
     # I think I'd prefer to write out the results into the DB rather
     # than create a bunch of CSVs.
     def write_out(self, results, file_name):
         '''
-        Takes in a list of trip objects and writes them out to a csv file
+        Writes the trips of the produced TripBuffer out to a csv file, or
+        to compressed binary columns if file_name ends with .npz. See
+        trip_files.py, Analyzer.read_and_parse reads either back.
         '''
-        with open(file_name, 'w') as f:
-            f.write(Trip.csv_header() + "\n")
-            for line in results['trips']:
-                f.write(line.to_csv()+"\n")
+        save_trips(trip_file_columns(results['trips']), file_name)
 
     def save_to_db(self, trips, disappointments):
         '''
-        Saves produced trips and associated disappointments to the db.
+        Saves produced trips (a TripBuffer) and associated disappointments
+        (a DisappointmentLog) to the db in bulk, see bulk_writer.py. To save
+        them while the run goes on, give Simulator.run a DBWriter sink.
         '''
-        trip_type = TripType('Produced')
-        self.session.add(trip_type)
-        for trip in trips:
-            trip.trip_type = trip_type
-            self.session.add(trip)
-        for d in disappointments:
-            self.session.add(d)
-        self.session.commit() 
-        self.session.flush()
-        # self.session.commit() 
+        trip_type_id = produced_trip_type(self.session)
+        save_results(self.session.connection(), trips, disappointments, trip_type_id)
+        self.session.commit()
 
     # Return string to write to console, std out
     def write_stdout(self, results):
         return "\n".join([line.to_csv() for line in results])
 
+# Simulator of the current pool worker process, see run_jobs
+_worker_simulator = None
+
+def _init_worker(logic_class):
+    global _worker_simulator
+    session = Connector().getDBSession()
+    _worker_simulator = Simulator(logic_class(session))
+    # Workers of one pool load every model once between them
+    _worker_simulator.sim_logic.share_models = True
+
+def _run_job(job):
+    return getattr(_worker_simulator, job[0])(*job[1:])
+
 def print_usage():
     print "Simulator Usage: python simulator.py <name of logic> <start_date> <end_date> <output file>"
 
@@ -160,9 +328,11 @@ def main():
     print results['arr_dis_stations']
     print "Departure dis stations:"
     print results['dep_dis_stations']
-    hours = [[0]*24 for d in range(7)]
-    for t in results['trips']:
-        hours[t.start_date.weekday()][t.start_date.hour] += 1
+    # Departures per [weekday][hour], the epoch started on a Thursday
+    start_times = results['trips'].origin + results['trips'].start_time
+    weekdays = (start_times // 86400 + 3) % 7
+    hours = numpy.zeros((7, 24), dtype=int)
+    numpy.add.at(hours, (weekdays, results['trips'].start_hours()), 1)
     session.close()
     
 
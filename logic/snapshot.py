@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+'''
+    snapshot.py
+
+    Snapshots of a running simulation, see SimulationLogic.snapshot and
+    SimulationLogic.restore. A snapshot holds everything a run reads or
+    writes while stepping (station counts, pending events, rebalancing
+    queues, random streams, accumulators...) as plain data: numbers, numpy
+    arrays, lists and dicts. The models (lambdas, gammas...) are left out,
+    they stay loaded in the logic or are reloaded from the DB.
+
+    A snapshot can be restored in the logic it came from to fork what-if
+    scenarios from a warm state, pickled to worker processes, or saved as a
+    checkpoint to resume a long run after a crash.
+'''
+import cPickle as pickle
+import os
+
+
+class Snapshot:
+
+    def __init__(self, logic_name, options, state):
+        # Class name of the logic the snapshot was taken from
+        self.logic_name = logic_name
+        # Keyword arguments of the snapshot run's initialize, to load its
+        # models where they aren't loaded yet
+        self.options = options
+        # attribute -> plain data, see SimulationLogic.snapshot
+        self.state = state
+
+    @property
+    def now(self):
+        '''Simulation seconds the snapshot was taken at'''
+        return self.state['now']
+
+    @property
+    def end_time(self):
+        return self.state['end_time']
+
+
+def save_snapshot(snapshot, file_name):
+    '''
+    Pickles snapshot to file_name. The file is written aside and renamed,
+    so a crash while saving leaves the previous checkpoint intact.
+    '''
+    temp_name = file_name + '.tmp'
+    with open(temp_name, 'wb') as f:
+        pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(temp_name, file_name)
+
+def load_snapshot(file_name):
+    with open(file_name, 'rb') as f:
+        return pickle.load(f)
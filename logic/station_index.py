@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+'''
+    station_index.py
+
+    Maps Capital Bikeshare terminal ids to contiguous indexes 0..N-1 so
+    per-station and per-pair data can be kept in arrays.
+'''
+import numpy
+
+
+class StationIndex:
+
+    def __init__(self, station_ids):
+        # Sorted so the same set of stations always gets the same indexes
+        self.ids = numpy.array(sorted(station_ids), dtype=numpy.int64)
+        self.index = {s_id:i for i, s_id in enumerate(self.ids.tolist())}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, s_id):
+        return s_id in self.index
+
+    def index_of(self, s_id):
+        return self.index[s_id]
+
+    def indexes_of(self, station_ids):
+        '''Vectorized index_of, every id must be indexed'''
+        station_ids = numpy.asarray(station_ids, dtype=numpy.int64)
+        idx = numpy.searchsorted(self.ids, station_ids)
+        if len(idx) and (idx.max() >= len(self.ids)
+                         or (self.ids[idx] != station_ids).any()):
+            raise KeyError('Unknown station id in %r' % station_ids)
+        return idx
+
+    def id_of(self, idx):
+        return int(self.ids[idx])
+
+    def ids_of(self, idx):
+        return self.ids[idx]
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+'''
+    trip_buffer.py
+
+    Struct-of-arrays storage for simulated trips. Every trip is a row made of
+    start/end station indexes (see StationIndex), start/end times in
+    simulation seconds (see SimClock) and a status code. Columns grow by
+    doubling, so appending is amortized O(1) and no ORM objects are created
+    while simulating.
+'''
+import random
+import numpy
+
+from models import Trip
+from sim_clock import epoch_seconds, from_epoch_seconds, HOUR
+
+# Trip status codes
+# Generated, waiting for its departure
+TRIP_PENDING = 0
+# Left its start station, waiting for its arrival
+TRIP_RIDING = 1
+# Docked at its end station
+TRIP_COMPLETED = 2
+# There was no bike at the start station
+TRIP_NO_BIKE = 3
+# Couldn't be rerouted away from a full station
+TRIP_STRANDED = 4
+
+COLUMNS = [('start_station', numpy.int32),
+           ('end_station', numpy.int32),
+           ('start_time', numpy.int64),
+           ('end_time', numpy.int64),
+           ('status', numpy.int8)]
+
+
+class TripBuffer(object):
+
+    def __init__(self, station_index, origin=0, capacity=1024):
+        '''origin: epoch seconds of time 0, i.e. the simulation's SimClock.origin'''
+        self.station_index = station_index
+        self.origin = origin
+        self.size = 0
+        self._columns = {name:numpy.zeros(capacity, dtype=dtype)
+                         for name, dtype in COLUMNS}
+
+    def __len__(self):
+        return self.size
+
+    # Views of the filled part of every column. They write through to the
+    # buffer but must not be kept around across appends.
+    @property
+    def start_station(self):
+        return self._columns['start_station'][:self.size]
+
+    @property
+    def end_station(self):
+        return self._columns['end_station'][:self.size]
+
+    @property
+    def start_time(self):
+        return self._columns['start_time'][:self.size]
+
+    @property
+    def end_time(self):
+        return self._columns['end_time'][:self.size]
+
+    @property
+    def status(self):
+        return self._columns['status'][:self.size]
+
+    def _reserve(self, num_rows):
+        capacity = len(self._columns['status'])
+        needed = self.size + num_rows
+        if needed <= capacity:
+            return
+        capacity = max(capacity * 2, needed)
+        for name, column in self._columns.items():
+            grown = numpy.zeros(capacity, dtype=column.dtype)
+            grown[:self.size] = column[:self.size]
+            self._columns[name] = grown
+
+    def append(self, start_station, end_station, start_time, end_time,
+               status=TRIP_PENDING):
+        '''Adds one trip, returns its row'''
+        self._reserve(1)
+        row = self.size
+        columns = self._columns
+        columns['start_station'][row] = start_station
+        columns['end_station'][row] = end_station
+        columns['start_time'][row] = start_time
+        columns['end_time'][row] = end_time
+        columns['status'][row] = status
+        self.size += 1
+        return row
+
+    def extend(self, start_station, end_station, start_time, end_time,
+               status=TRIP_PENDING):
+        '''
+        Adds one trip per entry of the given (parallel) arrays and returns
+        the first new row; the new rows are contiguous.
+        '''
+        num_rows = len(start_station)
+        self._reserve(num_rows)
+        first = self.size
+        last = first + num_rows
+        columns = self._columns
+        columns['start_station'][first:last] = start_station
+        columns['end_station'][first:last] = end_station
+        columns['start_time'][first:last] = start_time
+        columns['end_time'][first:last] = end_time
+        columns['status'][first:last] = status
+        self.size = last
+        return first
+
+    def select(self, rows):
+        '''A new buffer holding copies of the given rows (indexes or mask)'''
+        selected = TripBuffer(self.station_index, self.origin, capacity=0)
+        selected._columns = {name:column[:self.size][rows].copy()
+                             for name, column in self._columns.iteritems()}
+        selected.size = len(selected._columns['status'])
+        return selected
+
+    def with_status(self, status):
+        return self.select(self.status == status)
+
+    def start_date(self, row):
+        return from_epoch_seconds(self.origin + self._columns['start_time'][row])
+
+    def end_date(self, row):
+        return from_epoch_seconds(self.origin + self._columns['end_time'][row])
+
+    def start_station_ids(self):
+        return self.station_index.ids_of(self.start_station)
+
+    def end_station_ids(self):
+        return self.station_index.ids_of(self.end_station)
+
+    def departure_counts(self):
+        '''Number of trips leaving every station, by station index'''
+        return numpy.bincount(self.start_station, minlength=len(self.station_index))
+
+    def arrival_counts(self):
+        '''Number of trips ending at every station, by station index'''
+        return numpy.bincount(self.end_station, minlength=len(self.station_index))
+
+    def durations(self):
+        '''Trip lengths in seconds'''
+        return self.end_time - self.start_time
+
+    def start_hours(self):
+        '''Hour of the day (0-23) every trip started in'''
+        return ((self.origin + self.start_time) // HOUR) % 24
+
+    def end_hours(self):
+        return ((self.origin + self.end_time) // HOUR) % 24
+
+    def to_trips(self, trip_type_id=2):
+        '''Builds ORM Trip objects for every row'''
+        start_ids = self.start_station_ids().tolist()
+        end_ids = self.end_station_ids().tolist()
+        start_times = (self.origin + self.start_time).tolist()
+        end_times = (self.origin + self.end_time).tolist()
+        return [Trip(str(random.randint(1,500)), "Casual", trip_type_id,
+                     from_epoch_seconds(start_times[i]),
+                     from_epoch_seconds(end_times[i]),
+                     start_ids[i], end_ids[i])
+                for i in xrange(self.size)]
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+'''
+    trip_files.py
+
+    Files of produced trips, see Simulator.write_out. Trips are handled as
+    columns, a {field : array} dict by TRIP_FIELDS with dates as epoch
+    seconds, and written in one of two formats picked by file extension:
+
+    - .npz: binary columns (numpy.savez_compressed, or numpy.savez)
+    - anything else: csv with the Trip.to_csv fields and header, written
+      and parsed a whole column at a time instead of line by line
+
+    Times are whole seconds; fractions of a second in csv files are dropped.
+'''
+import numpy
+
+from models import Trip
+from result_sinks import format_dates
+from sim_clock import from_epoch_seconds
+
+# Column order of Trip.csv_header
+TRIP_FIELDS = ['bike_id', 'member_type', 'trip_type', 'start_date', 'end_date',
+               'start_station_id', 'end_station_id']
+DATE_FIELDS = ['start_date', 'end_date']
+INT_FIELDS = ['start_station_id', 'end_station_id']
+
+
+def trip_file_columns(trips, trip_type_id=2, rng=numpy.random):
+    '''
+    Columns of a TripBuffer. Bike ids are made up, as in TripBuffer.to_trips.
+    Like bike ids, trip types are kept as the strings of the csv files.
+    '''
+    num_trips = len(trips)
+    return {'bike_id':rng.randint(1, 501, num_trips).astype('S3'),
+            'member_type':numpy.repeat(numpy.array(['Casual']), num_trips),
+            'trip_type':numpy.repeat(numpy.array([str(trip_type_id)]), num_trips),
+            'start_date':trips.origin + trips.start_time,
+            'end_date':trips.origin + trips.end_time,
+            'start_station_id':trips.start_station_ids(),
+            'end_station_id':trips.end_station_ids()}
+
+def save_trips(columns, file_name, compress=True):
+    '''
+    compress: whether .npz files are compressed, about 8 times smaller
+        but slower to write
+    '''
+    if file_name.endswith('.npz'):
+        if compress:
+            numpy.savez_compressed(file_name, **columns)
+        else:
+            numpy.savez(file_name, **columns)
+    else:
+        write_csv(columns, file_name)
+
+def load_trips(file_name):
+    '''Columns of a file written by save_trips'''
+    if file_name.endswith('.npz'):
+        with numpy.load(file_name) as data:
+            return {field:data[field] for field in TRIP_FIELDS}
+    return read_csv(file_name)
+
+def write_csv(columns, file_name):
+    strings = [format_dates(0, columns[field]) if field in DATE_FIELDS
+               else numpy.asarray(columns[field]).astype(str).tolist()
+               for field in TRIP_FIELDS]
+    with open(file_name, 'w') as f:
+        f.write(Trip.csv_header() + "\n")
+        if strings[0]:
+            f.write("\n".join(",".join(row) for row in zip(*strings)))
+            f.write("\n")
+
+def read_csv(file_name):
+    '''
+    Parses a csv of Trip.to_csv lines, with or without the header line.
+    Dates may have fractions of a second.
+    '''
+    with open(file_name, 'r') as f:
+        lines = f.read().splitlines()
+    if lines and lines[0].startswith(TRIP_FIELDS[0]):
+        lines = lines[1:]
+    lines = [line for line in lines if line]
+    values = numpy.array(",".join(lines).split(",")) if lines else numpy.zeros(0, dtype=str)
+    values = values.reshape(len(lines), len(TRIP_FIELDS))
+    columns = {}
+    for i, field in enumerate(TRIP_FIELDS):
+        if field in DATE_FIELDS:
+            columns[field] = values[:, i].astype('datetime64[us]')\
+                                         .astype('datetime64[s]').astype(numpy.int64)
+        elif field in INT_FIELDS:
+            columns[field] = values[:, i].astype(numpy.int64)
+        else:
+            columns[field] = values[:, i]
+    return columns
+
+def to_trips(columns):
+    '''Builds ORM Trip objects for every row of columns'''
+    values = [columns[field].tolist() for field in TRIP_FIELDS]
+    return [Trip(bike_id, member_type, trip_type,
+                 from_epoch_seconds(start_date), from_epoch_seconds(end_date),
+                 start_station_id, end_station_id)
+            for bike_id, member_type, trip_type, start_date, end_date,
+                start_station_id, end_station_id in zip(*values)]
@@ -466,6 +466,66 @@ class StationStatus(Base):
                         e=self.empty_docks)
 
 
+class StationOccupancy(Base):
+    '''
+    Hourly rollup of station_statuses: the bike counts a station had at an
+    hour of the day, on week days or weekends. Kept as count, sum and sum of
+    squares so the collector can add statuses as they come in, and rollups
+    of several hours or day types can be added up.
+    See data_collection/occupancy_rollup.py
+    '''
+    __tablename__ = 'station_occupancies'
+    station_id = Column(Integer, ForeignKey('stations.id'), primary_key=True)
+    hour = Column(Integer, primary_key=True) # range 0-23
+    is_week_day = Column(Boolean, primary_key=True)
+
+    count = Column(Integer, nullable=False)
+    bike_sum = Column(Integer, nullable=False)
+    bike_sq_sum = Column(Integer, nullable=False)
+
+    def __init__(self, station_id, hour, is_week_day):
+        self.station_id = station_id
+        self.hour = hour
+        self.is_week_day = is_week_day
+        self.count = 0
+        self.bike_sum = 0
+        self.bike_sq_sum = 0
+
+    def add(self, bike_count):
+        self.count += 1
+        self.bike_sum += bike_count
+        self.bike_sq_sum += bike_count * bike_count
+
+    def __repr__(self):
+        return 'Station occupancy: s_id={s} hour={h} week day={w} count={c}'\
+                .format(s=self.station_id, h=self.hour, w=self.is_week_day,
+                        c=self.count)
+
+
+class FleetSize(Base):
+    '''
+    Single row table, the largest number of bikes docked at once over all
+    the status groups, maintained along with StationOccupancy.
+    '''
+    __tablename__ = 'fleet_sizes'
+    id = Column(Integer, primary_key=True)
+    max_bike_total = Column(Integer, nullable=False)
+    status_groups = Column(Integer, nullable=False)
+
+    def __init__(self):
+        self.id = 1
+        self.max_bike_total = 0
+        self.status_groups = 0
+
+    def add(self, bike_total):
+        self.max_bike_total = max(self.max_bike_total, bike_total)
+        self.status_groups += 1
+
+    def __repr__(self):
+        return 'Fleet size: max={m} over {g} status groups'\
+                .format(m=self.max_bike_total, g=self.status_groups)
+
+
 class Disappointment(Base):
     __tablename__ = 'disappointments'
     id = Column(Integer, Sequence('disappointments_id_seq'), primary_key=True)
@@ -0,0 +1,404 @@
+#! /usr/bin/env python
+"""
+Timing benchmarks for the simulation engine. Benchmarks run against the
+database configured in utils/hidden.py. Usage:
+
+    python -m tests.benchmark <benchmark> [<start_date> <end_date>]
+
+with dates formatted as %Y-%m-%d.
+"""
+
+from logic import PoissonLogic, Simulator
+from logic.bulk_writer import DBWriter, produced_trip_type, save_results
+from logic.event_calendar import CALENDAR_TYPES
+from logic.lambda_store import nonzero_pairs
+from logic.result_sinks import AggregateSink
+from logic.sim_clock import epoch_seconds
+from logic.simulation_logic import distribute_bikes
+from logic.station_index import StationIndex
+from logic.trip_buffer import TripBuffer
+from logic.trip_files import load_trips, save_trips, trip_file_columns
+from utils import Connector
+from models import Disappointment, Lambda, Station, Trip, TripType
+
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import csv
+import multiprocessing
+import numpy
+import os
+import random
+import sys
+import time
+
+TIMESTEP = timedelta(seconds=3600)
+
+def run_event_loop(logic, start_date, end_date, logic_options={}, seed=None):
+    '''
+    Initializes the logic and steps it from start_date to end_date.
+    Returns (events resolved, seconds spent stepping). Loading time is
+    not included.
+    '''
+    if seed is not None:
+        random.seed(seed)
+        numpy.random.seed(seed)
+    logic.initialize(start_date, end_date, **logic_options)
+    cur_time = start_date
+    began = time.time()
+    while cur_time < end_date:
+        logic.update(TIMESTEP)
+        cur_time += TIMESTEP
+    return logic.events_resolved, time.time() - began
+
+def bench_calendar(session, start_date, end_date):
+    '''
+    Compares events/sec of every event calendar backend on the same
+    PoissonLogic run.
+    '''
+    print "%20s | %10s | %10s | %12s" % ("calendar", "events", "seconds", "events/sec")
+    for calendar_type in sorted(CALENDAR_TYPES):
+        logic = PoissonLogic(session)
+        events, elapsed = run_event_loop(logic, start_date, end_date,
+                                         {'calendar_type':calendar_type},
+                                         seed=23526)
+        print "%20s | %10d | %10.2f | %12.1f" % (calendar_type, events, elapsed,
+                                                 events/elapsed if elapsed else 0)
+
+def bench_rebalancing(session, start_date, end_date):
+    '''
+    Events/sec of a PoissonLogic run for several rebalancing times, the
+    shorter ones rebalancing far more often.
+    '''
+    print "%12s | %10s | %10s | %10s | %12s" % ("rebalancing", "events", "rebalanced",
+                                                "seconds", "events/sec")
+    for minutes in [0, 15, 60, 120, 360]:
+        logic = PoissonLogic(session)
+        events, elapsed = run_event_loop(logic, start_date, end_date,
+                                         {'rebalancing_time':timedelta(minutes=minutes)},
+                                         seed=23526)
+        print "%10dmn | %10d | %10d | %10.2f | %12.1f" % (minutes, events,
+                                                          logic.total_rebalances, elapsed,
+                                                          events/elapsed if elapsed else 0)
+
+def deep_getsizeof(obj, seen=None):
+    '''
+    Rough memory use of nested containers, following ORM entities'
+    attributes (but not their session state).
+    '''
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_getsizeof(k, seen) + deep_getsizeof(v, seen)
+                    for k, v in obj.iteritems())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(deep_getsizeof(v, seen) for v in obj)
+    elif hasattr(obj, '_sa_instance_state'):
+        size += sys.getsizeof(obj.__dict__)
+        size += sum(deep_getsizeof(v, seen) for v in obj.__dict__.itervalues())
+    return size
+
+def load_nested_lambdas(session, store):
+    '''
+    Builds the nested defaultdict of Lambda entities PoissonLogic used to
+    keep, holding the same slices as the given LambdaStore.
+    '''
+    distr_dict = defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: defaultdict(float)))))
+    station_list = store.station_index.ids.tolist()
+    for year, month, is_week_day, hour in store.slices:
+        lambdas = session.query(Lambda)\
+                         .filter(Lambda.year == year)\
+                         .filter(Lambda.month == month)\
+                         .filter(Lambda.is_week_day == is_week_day)\
+                         .filter(Lambda.hour == hour)\
+                         .filter(Lambda.start_station_id.in_(station_list))\
+                         .filter(Lambda.end_station_id.in_(station_list))
+        for lam in lambdas:
+            distr_dict[lam.year][lam.month][lam.is_week_day][lam.hour][(lam.start_station_id, lam.end_station_id)] = lam
+    return distr_dict
+
+def bench_lambdas(session, start_date, end_date, num_lookups=100000):
+    '''
+    Reports memory use and lookup cost of the LambdaStore against the
+    nested defaultdict of Lambda entities.
+    '''
+    logic = PoissonLogic(session)
+    logic.initialize(start_date, end_date)
+    store = logic.lambda_distrs
+    nested = load_nested_lambdas(session, store)
+    station_ids = store.station_index.ids.tolist()
+    keys = sorted(store.slices)
+
+    print "%d lambdas in %d slices, %d stations" % (len(store), len(keys), len(station_ids))
+    print "%25s | %15s | %15s" % ("", "nested dict", "lambda store")
+    print "%25s | %15d | %15d" % ("bytes", deep_getsizeof(nested),
+                                  store.nbytes() + deep_getsizeof(store.slices))
+
+    # Random pair lookups, the way get_lambda is used for predictions
+    rand = random.Random(23526)
+    lookups = [(rand.choice(keys), rand.choice(station_ids), rand.choice(station_ids))
+               for i in xrange(num_lookups)]
+    began = time.time()
+    for (year, month, is_week_day, hour), s_id, e_id in lookups:
+        nested.get(year, {}).get(month, {}).get(is_week_day, {}).get(hour, {}).get((s_id, e_id), None)
+    nested_time = time.time() - began
+    began = time.time()
+    for (year, month, is_week_day, hour), s_id, e_id in lookups:
+        logic.get_lambda(year, month, 0 if is_week_day else 5, hour, s_id, e_id)
+    store_time = time.time() - began
+    print "%25s | %15.3f | %15.3f" % ("usec per lookup",
+                                      nested_time / num_lookups * 1e6,
+                                      store_time / num_lookups * 1e6)
+
+    # Visiting every lambda of an hour, the way trips are generated
+    began = time.time()
+    for year, month, is_week_day, hour in keys:
+        hour_lambdas = nested[year][month][is_week_day][hour]
+        for s_id in station_ids:
+            for e_id in station_ids:
+                hour_lambdas.get((s_id, e_id), None)
+    nested_time = time.time() - began
+    began = time.time()
+    for key in keys:
+        nonzero_pairs(store.slices[key])
+    store_time = time.time() - began
+    print "%25s | %15.3f | %15.3f" % ("msec per hour scan",
+                                      nested_time / len(keys) * 1e3,
+                                      store_time / len(keys) * 1e3)
+
+def bench_replications(session, start_date, end_date, num_replications=8):
+    '''
+    Wall time of Simulator.run_replications with a growing number of
+    worker processes, up to one per core.
+    '''
+    simulator = Simulator(PoissonLogic(session))
+    worker_counts = [1]
+    while worker_counts[-1] * 2 <= multiprocessing.cpu_count():
+        worker_counts.append(worker_counts[-1] * 2)
+
+    print "%10s | %10s | %10s | %12s" % ("workers", "seconds", "speedup", "mean trips")
+    serial_time = None
+    for workers in worker_counts:
+        began = time.time()
+        merged = simulator.run_replications(num_replications, start_date, end_date,
+                                            workers=workers, seed=23526)
+        elapsed = time.time() - began
+        if serial_time is None:
+            serial_time = elapsed
+        print "%10d | %10.2f | %10.2f | %12.1f" % (workers, elapsed, serial_time / elapsed,
+                                                   merged['trips']['mean'])
+
+def bench_crn(session, start_date, end_date, num_replications=8):
+    '''
+    How many times fewer replications common random numbers (and the
+    antithetic runs on top of them) need to compare two scenarios: as is
+    and with the first station dropped.
+    '''
+    simulator = Simulator(PoissonLogic(session))
+    dropped = session.query(Station).first().id
+    comparison = simulator.compare_scenarios(num_replications, start_date, end_date,
+                                             {}, {'drop_stations':[dropped]},
+                                             seed=23526, antithetic=True)
+
+    print "%30s | %12s | %10s | %10s" % ("metric", "difference", "crn", "antithetic")
+    for metric, difference in sorted(comparison['difference'].items()):
+        print "%30s | %12.1f | %10s | %10s" % (metric, difference['mean'],
+                                                _ratio(difference['variance_reduction']),
+                                                _ratio(difference['antithetic_reduction']))
+
+def bench_water_filling(session, start_date, end_date, num_repeats=100):
+    '''
+    Times distributing bikes over the stations of start_date for a sweep
+    of bike_total values, from taking most bikes out to more bikes than
+    the stations hold, as cost_analysis does.
+    '''
+    logic = PoissonLogic(session)
+    logic.initialize(start_date, end_date)
+    counts, caps = logic.station_counts, logic.station_caps
+    capacity = caps.sum()
+
+    print "%10s | %10s | %10s | %10s" % ("bike_total", "placed", "left", "ms")
+    for bike_total in numpy.linspace(0, 1.2 * capacity, 13).astype(int).tolist():
+        began = time.time()
+        for i in xrange(num_repeats):
+            new_counts, left = distribute_bikes(counts, caps, bike_total - counts.sum())
+        elapsed = (time.time() - began) / num_repeats
+        print "%10d | %10d | %10d | %10.3f" % (bike_total, new_counts.sum(), left,
+                                               elapsed * 1000)
+
+def bench_streaming(session, start_date, end_date):
+    '''
+    Wall time and trip rows held at the end of the same PoissonLogic run
+    keeping its results, streaming them to an AggregateSink as well, and
+    only streaming them (retain=False).
+    '''
+    print "%20s | %10s | %10s | %12s" % ("mode", "seconds", "trips", "rows held")
+    for mode, sinks, retain in [('flush', [], True), ('flush + sink', [AggregateSink()], True),
+                                ('sink only', [AggregateSink()], False)]:
+        simulator = Simulator(PoissonLogic(session))
+        random.seed(23526)
+        numpy.random.seed(23526)
+        began = time.time()
+        results = simulator.run(start_date, end_date, TIMESTEP, progress=False,
+                                sinks=sinks, retain=retain)
+        elapsed = time.time() - began
+        num_trips = sinks[0].num_trips if sinks else len(results['trips'])
+        print "%20s | %10.2f | %10d | %12d" % (mode, elapsed, num_trips,
+                                               len(simulator.sim_logic.trips))
+
+def bench_persistence(session, start_date, end_date):
+    '''
+    Rows/sec saving the results of one PoissonLogic run as ORM objects
+    (session.add of every Trip and Disappointment) and with bulk_writer,
+    and how much longer the run takes saving them on a DBWriter thread.
+    Saved rows are deleted afterwards.
+    '''
+    simulator = Simulator(PoissonLogic(session))
+    random.seed(23526)
+    numpy.random.seed(23526)
+    began = time.time()
+    results = simulator.run(start_date, end_date, TIMESTEP, progress=False)
+    run_time = time.time() - began
+    trips, disappointments = results['trips'], results['disappointments']
+    num_rows = len(trips) + len(disappointments)
+    first_disappointment = (session.query(Disappointment.id)
+                                   .order_by(Disappointment.id.desc()).first() or (0,))[0]
+
+    def save_orm():
+        trip_type = TripType('Produced')
+        session.add(trip_type)
+        for trip in trips.to_trips():
+            trip.trip_type = trip_type
+            session.add(trip)
+        session.add_all(disappointments.to_disappointments())
+        session.commit()
+        return trip_type.id
+
+    def save_bulk():
+        trip_type_id = produced_trip_type(session)
+        save_results(session.connection(), trips, disappointments, trip_type_id)
+        session.commit()
+        return trip_type_id
+
+    print "%12s | %10s | %10s | %12s" % ("path", "rows", "seconds", "rows/sec")
+    for path, save in [('orm', save_orm), ('bulk', save_bulk)]:
+        began = time.time()
+        trip_type_id = save()
+        elapsed = time.time() - began
+        print "%12s | %10d | %10.2f | %12.1f" % (path, num_rows, elapsed,
+                                                 num_rows/elapsed if elapsed else 0)
+        _delete_produced(session, [trip_type_id], first_disappointment)
+
+    writer = DBWriter(session)
+    random.seed(23526)
+    numpy.random.seed(23526)
+    began = time.time()
+    Simulator(PoissonLogic(session)).run(start_date, end_date, TIMESTEP,
+                                         progress=False, sinks=[writer])
+    elapsed = time.time() - began
+    print "%12s | %10d | %10.2f | %12s" % ("background", writer.rows_written, elapsed,
+                                           "+%.2fs run" % (elapsed - run_time))
+    _delete_produced(session, [writer.trip_type_id], first_disappointment)
+
+def _delete_produced(session, trip_type_ids, first_disappointment):
+    '''Deletes what bench_persistence saved'''
+    session.query(Disappointment).filter(Disappointment.id > first_disappointment)\
+                                 .delete(synchronize_session=False)
+    session.query(Trip).filter(Trip.trip_type_id.in_(trip_type_ids))\
+                       .delete(synchronize_session=False)
+    session.query(TripType).filter(TripType.id.in_(trip_type_ids))\
+                           .delete(synchronize_session=False)
+    session.commit()
+
+def bench_export(session, start_date, end_date, num_trips=1000000,
+                 legacy_trips=100000, file_prefix='/tmp/benchmark_trips'):
+    '''
+    Round trip time and file size of num_trips random trips through every
+    format of Simulator.write_out / Analyzer.read_and_parse, against the
+    former Trip.to_csv writer and strptime reader (timed on legacy_trips
+    trips, they're too slow for all of them).
+    '''
+    station_index = StationIndex([s_id for s_id, in session.query(Station.id)])
+    origin = epoch_seconds(start_date)
+    span = int((end_date - start_date).total_seconds())
+    rng = numpy.random.RandomState(23526)
+    trips = TripBuffer(station_index, origin, capacity=num_trips)
+    start_times = numpy.sort(rng.randint(0, span, num_trips))
+    trips.extend(rng.randint(0, len(station_index), num_trips),
+                 rng.randint(0, len(station_index), num_trips),
+                 start_times, start_times + rng.randint(60, 3600, num_trips))
+
+    print "%8s | %10s | %10s | %10s | %12s | %10s" % ("format", "trips", "write s",
+                                                      "read s", "trips/sec", "MB")
+    for name, extension, compress in [('csv', '.csv', False), ('npz', '.npz', True),
+                                      ('raw npz', '.npz', False)]:
+        file_name = file_prefix + extension
+        began = time.time()
+        save_trips(trip_file_columns(trips), file_name, compress)
+        write_time = time.time() - began
+        began = time.time()
+        read = load_trips(file_name)
+        read_time = time.time() - began
+        assert len(read['start_date']) == num_trips
+        _print_export(name, num_trips, write_time, read_time, file_name)
+
+    legacy = trips.select(slice(0, legacy_trips))
+    file_name = file_prefix + '_legacy.csv'
+    began = time.time()
+    with open(file_name, 'w') as f:
+        for trip in legacy.to_trips():
+            f.write(trip.to_csv() + "\n")
+    write_time = time.time() - began
+    began = time.time()
+    with open(file_name, 'r') as f:
+        read = [(line[0], line[1], line[2],
+                 datetime.strptime(line[3], "%Y-%m-%d %H:%M:%S"),
+                 datetime.strptime(line[4], "%Y-%m-%d %H:%M:%S"),
+                 int(line[5]), int(line[6])) for line in csv.reader(f)]
+    read_time = time.time() - began
+    _print_export('legacy', len(legacy), write_time, read_time, file_name)
+
+def _print_export(name, num_trips, write_time, read_time, file_name):
+    print "%8s | %10d | %10.2f | %10.2f | %12.1f | %10.1f" % (
+            name, num_trips, write_time, read_time,
+            num_trips / (write_time + read_time), os.path.getsize(file_name) / 1e6)
+    os.remove(file_name)
+
+def _ratio(ratio):
+    return "-" if ratio is None else "%.2f" % ratio
+
+BENCHMARKS = {
+    'calendar' : bench_calendar,
+    'crn' : bench_crn,
+    'export' : bench_export,
+    'lambdas' : bench_lambdas,
+    'persistence' : bench_persistence,
+    'rebalancing' : bench_rebalancing,
+    'replications' : bench_replications,
+    'streaming' : bench_streaming,
+    'water_filling' : bench_water_filling
+}
+
+def main():
+    if len(sys.argv) not in (2, 4) or sys.argv[1] not in BENCHMARKS:
+        sys.exit("Usage: python -m tests.benchmark <%s> [start_date end_date]"
+                 % "|".join(sorted(BENCHMARKS)))
+
+    if len(sys.argv) == 4:
+        start_date = datetime.strptime(sys.argv[2], '%Y-%m-%d')
+        end_date = datetime.strptime(sys.argv[3], '%Y-%m-%d')
+    else:
+        # A multi-day run
+        start_date = datetime(2012, 6, 4)
+        end_date = datetime(2012, 6, 8)
+
+    session = Connector().getDBSession()
+    BENCHMARKS[sys.argv[1]](session, start_date, end_date)
+    session.close()
+
+if __name__ == "__main__":
+    main()
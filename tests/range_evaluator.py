@@ -6,6 +6,7 @@ real trips.
 """
 
 from logic import ExponentialLogic, PoissonLogic, Simulator, AltPoissonLogic
+from logic.progress import DEFAULT_JOB
 from utils import Connector
 from models import Trip, Station
 
@@ -20,7 +21,8 @@ import sys
 import random
 
 class RangeEvaluator:
-    def __init__(self, start_date, end_date, logic_options = {}):
+    def __init__(self, start_date, end_date, logic_options = {}, job_id = DEFAULT_JOB,
+                 sinks = (), sim_logic = None):
         year = end_date.year
         if year > 2013:
             print "We don't have testing data for 2014 and beyond"
@@ -29,13 +31,22 @@ class RangeEvaluator:
         self.start_date = start_date
         self.end_date = end_date
         self.logic_options = logic_options
+        self.job_id = job_id
+        # ResultSinks the simulation's results also go to
+        self.sinks = sinks
+        # Sim logic to run, with its session (a new PoissonLogic if None)
+        self.sim_logic = sim_logic
 
         # by default, evaluator is not verbose
         self.verbose = False
 
-        c = Connector()
-        self.session = c.getDBSession()
-        self.engine = c.getDBEngine()
+        if sim_logic is None:
+            c = Connector()
+            self.session = c.getDBSession()
+            self.engine = c.getDBEngine()
+        else:
+            self.session = sim_logic.getDBSession()
+            self.engine = self.session.get_bind()
 
         # store produced and real trips in dictionaries
         # station id -> [number of departures, number of arrivals]
@@ -59,12 +70,13 @@ class RangeEvaluator:
         print "total real: ", total_real
 
     def get_produced_trips(self):
-        logic = PoissonLogic(self.session)
+        logic = self.sim_logic or PoissonLogic(self.session)
         #logic = ExponentialLogic(self.session)
         # logic = AltPoissonLogic(self.session)
         simulator = Simulator(logic)
         results = simulator.run(self.start_date, self.end_date,
-                                logic_options = self.logic_options)
+                                logic_options = self.logic_options,
+                                job_id = self.job_id, sinks = self.sinks)
         
         self.trips = results['trips']
         self.full_station_disappointments = results['full_station_disappointments']
@@ -74,17 +86,16 @@ class RangeEvaluator:
         self.arr_dis_station_counts = results['arr_dis_stations']
         self.dep_dis_station_counts = results['dep_dis_stations']
 
-        total_trips = 0
+        produced = results['trips']
+        total_trips = len(produced)
 
+        # Only stations that had a trip
         trips = {}
-        for trip in results['trips']:
-            trips.setdefault(trip.start_station_id, [0, 0])
-            trips.setdefault(trip.end_station_id, [0, 0])
-
-            trips[trip.start_station_id][0] += 1
-            trips[trip.end_station_id][1] += 1
-
-            total_trips += 1
+        dep_counts = produced.departure_counts()
+        arr_counts = produced.arrival_counts()
+        station_ids = produced.station_index.ids.tolist()
+        for idx in np.flatnonzero(dep_counts + arr_counts):
+            trips[station_ids[idx]] = [int(dep_counts[idx]), int(arr_counts[idx])]
 
         return trips, total_trips, len(self.full_station_disappointments), len(self.empty_station_disappointments)
         
@@ -7,6 +7,7 @@ between every pair of stations.
 
 from models import *
 from utils import Connector
+from logic.model_artifacts import invalidate
 
 from collections import defaultdict
 import math
@@ -104,6 +105,8 @@ def train_dest_distrs(session, start_d, end_d):
         stations_done += 1
         if stations_done % 10 == 0:
             print "Stations done",stations_done
+    # Compiled artifacts of the old rows are stale now
+    invalidate('dest_distr')
   
 def train_exp_lambdas(conn, start_d, end_d):
     engine = conn.getDBEngine()
@@ -163,6 +166,7 @@ def train_exp_lambdas(conn, start_d, end_d):
     # shouldn't be necessary but keep it there for now
     session.commit()
     session.flush()
+    invalidate('exp_lambda')
 
 
 
@@ -256,6 +260,7 @@ def train_poisson(conn, start_d, end_d):
     # flush for last time
     session.flush()
     session.commit()
+    invalidate('lambda')
 
     print "Number of trips used in training: %d" % trip_num
 
@@ -309,6 +314,7 @@ def train_gammas(session, start_date, end_date):
              
     session.flush()
     session.commit()
+    invalidate('gamma')
 
 def train_gaussian(connector, start_date, end_date):
     '''
@@ -3,64 +3,334 @@
 import tornado.ioloop
 import datetime
 import os
-import subprocess
 import json
 
 from analytics import PlotMap
-from tornado.web import RequestHandler, Application, asynchronous
+from tornado.web import RequestHandler, Application, HTTPError, asynchronous
+from tornado.websocket import WebSocketHandler
 from analytics import SummaryStats
 from analytics import clustering
+from logic import PoissonLogic
+from logic.progress import board
+from logic.result_sinks import LiveSink
+from logic.model_artifacts import model_version
+from logic.resident import warm_up, resident_logic, end_run
+from utils import Connector
+from jobs import *
+from result_cache import ResultCache, scenario_key
+
+# Runs the simulations and clusterings of every request, see jobs.py.
+# Its workers keep a warm PoissonLogic from one simulation to the next.
+job_service = JobService(initializer=warm_up, initargs=([PoissonLogic],))
+# Results of the simulations already run, see result_cache.py
+result_cache = ResultCache()
+# Seconds between two reads of the models' training versions: results
+# of models retrained meanwhile may be cached under the older version
+MODEL_VERSION_INTERVAL = 60
+# Session of the model versions, and the last version read, see
+# refresh_model_version
+_session = None
+_model_version = None
+
+
+def summary_stats_job(job_id, start_date, end_date, capacity={}, seed=None):
+    # Partial results go to the job's listeners, see JobStreamHandler
+    try:
+        return SummaryStats(start_date, end_date, capacity, seed, job_id,
+                            sinks=[LiveSink(send_update)],
+                            sim_logic=resident_logic(PoissonLogic)).get_stats()
+    finally:
+        end_run()
+
+def clusters_job(job_id, start_dstr, end_dstr, k, choice, cluster_type):
+    return clustering.get_clusters(start_dstr, end_dstr, k, choice, cluster_type)
+
+def unified_arguments(handler):
+    start_date = datetime.datetime.strptime(handler.get_argument("start"), "%Y-%m-%d %H:%M")
+    end_date = datetime.datetime.strptime(handler.get_argument("end"), "%Y-%m-%d %H:%M")
+
+    altered_capacity = json.loads(handler.get_argument("capacity"))
+    ac = {int(k): int(altered_capacity[k]) for k in altered_capacity}
+    altered_capacity = ac
+    # Same seed, same random numbers: lets clients compare capacities
+    seed = handler.get_argument("seed", default=None)
+    if seed is not None:
+        seed = int(seed)
+    return {"start_date" : start_date, "end_date" : end_date,
+            "capacity" : altered_capacity, "seed" : seed}
+
+def stats_arguments(handler):
+    start_date = datetime.datetime.strptime(handler.get_argument("start"),
+                                            "%Y-%m-%d %H:%M")
+    end_date = datetime.datetime.strptime(handler.get_argument("end"),
+                                          "%Y-%m-%d %H:%M")
+    return {"start_date" : start_date, "end_date" : end_date}
+
+def clustering_arguments(handler):
+    return {"start_dstr" : handler.get_argument("start_date"),
+            "end_dstr" : handler.get_argument("end_date"),
+            "cluster_type" : handler.get_argument("clustering_method"),
+            "k" : handler.get_argument("max_k", default = 5),
+            "choice" : handler.get_argument("choice", default = "totals")}
+
+# kind -> (function run as the job, function of the request handler
+# returning the job's arguments)
+JOB_KINDS = {
+    "unified" : (summary_stats_job, unified_arguments),
+    "stats" : (summary_stats_job, stats_arguments),
+    "clustering" : (clusters_job, clustering_arguments)
+}
+# Kinds whose results are kept in result_cache
+CACHED_KINDS = ["unified", "stats"]
+
+def refresh_model_version():
+    '''
+    Reads the models' training versions, every MODEL_VERSION_INTERVAL
+    seconds on the IOLoop rather than on every submission
+    '''
+    global _session, _model_version
+    if _session is None:
+        _session = Connector().getDBSession()
+    try:
+        _model_version = model_version(_session)
+    finally:
+        # Lets go of the connection, the next version is read afresh
+        _session.close()
+
+def current_model_version():
+    '''The models' version of the last refresh_model_version'''
+    if _model_version is None:
+        refresh_model_version()
+    return _model_version
+
+def cache_result(job):
+    if job.state == DONE:
+        result_cache.put(job.key, job.result, job.finished - job.started)
+
+def submit_job(handler, kind, callback=None):
+    """
+    Submits a job of kind with the request's arguments. The optional
+    'job' argument names the job (it's also what its progress is
+    published as), 'timeout' shortens the default timeout.
+
+    Jobs of CACHED_KINDS are answered from result_cache when their
+    scenario was run before, and join the job of an identical request
+    still running. Such jobs keep the id they were first submitted as.
+    """
+    function, get_arguments = JOB_KINDS[kind]
+    arguments = get_arguments(handler)
+    job_id = handler.get_argument("job", default=None)
+    owner = handler.request.remote_ip
+    key = None
+    if kind in CACHED_KINDS:
+        key = scenario_key(kind, arguments, current_model_version())
+        result = result_cache.get(key)
+        if result is not None:
+            return job_service.record(kind, result, job_id, owner, callback)
+        if job_service.find(key) is not None:
+            result_cache.coalesced += 1
+
+    timeout = handler.get_argument("timeout", default=None)
+    if timeout is not None:
+        timeout = min(float(timeout), job_service.default_timeout)
+    is_new = key is None or job_service.find(key) is None
+    job_id = job_service.submit(kind, function, arguments, job_id=job_id,
+                                timeout=timeout, owner=owner, callback=callback,
+                                key=key)
+    if key is not None and is_new:
+        job_service.watch(job_id, cache_result)
+    return job_id
+
+
+class JobHandler(RequestHandler):
+    """
+    Handlers whose post runs as a job of job_service and answers with its
+    result once it's done, leaving the IOLoop free meanwhile. The job is
+    cancelled if the client goes away.
+    """
+    job_kind = None
+
+    @asynchronous
+    def post(self):
+        self.job_id = None
+        self.connection_closed = False
+        try:
+            self.job_id = submit_job(self, self.job_kind, self.on_job_finished)
+        except JobRefused as e:
+            self.job_failed(503, str(e))
+
+    def on_job_finished(self, job):
+        if self.connection_closed:
+            return
+        if job.state == DONE:
+            self.write(job.result)
+            self.finish()
+        else:
+            self.job_failed(500, job.error)
+
+    def job_failed(self, status_code, error):
+        print error
+        self.send_error(status_code)
+
+    def on_connection_close(self):
+        self.connection_closed = True
+        if self.job_id is not None:
+            job_service.leave(self.job_id, self.on_job_finished)
+
+
+class UnifiedHandler(JobHandler):
+    job_kind = "unified"
 
-class UnifiedHandler(RequestHandler):
     def get(self):        
         stations = PlotMap().stations
         self.render("unified.html",title="Simba | Washington DC",locations=stations)
 
-    def post(self):
-        start_date = datetime.datetime.strptime(self.get_argument("start"), "%Y-%m-%d %H:%M")
-        end_date = datetime.datetime.strptime(self.get_argument("end"), "%Y-%m-%d %H:%M")
+    def job_failed(self, status_code, error):
+        print error
+        # some error occurred
+        self.write("{}")
+        self.finish()
 
-	altered_capacity = json.loads(self.get_argument("capacity"))
-	ac = {int(k): int(altered_capacity[k]) for k in altered_capacity}
-	altered_capacity = ac
+class StatsHandler(JobHandler):
+    job_kind = "stats"
 
-        try:
-            sstats = SummaryStats(start_date, end_date, altered_capacity)
-            self.write(sstats.get_stats())
-        except Exception as e:
-            print e
-            # some error occurred
-            self.write("{}")
-
-class StatsHandler(RequestHandler):
     def get(self):
         self.render("stats.html", title="Get Summary Stats on Generated Bike Trips")
 
-    def post(self):
-        start_date = datetime.datetime.strptime(self.get_argument("start"),
-                                                "%Y-%m-%d %H:%M")
-        end_date = datetime.datetime.strptime(self.get_argument("end"),
-                                              "%Y-%m-%d %H:%M")
-        
-        sstats = SummaryStats(start_date, end_date)
-        self.write(sstats.get_stats())
 
+class ClusterHandler(JobHandler):
+    job_kind = "clustering"
 
-class ClusterHandler(RequestHandler):
     def get(self):
         stations = PlotMap().stations
         self.render("clustering.html", title="Clustering Tool", locations=stations)
 
-    def post(self):
-        start_dstr = self.get_argument("start_date")
-        end_dstr = self.get_argument("end_date")
-        cluster_type = self.get_argument("clustering_method")
-        
-        k = self.get_argument("max_k", default = 5)
-        choice = self.get_argument("choice", default = "totals")
-        
-        clusters = clustering.get_clusters(start_dstr, end_dstr, k, choice, cluster_type)
-        self.write(clusters)
+
+def job_progress(job_id):
+    """The progress dict the job's run last published, None if there's none"""
+    progress = board().get(job_id)
+    if progress is not None:
+        progress["current_time"] = datetime.datetime.strftime(
+            progress["current_time"], "%Y-%m-%d %H:%M")
+    return progress
+
+class JobsHandler(RequestHandler):
+    """
+    Job endpoints:
+        POST /jobs/<kind> with the arguments of the kind's page: submits
+            the job and returns its job_id, or 503 if the server is busy
+        GET /jobs/<job id>: the job's status and progress
+        GET /jobs/<job id>/result: its result once done, 202 until then
+        DELETE /jobs/<job id>: gives up on it, which cancels it unless
+            identical requests share it
+    """
+
+    def post(self, kind):
+        if kind not in JOB_KINDS:
+            raise HTTPError(404)
+        try:
+            job_id = submit_job(self, kind)
+        except JobRefused as e:
+            self.set_status(503)
+            self.write({"error" : str(e)})
+            return
+        self.write({"job_id" : job_id})
+
+    def get(self, job_id, result=None):
+        job = job_service.get(job_id)
+        if job is None:
+            raise HTTPError(404)
+        if result is None:
+            status = job.status()
+            status["progress"] = job_progress(job_id) if job.state == RUNNING else None
+            self.write(status)
+        elif job.state == DONE:
+            self.write(job.result)
+        else:
+            self.set_status(202 if job.state in (QUEUED, RUNNING) else 500)
+            self.write(job.status())
+
+    def delete(self, job_id):
+        if job_service.get(job_id) is None:
+            raise HTTPError(404)
+        self.write({"cancelled" : job_service.leave(job_id)})
+
+
+class JobStreamHandler(WebSocketHandler):
+    """
+    WebSocket /jobs/<job id>/live: follows a job submitted to /jobs, with
+    JSON messages of a "type":
+        progress: its run's progress (percent_progress, current_time,
+            events_per_sec, eta_seconds), whenever it changes
+        partial: a LiveSink update, partial results of the run since the
+            previous one (the updates sent before connecting come first)
+        result: the job's "result", after which the socket is closed
+        failed: the job's state and error, after which the socket is closed
+    Closing the socket before the job is over gives up on it, as DELETE
+    /jobs/<job id> does.
+    """
+    # Milliseconds between two looks at the job's progress
+    progress_interval = 250
+
+    def open(self, job_id):
+        self.job_id = job_id
+        self.last_progress = None
+        self.progress_timer = None
+        job = job_service.get(job_id)
+        if job is None:
+            self.write_message({"type" : "failed", "state" : None,
+                                "error" : "Unknown job %s" % job_id})
+            self.close()
+            return
+        for update in job.updates:
+            self.on_update(job, update)
+        if job.state in FINISHED_STATES:
+            self.on_job_finished(job)
+            return
+        job_service.subscribe(job_id, self.on_update)
+        job_service.watch(job_id, self.on_job_finished)
+        self.progress_timer = tornado.ioloop.PeriodicCallback(self.send_progress,
+                                                              self.progress_interval)
+        self.progress_timer.start()
+
+    def send_progress(self):
+        progress = job_progress(self.job_id)
+        if progress is not None and progress != self.last_progress:
+            self.last_progress = progress
+            self.write_message(dict(progress, type="progress"))
+
+    def on_update(self, job, update):
+        self.write_message(dict(update, type="partial"))
+
+    def on_job_finished(self, job):
+        self.stop_following()
+        if job.state == DONE:
+            self.send_progress()
+            self.write_message({"type" : "result", "result" : job.result})
+        else:
+            self.write_message({"type" : "failed", "state" : job.state,
+                                "error" : job.error})
+        self.close()
+
+    def stop_following(self):
+        if self.progress_timer is not None:
+            self.progress_timer.stop()
+            self.progress_timer = None
+        job_service.unsubscribe(self.job_id, self.on_update)
+
+    def on_close(self):
+        if self.progress_timer is None:
+            # Not following the job, or it's over
+            return
+        self.stop_following()
+        job_service.leave(self.job_id, self.on_job_finished)
+
+
+class CacheHandler(RequestHandler):
+    """GET /cache: hit rates and latencies of result_cache"""
+
+    def get(self):
+        self.write(result_cache.stats())
 
 
 class AboutHandler(RequestHandler):
@@ -85,7 +355,11 @@ if __name__ == "__main__":
         (r"/about", AboutHandler),
         (r"/stats", StatsHandler),
         (r"/unified", UnifiedHandler),
-        (r"/clustering", ClusterHandler)
+        (r"/clustering", ClusterHandler),
+        (r"/cache", CacheHandler),
+        (r"/jobs/([\w-]+)", JobsHandler),
+        (r"/jobs/([\w-]+)/live", JobStreamHandler),
+        (r"/jobs/([\w-]+)/(result)", JobsHandler)
     ], **settings)
 
 
@@ -93,10 +367,11 @@ if __name__ == "__main__":
     application.listen(port_num)
     print "listening on port", port_num
 
-    # run another server to use for long-polling
-    cmd = ["python",
-           "-m",
-           "views.long_polling"]
-    proc = subprocess.Popen(cmd)
+    # Forks the workers ahead of the first request, then moves the jobs along
+    job_service.start()
+    tornado.ioloop.PeriodicCallback(job_service.poll, 100).start()
+    refresh_model_version()
+    tornado.ioloop.PeriodicCallback(refresh_model_version,
+                                    MODEL_VERSION_INTERVAL * 1000).start()
 
     tornado.ioloop.IOLoop.instance().start()
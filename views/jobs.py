@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+'''
+jobs.py
+
+Runs the long requests of the web app (simulations, clustering) as jobs
+outside of the Tornado IOLoop, on max_running worker processes forked
+ahead of time. Workers live on from job to job, so whatever a job leaves
+in its process (see logic/resident.py) is there for the next one. A
+cancelled or timed out job has its worker killed and replaced by a new
+one. At most max_queued jobs wait for a worker; submitting past that,
+or past max_per_client active jobs of one client, is refused rather
+than queued, so a crowd of users can't oversubscribe the machine.
+
+While it runs, a job may send updates (partial results, say) with
+send_update; they're kept on the job and handed to its listeners, see
+subscribe.
+
+Jobs submitted with a key are shared: submitting a key whose job is
+still queued or running joins that job instead of starting another one,
+see join and leave.
+
+JobService.start forks the workers, JobService.poll must then be called
+every so often on the IOLoop (see app.py): it starts queued jobs,
+collects results, enforces timeouts, replaces killed workers and runs
+the jobs' callbacks, all without blocking.
+'''
+
+import multiprocessing
+import time
+import traceback
+import uuid
+
+# Job states
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+TIMED_OUT = 'timed_out'
+FINISHED_STATES = [DONE, FAILED, CANCELLED, TIMED_OUT]
+
+# Seconds a job may run by default
+DEFAULT_TIMEOUT = 30 * 60
+# Seconds finished jobs are kept for their results
+KEEP_FINISHED = 10 * 60
+
+# Kinds of the messages of a worker
+UPDATE = 'update'
+RESULT = 'result'
+# What a worker is sent to exit
+STOP = None
+
+
+class JobRefused(Exception):
+    '''Raised by submit when the service can't take any more jobs'''
+    pass
+
+
+class Job:
+    def __init__(self, job_id, kind, function, arguments, timeout, owner, key=None):
+        self.job_id = job_id
+        self.kind = kind
+        # Called in the job's process as function(job_id, **arguments)
+        self.function = function
+        self.arguments = arguments
+        self.timeout = timeout
+        self.owner = owner
+        # Identical requests have the same key and share the job
+        self.key = key
+        # Called on the IOLoop with the job once it's finished
+        self.callbacks = []
+        # Requests waiting on the job, see JobService.leave
+        self.clients = 0
+        # Updates sent so far, and functions of (job, update) called with
+        # the next ones
+        self.updates = []
+        self.listeners = []
+
+        self.state = QUEUED
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+
+        # Worker running the job
+        self.worker = None
+
+    def status(self):
+        '''Everything about the job but its result, JSON serializable'''
+        return {'job_id' : self.job_id,
+                'kind' : self.kind,
+                'state' : self.state,
+                'submitted' : self.submitted,
+                'started' : self.started,
+                'finished' : self.finished,
+                'error' : self.error}
+
+
+# Connection of a worker process to the service, see send_update
+_connection = None
+
+def send_update(update):
+    '''
+    From within a job, sends update (anything picklable) to the job's
+    listeners. Does nothing outside of jobs.
+    '''
+    if _connection is not None:
+        _connection.send((UPDATE, update))
+
+def _serve(connection, initializer, initargs):
+    '''
+    Body of a worker process: runs the (function, job id, arguments) jobs
+    it's sent one after the other, sending back (succeeded, result or
+    error) of each, until it's sent STOP
+    '''
+    global _connection
+    if initializer is not None:
+        try:
+            initializer(*initargs)
+        except Exception:
+            # Jobs will do without
+            traceback.print_exc()
+    _connection = connection
+    while True:
+        try:
+            job = connection.recv()
+        except EOFError:
+            return
+        if job is STOP:
+            return
+        function, job_id, arguments = job
+        try:
+            result = function(job_id, **arguments)
+            connection.send((RESULT, (True, result)))
+        except Exception:
+            connection.send((RESULT, (False, traceback.format_exc())))
+
+
+class Worker:
+    '''A worker process, forked as soon as it's made'''
+
+    def __init__(self, initializer=None, initargs=()):
+        self.connection, child_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_serve,
+                                               args=(child_connection, initializer,
+                                                     initargs))
+        self.process.daemon = True
+        self.process.start()
+        # Only the worker uses its end
+        child_connection.close()
+        # Job it runs, None while idle
+        self.job = None
+
+    def run(self, job):
+        self.connection.send((job.function, job.job_id, job.arguments))
+        self.job = job
+
+    def stop(self):
+        '''Lets an idle worker exit'''
+        try:
+            self.connection.send(STOP)
+        except IOError:
+            pass
+        self.process.join()
+        self.connection.close()
+
+    def kill(self):
+        self.process.terminate()
+        self.process.join()
+        self.connection.close()
+
+
+class JobService:
+    def __init__(self, max_running=None, max_queued=None, max_per_client=2,
+                 default_timeout=DEFAULT_TIMEOUT, keep_finished=KEEP_FINISHED,
+                 initializer=None, initargs=()):
+        '''
+        initializer: called as initializer(*initargs) by every worker when
+        it starts, to warm it up for its jobs
+        '''
+        if max_running is None:
+            max_running = multiprocessing.cpu_count()
+        if max_queued is None:
+            max_queued = 2 * max_running
+        self.max_running = max_running
+        self.max_queued = max_queued
+        self.max_per_client = max_per_client
+        self.default_timeout = default_timeout
+        self.keep_finished = keep_finished
+        self.initializer = initializer
+        self.initargs = initargs
+
+        self.workers = []
+        # job id -> Job, of every job not yet forgotten
+        self.jobs = {}
+        # Job ids waiting to run, oldest first
+        self.queue = []
+        self.running = set()
+        # key -> job id, of the jobs with a key not yet finished
+        self.keys = {}
+
+    def submit(self, kind, function, arguments={}, job_id=None, timeout=None,
+               owner=None, callback=None, key=None):
+        '''
+        Queues function(job_id, **arguments) and returns the job's id, a
+        new one unless job_id is given. function and arguments must be
+        picklable. owner identifies the client, for max_per_client.
+        If the job of key is still queued or running, joins it and returns
+        its id instead: sharing a job is never refused.
+        '''
+        if key in self.keys:
+            return self.join(self.keys[key], callback)
+        if len(self.queue) >= self.max_queued:
+            raise JobRefused('Too many jobs waiting')
+        if owner is not None and self.max_per_client is not None:
+            active = [job for job in self.jobs.itervalues()
+                      if job.owner == owner and job.state not in FINISHED_STATES]
+            if len(active) >= self.max_per_client:
+                raise JobRefused('Too many jobs for %s' % owner)
+        if job_id is None:
+            job_id = uuid.uuid4().hex
+        elif job_id in self.jobs:
+            raise JobRefused('Job %s already exists' % job_id)
+        if timeout is None:
+            timeout = self.default_timeout
+
+        self.jobs[job_id] = Job(job_id, kind, function, arguments, timeout, owner, key)
+        if key is not None:
+            self.keys[key] = job_id
+        self.queue.append(job_id)
+        self.join(job_id, callback)
+        self.poll()
+        return job_id
+
+    def record(self, kind, result, job_id=None, owner=None, callback=None):
+        '''
+        Adds a job that is already done, with result (of a cache, say), so
+        its result is served like any other's. Returns the job's id.
+        '''
+        if job_id is None or job_id in self.jobs:
+            job_id = uuid.uuid4().hex
+        job = Job(job_id, kind, None, {}, 0, owner)
+        self.jobs[job_id] = job
+        job.started = time.time()
+        job.result = result
+        self.join(job_id, callback)
+        self._finish(job, DONE)
+        return job_id
+
+    def get(self, job_id):
+        '''The Job of job_id, None if unknown or forgotten'''
+        return self.jobs.get(job_id)
+
+    def find(self, key):
+        '''The queued or running Job of key, None if there's none'''
+        job_id = self.keys.get(key)
+        return None if job_id is None else self.jobs[job_id]
+
+    def join(self, job_id, callback=None):
+        '''
+        Adds a client to a queued or running job, callback being called
+        along with the others once it's finished. Returns the job's id.
+        '''
+        self.jobs[job_id].clients += 1
+        self.watch(job_id, callback)
+        return job_id
+
+    def watch(self, job_id, callback):
+        '''Calls callback with the job once it's finished, like a client's'''
+        if callback is not None:
+            self.jobs[job_id].callbacks.append(callback)
+
+    def subscribe(self, job_id, listener):
+        '''Calls listener(job, update) with every update the job sends from now on'''
+        self.jobs[job_id].listeners.append(listener)
+
+    def unsubscribe(self, job_id, listener):
+        job = self.jobs.get(job_id)
+        if job is not None and listener in job.listeners:
+            job.listeners.remove(listener)
+
+    def leave(self, job_id, callback=None):
+        '''
+        A client of the job gives up on it (callback being the one it
+        joined with): the job is cancelled once it has no client left.
+        Returns whether it was cancelled.
+        '''
+        job = self.jobs.get(job_id)
+        if job is None or job.state in FINISHED_STATES:
+            return False
+        if callback in job.callbacks:
+            job.callbacks.remove(callback)
+        job.clients -= 1
+        if job.clients > 0:
+            return False
+        return self.cancel(job_id)
+
+    def cancel(self, job_id):
+        '''Stops a queued or running job, returns whether it was stopped'''
+        job = self.jobs.get(job_id)
+        if job is None or job.state in FINISHED_STATES:
+            return False
+        if job.state == QUEUED:
+            self.queue.remove(job_id)
+        else:
+            self._stop(job)
+        self._finish(job, CANCELLED)
+        return True
+
+    def start(self):
+        '''Forks the workers missing to make max_running of them'''
+        for worker in list(self.workers):
+            if worker.job is None and not worker.process.is_alive():
+                self._retire(worker)
+        while len(self.workers) < self.max_running:
+            self.workers.append(Worker(self.initializer, self.initargs))
+
+    def poll(self):
+        '''Moves every job along, to call regularly on the IOLoop'''
+        now = time.time()
+        for job_id in list(self.running):
+            job = self.jobs[job_id]
+            worker = job.worker
+            outcome = self._receive(job)
+            if outcome is not None:
+                succeeded, value = outcome
+                if succeeded:
+                    job.result = value
+                    self._finish(job, DONE)
+                else:
+                    job.error = value
+                    self._finish(job, FAILED)
+            elif not worker.process.is_alive() and not worker.connection.poll():
+                job.error = 'Worker exited with code %s' % worker.process.exitcode
+                self._retire(worker)
+                self._finish(job, FAILED)
+            elif now - job.started > job.timeout:
+                self._stop(job)
+                job.error = 'Timed out after %d seconds' % job.timeout
+                self._finish(job, TIMED_OUT)
+
+        # Replaces the workers killed meanwhile, ahead of the next jobs
+        self.start()
+        idle = [worker for worker in self.workers if worker.job is None]
+        while self.queue and idle:
+            self._start(self.jobs[self.queue.pop(0)], idle.pop(0))
+
+        for job_id, job in self.jobs.items():
+            if job.state in FINISHED_STATES and now - job.finished > self.keep_finished:
+                del self.jobs[job_id]
+
+    def _start(self, job, worker):
+        worker.run(job)
+        job.worker = worker
+        job.state = RUNNING
+        job.started = time.time()
+        self.running.add(job.job_id)
+
+    def _receive(self, job):
+        '''
+        Hands the updates the job sent to its listeners, returns its
+        (succeeded, result or error) if it's over, else None
+        '''
+        worker = job.worker
+        while worker.connection.poll():
+            try:
+                kind, value = worker.connection.recv()
+            except EOFError:
+                worker.process.join()
+                self._retire(worker)
+                return False, 'Worker exited with code %s' % worker.process.exitcode
+            if kind == RESULT:
+                return value
+            job.updates.append(value)
+            for listener in list(job.listeners):
+                listener(job, value)
+        return None
+
+    def _stop(self, job):
+        '''Kills the worker of a running job, a new one takes its place'''
+        job.worker.kill()
+        self._retire(job.worker)
+
+    def _retire(self, worker):
+        worker.job = None
+        if worker in self.workers:
+            self.workers.remove(worker)
+
+    def _finish(self, job, state):
+        job.state = state
+        job.finished = time.time()
+        self.running.discard(job.job_id)
+        if job.key is not None:
+            del self.keys[job.key]
+        if job.worker is not None:
+            job.worker.job = None
+            job.worker = None
+        for callback in job.callbacks:
+            callback(job)
+
+    def shutdown(self):
+        '''Cancels every job and stops the workers'''
+        for job_id in list(self.queue) + list(self.running):
+            self.cancel(job_id)
+        for worker in self.workers:
+            worker.stop()
+        self.workers = []
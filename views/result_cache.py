@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+'''
+result_cache.py
+
+Results of the simulation jobs of the web app (the JSON of SummaryStats),
+kept so a scenario submitted again is answered without being run again.
+Results are keyed by scenario_key: a hash of the job's kind, its
+arguments, the seed policy and the training version of the models, so
+retraining any model leaves every older result behind.
+
+The last max_entries results are kept in memory, least recently used out
+first, in front of one file per result in directory. The files survive
+restarts and are bounded to max_bytes, least recently used removed first.
+Identical requests arriving while their scenario runs share its job
+instead (see JobService.join), stats counts them as coalesced.
+'''
+
+import collections
+import datetime
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+CACHE_DIR = os.environ.get('SIMBA_RESULT_DIR',
+                           os.path.join(os.path.expanduser('~'), '.simba', 'results'))
+# Results kept in memory
+MAX_ENTRIES = 64
+# Size bound of the result files
+MAX_BYTES = 256 * 1024**2
+# Bumped when the jobs' results change for the same arguments
+CACHE_FORMAT = 1
+RESULT_EXTENSION = '.json'
+
+
+def _canonical(value):
+    if isinstance(value, datetime.datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    raise TypeError('Cannot make a key of %r' % (value,))
+
+def scenario_key(kind, arguments, model_version):
+    '''
+    Hex digest of a job's scenario. Unseeded runs draw their own random
+    numbers, their key only says they're unseeded: an unseeded scenario
+    submitted again gets the sample drawn the first time.
+    '''
+    seed = arguments.get('seed')
+    scenario = {'format' : CACHE_FORMAT,
+                'kind' : kind,
+                'arguments' : arguments,
+                'seed_policy' : 'unseeded' if seed is None else 'seeded',
+                'models' : model_version}
+    text = json.dumps(scenario, sort_keys=True, separators=(',', ':'),
+                      default=_canonical)
+    return hashlib.sha1(text).hexdigest()
+
+
+class ResultCache:
+
+    def __init__(self, directory=CACHE_DIR, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # key -> result, least recently used first
+        self.memory = collections.OrderedDict()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        # Seconds spent looking up hits, and computing missed results
+        self.hit_seconds = 0.
+        self.computed = 0
+        self.compute_seconds = 0.
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + RESULT_EXTENSION)
+
+    def get(self, key):
+        '''The result of key, None if it isn't cached'''
+        began = time.time()
+        result = self.memory.pop(key, None)
+        if result is not None:
+            self.memory_hits += 1
+        else:
+            result = self._read(key)
+            if result is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        self._remember(key, result)
+        self.hit_seconds += time.time() - began
+        return result
+
+    def put(self, key, result, seconds=None):
+        '''
+        Caches the result of key, a string. seconds: how long it took to
+        compute, for stats
+        '''
+        if seconds is not None:
+            self.computed += 1
+            self.compute_seconds += seconds
+        self.memory.pop(key, None)
+        self._remember(key, result)
+        self._write(key, result)
+        self._evict(keep=self._path(key))
+
+    def _remember(self, key, result):
+        self.memory[key] = result
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def _read(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                result = f.read()
+        except IOError:
+            return None
+        try:
+            # Marks it as recently used
+            os.utime(path, None)
+        except OSError:
+            # Evicted by another server in the meantime
+            pass
+        return result
+
+    def _write(self, key, result):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # Made by another server
+                pass
+        # Written aside then renamed, readers never see half a result
+        handle, temp_path = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        with os.fdopen(handle, 'wb') as f:
+            f.write(result)
+        os.rename(temp_path, self._path(key))
+
+    def _file_sizes(self):
+        '''(last used, path, size) of every result file'''
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(RESULT_EXTENSION):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                files.append((os.path.getmtime(path), path, os.path.getsize(path)))
+            except OSError:
+                pass
+        return files
+
+    def _evict(self, keep=None):
+        '''Removes least recently used result files until they fit max_bytes'''
+        files = self._file_sizes()
+        total = sum(size for used, path, size in files)
+        for used, path, size in sorted(files):
+            if total <= self.max_bytes:
+                break
+            if path != keep:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+
+    def stats(self):
+        '''Hit rates and latencies, JSON serializable'''
+        hits = self.memory_hits + self.disk_hits
+        lookups = hits + self.misses
+        files = self._file_sizes() if os.path.isdir(self.directory) else []
+        return {'lookups' : lookups,
+                'memory_hits' : self.memory_hits,
+                'disk_hits' : self.disk_hits,
+                'misses' : self.misses,
+                'coalesced' : self.coalesced,
+                'hit_rate' : float(hits) / lookups if lookups else None,
+                'mean_hit_ms' : 1000 * self.hit_seconds / hits if hits else None,
+                'mean_compute_seconds' : self.compute_seconds / self.computed
+                                         if self.computed else None,
+                'memory_entries' : len(self.memory),
+                'disk_entries' : len(files),
+                'disk_bytes' : sum(size for used, path, size in files)}
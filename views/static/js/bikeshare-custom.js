@@ -424,34 +424,62 @@ function updateProgressBar(currentTime, percentProgress, isError) {
     }
 }
 
-function pollProgress(hasZero, currentUrl) {
-    var hasHundred = false;
-    var hasError = false;
-    setTimeout(function() {
-        $.ajax({
-            url: currentUrl,
-            type: "GET",
-            success: function(data) {
-                if (data.percent_progress == 0) {
-                    hasZero = true;
-                }
-                if (hasZero) {
-                    updateProgressBar(data.current_time, data.percent_progress);
-                    hasHundred = data.percent_progress == 100;
-                }
-            },
-            complete: function() {
-                if (!hasHundred && !hasError) {
-                    pollProgress(hasZero, currentUrl);
-                }
-            }
-            , error: function() {
-                hasError = true;
-		console.log("found some error");
-                updateProgressBar(null, null, true);
-            }
-        });
-    }, 100);
+// Sum of the partial results of the running simulation, by hour
+var liveResults = null;
+
+function resetLiveResults() {
+    liveResults = {trips: {}, empty_disappointments: {}, full_disappointments: {},
+                   occupancy: {}, num_trips: 0, num_disappointments: 0};
+    $("#live_trips").html(0);
+    $("#live_disappointments").html(0);
+}
+
+function addCounts(totals, counts) {
+    var added = 0;
+    for (var key in counts) {
+        totals[key] = (totals[key] || 0) + counts[key];
+        added += counts[key];
+    }
+    return added;
+}
+
+function addPartialResults(update) {
+    liveResults.num_trips += addCounts(liveResults.trips, update.trips);
+    liveResults.num_disappointments +=
+        addCounts(liveResults.empty_disappointments, update.empty_disappointments) +
+        addCounts(liveResults.full_disappointments, update.full_disappointments);
+    addCounts(liveResults.occupancy, update.occupancy);
+    $("#live_trips").html(liveResults.num_trips);
+    $("#live_disappointments").html(liveResults.num_disappointments);
+}
+
+// Follows the job over a WebSocket (see JobStreamHandler in app.py),
+// onResult gets the job's result
+function followJob(jobId, onResult) {
+    var protocol = window.location.protocol == "https:" ? "wss://" : "ws://";
+    var socket = new WebSocket(protocol + window.location.host + "/jobs/" + jobId + "/live");
+    var over = false;
+    socket.onmessage = function(event) {
+        var message = JSON.parse(event.data);
+        if (message.type == "progress") {
+            updateProgressBar(message.current_time, message.percent_progress);
+        } else if (message.type == "partial") {
+            addPartialResults(message);
+        } else if (message.type == "result") {
+            over = true;
+            onResult(message.result);
+        } else if (message.type == "failed") {
+            over = true;
+            console.log(message.error);
+            updateProgressBar(null, null, true);
+        }
+    };
+    socket.onclose = function() {
+        if (!over) {
+            updateProgressBar(null, null, true);
+        }
+    };
+    return socket;
 }
 
 function processStatsForm() {
@@ -470,10 +498,10 @@ function processStatsForm() {
 	if (!to.length) {
 		to = currentDate;
 	}
-	var datatosend = { start: from, end: to, capacity: capacity_dict_string};
+	var datatosend = { start: from, end: to, capacity: capacity_dict_string };
 	$.ajax({
 	    type: "POST",
-	    url: "/unified",
+	    url: "/jobs/unified",
 	    data: datatosend,
 	    beforeSend: function() {
                 if (in_comp_mode) {toggle_comps();}
@@ -497,37 +525,15 @@ function processStatsForm() {
                 loadingDiv.find("#error_alert").hide();
                 var slider_left_pos = parseInt($("#stats_slider").css('left'),10);
                 if (slider_left_pos == 660) {map.panBy(320,0);}
+                resetLiveResults();
                 loadingDiv.show();
-                pollProgress(false, "http://cmc307-04.mathcs.carleton.edu:3001");
             },
 
-	    success: function(data) {
-                res = data.concat('!?!',from,'!?!',to);
-                var jsond = JSON.parse(data);
-                data_for_maps = jsond;
-                if (Object.keys(jsond).length == 0) {
-                    updateProgressBar(null, null, true);
-                    return;
-                }
-
-                $("#stats_name").html('Summary for most recent simulation:');
-                $("#stats_range").html(from + ' to ' + to);
-                $("#loading_div").hide();
-                $("#stats_slider").animate({left: 660},400);
-                $("#stats_panel").css('width','640px');
-                $(flexy_tables).addClass('large-12');
-                $(flexy_tables).removeClass('large-6');
-                displaySummaryStats(jsond, from, to);
-                map.panBy(-320,0);
-		        
-                $.getScript("static/js/visualize-helper.js")
-                .done(function(){changeMapVis("by_popularity");})
-                .fail(function(jqxhr, settings, exception) {
-                    console.log(jqxhr);
-                    console.log(settings);
-                    console.log(exception);
+	    success: function(job) {
+                followJob(job.job_id, function(data) {
+                    showSimulationResult(data, from, to);
                 });
-        },
+            },
 
         error: function() {
             console.log("damn it.");
@@ -535,3 +541,31 @@ function processStatsForm() {
         }
 	});
 }
+
+function showSimulationResult(data, from, to) {
+    res = data.concat('!?!',from,'!?!',to);
+    var jsond = JSON.parse(data);
+    data_for_maps = jsond;
+    if (Object.keys(jsond).length == 0) {
+        updateProgressBar(null, null, true);
+        return;
+    }
+
+    $("#stats_name").html('Summary for most recent simulation:');
+    $("#stats_range").html(from + ' to ' + to);
+    $("#loading_div").hide();
+    $("#stats_slider").animate({left: 660},400);
+    $("#stats_panel").css('width','640px');
+    $(flexy_tables).addClass('large-12');
+    $(flexy_tables).removeClass('large-6');
+    displaySummaryStats(jsond, from, to);
+    map.panBy(-320,0);
+
+    $.getScript("static/js/visualize-helper.js")
+    .done(function(){changeMapVis("by_popularity");})
+    .fail(function(jqxhr, settings, exception) {
+        console.log(jqxhr);
+        console.log(settings);
+        console.log(exception);
+    });
+}